@@ -0,0 +1,315 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from typing import Optional, Sequence
+
+import numpy as np
+
+
+# quality settings every pose is rendered with
+Preset = namedtuple("Preset", ["name", "render_simple", "reflection_depth"])
+
+PRESETS = (
+    Preset("simple", True, 0),
+    Preset("phong", False, 0),
+    Preset("phong-reflections-1", False, 1),
+    Preset("phong-reflections-2", False, 2)
+)
+
+POSES = ("initial", "close-up", "sky")
+
+# the close-up camera covers this fraction of the distance to the surface in the center of the initial view
+CLOSE_UP_APPROACH = 0.9
+
+
+def get_git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def set_pose(render, camera, pose):
+    fractal = render.fractal
+
+    position = np.array(fractal.get_initial_camera_position(), dtype=np.float32)
+    target = np.array(fractal.get_initial_camera_target(), dtype=np.float32)
+
+    camera.zoom = 1.0
+    camera.position = position.copy()
+    camera.look_at(target)
+
+    if pose == "close-up":
+        depth = render.render_depth()
+        distance = depth[render.height // 2, render.width // 2]
+
+        # a view that misses the fractal in the center stays where it is
+        if distance < 1e19:
+            camera.position = position + camera.direction * distance * CLOSE_UP_APPROACH
+
+    elif pose == "sky":
+        camera.look_at(position + (position - target))
+
+
+def benchmark_frame(render, repeats):
+    # the first frame is not measured, it pays for the upload of the uniforms
+    render.render()
+
+    kernel_times = []
+    wall_times = []
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        render.render()
+        render.finish()
+
+        wall_times.append(time.perf_counter() - start)
+        kernel_times.append(render.last_kernel_time)
+
+    statistics = render.render_statistics().summary()
+
+    kernel_time = float(np.median(kernel_times))
+    pixels = render.width * render.height
+    ray_steps = sum(statistics[name]["total"] for name in ("primary_steps", "shadow_steps", "reflection_steps"))
+
+    return {
+        "kernel_time_median": kernel_time,
+        "kernel_time_min": float(np.min(kernel_times)),
+        "wall_time_median": float(np.median(wall_times)),
+        "mpixels_per_second": pixels / kernel_time * 1e-6,
+        "ray_steps_per_second": ray_steps / kernel_time,
+        "distance_evaluations_per_second": statistics["distance_evaluations"]["total"] / kernel_time,
+        "ray_steps": ray_steps,
+        "distance_evaluations": statistics["distance_evaluations"]["total"]
+    }
+
+
+def run(platform_id=0,
+        device_id=0,
+        width=320,
+        height=240,
+        repeats=5,
+        fractal_names: Optional[Sequence[str]] = None,
+        preset_names: Optional[Sequence[str]] = None,
+        use_cache=False,
+        tune_work_groups=False,
+        camera_path: Optional[str] = None):
+
+    # compile times are only comparable with a cold cache, so it is disabled unless asked for
+    if not use_cache:
+        os.environ["PYFRACTALEXPLORER_CACHE_DIR"] = ""
+
+    import pyopencl as cl
+
+    from src import Camera, Render
+    from src.camera_path import load_camera_path, replay_camera_path, summarize_frame_times
+    from src.work_group_tuning import WorkGroupTuner
+
+    presets = [preset for preset in PRESETS if preset_names is None or preset.name in preset_names]
+
+    startup_start = time.perf_counter()
+
+    device = cl.get_platforms()[platform_id].get_devices()[device_id]
+    context = cl.Context([device])
+    queue = cl.CommandQueue(context, properties=cl.command_queue_properties.PROFILING_ENABLE)
+
+    camera = Camera(device, context, queue)
+    # the local sizes are tuned in the unmeasured first frame of every case, and not persisted,
+    # so every run measures against the same candidates
+    work_group_tuner = WorkGroupTuner() if tune_work_groups else None
+
+    render = Render(device, context, queue, camera, width=width, height=height, work_group_tuner=work_group_tuner)
+
+    startup_time = time.perf_counter() - startup_start
+
+    # names are matched case-insensitively, an unknown one is an error rather than a run without results
+    fractals = render.fractals
+
+    if fractal_names is not None:
+        wanted = {fractal_name.lower() for fractal_name in fractal_names}
+        known = {fractal.get_name().lower() for fractal in render.fractals}
+
+        for fractal_name in fractal_names:
+            if fractal_name.lower() not in known:
+                raise ValueError("Unknown fractal {!r}, expected one of: {}".format(
+                    fractal_name, ", ".join(fractal.get_name() for fractal in render.fractals)))
+
+        fractals = [fractal for fractal in render.fractals if fractal.get_name().lower() in wanted]
+
+    results = []
+    compile_times = {}
+
+    for fractal in fractals:
+        name = fractal.get_name()
+
+        compile_start = time.perf_counter()
+        fractal.build()
+        compile_times[name] = time.perf_counter() - compile_start
+
+        # the instrumented program used for the ray step counts is compiled ahead, outside of any measurement
+        fractal.build_statistics()
+
+        render.fractal = fractal
+
+        for pose in POSES:
+            for preset in presets:
+                render.render_simple = preset.render_simple
+                render.reflection_depth = preset.reflection_depth
+
+                set_pose(render, camera, pose)
+
+                result = {"fractal": name, "pose": pose, "preset": preset.name}
+                result.update(benchmark_frame(render, repeats))
+
+                results.append(result)
+
+                print(
+                    "{:<20} {:<9} {:<20} {:8.2f} ms {:8.3f} Mpix/s {:10.2f} Msteps/s".format(
+                        name,
+                        pose,
+                        preset.name,
+                        result["kernel_time_median"] * 1e3,
+                        result["mpixels_per_second"],
+                        result["ray_steps_per_second"] * 1e-6
+                    ),
+                    file=sys.stderr
+                )
+
+    replay = None
+
+    # a recorded flight is rendered frame by frame as it was seen in the explorer, its frame time distribution
+    # can be compared across builds
+    if camera_path is not None:
+        records = load_camera_path(camera_path)
+        times = replay_camera_path(render, camera, records)
+
+        replay = {
+            "path": camera_path,
+            "frames": len(records),
+            "kernel_time": summarize_frame_times(times["kernel_times"]),
+            "wall_time": summarize_frame_times(times["wall_times"]),
+            "kernel_times": times["kernel_times"].tolist()
+        }
+
+        print(
+            "{:<20} {:>5} frames p50 {:8.2f} ms p95 {:8.2f} ms".format(
+                os.path.basename(camera_path),
+                len(records),
+                replay["kernel_time"]["p50"] * 1e3,
+                replay["kernel_time"]["p95"] * 1e3
+            ),
+            file=sys.stderr
+        )
+
+    return {
+        "meta": {
+            "timestamp": time.time(),
+            "revision": get_git_revision(),
+            "python": platform.python_version(),
+            "pyopencl": cl.VERSION_TEXT,
+            "numpy": np.__version__,
+            "platform": device.platform.name,
+            "device": device.name,
+            "driver": device.driver_version,
+            "width": width,
+            "height": height,
+            "repeats": repeats,
+            "program_cache": use_cache,
+            "work_group_tuning": tune_work_groups
+        },
+        "startup_time": startup_time,
+        "compile_times": compile_times,
+        "results": results,
+        "camera_path": replay
+    }
+
+
+def compare(results, baseline):
+    # prints the kernel time speedup of every case present in both runs
+    def key(result):
+        return result["fractal"], result["pose"], result["preset"]
+
+    baseline_by_key = {key(result): result for result in baseline["results"]}
+
+    for result in results["results"]:
+        reference = baseline_by_key.get(key(result))
+
+        if reference is None:
+            continue
+
+        print("{:<20} {:<9} {:<20} {:6.2f}x".format(
+            *key(result),
+            reference["kernel_time_median"] / result["kernel_time_median"]
+        ))
+
+    replay, reference = results.get("camera_path"), baseline.get("camera_path")
+
+    if replay is not None and reference is not None and replay["path"] == reference["path"]:
+        for statistic in ("mean", "p50", "p95", "p99", "max"):
+            print("{:<20} {:<30} {:6.2f}x".format(
+                os.path.basename(replay["path"]),
+                statistic,
+                reference["kernel_time"][statistic] / replay["kernel_time"][statistic]
+            ))
+
+
+def parse_arguments(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.run_benchmarks",
+        description="Render every fractal from a fixed set of poses and quality presets and report the throughput"
+    )
+
+    parser.add_argument("--platform", type=int, default=0, help="OpenCL platform index")
+    parser.add_argument("--device", type=int, default=0, help="OpenCL device index")
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--height", type=int, default=240)
+    parser.add_argument("--repeats", type=int, default=5, help="measured frames per case")
+    parser.add_argument("--fractal", action="append", default=None, help="benchmark only this fractal, e.g. mandelbox, repeatable")
+    parser.add_argument("--preset", action="append", default=None, choices=[preset.name for preset in PRESETS],
+                        help="benchmark only this quality preset, repeatable")
+    parser.add_argument("--cache", action="store_true", help="use the kernel cache, compile times are then warm")
+    parser.add_argument("--tune-work-groups", action="store_true",
+                        help="launch the kernels with the fastest measured local size instead of the driver default")
+    parser.add_argument("--camera-path", default=None,
+                        help="also replay a camera path recorded in the explorer and report its frame times")
+    parser.add_argument("--compare", default=None, help="results of an earlier run to print the speedups against")
+    parser.add_argument("-o", "--output", default="benchmark.json")
+
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    args = parse_arguments(argv)
+
+    results = run(
+        platform_id=args.platform,
+        device_id=args.device,
+        width=args.width,
+        height=args.height,
+        repeats=args.repeats,
+        fractal_names=args.fractal,
+        preset_names=args.preset,
+        use_cache=args.cache,
+        tune_work_groups=args.tune_work_groups,
+        camera_path=args.camera_path
+    )
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
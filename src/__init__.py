@@ -1,3 +1,16 @@
-from .app import App
 from .camera import Camera
 from .render import Render
+
+
+def __getattr__(name):
+    # pygame is only needed by the interactive explorer, so App (and the headless facade,
+    # which doubles as the `python -m src.renderer` entry point) are imported on demand
+    if name == "App":
+        from .app import App
+        return App
+
+    if name == "Renderer":
+        from .renderer import Renderer
+        return Renderer
+
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
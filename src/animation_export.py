@@ -0,0 +1,351 @@
+import os
+import queue
+import subprocess
+import threading
+import time
+from fractions import Fraction
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from .camera_path import apply_camera_path_frame
+from .image_io import write_png
+from .keyframes import load_camera_spline
+from .renderer import Renderer, create_renderer, get_argument_parser
+
+
+# BT.601 in the limited range, which is what YUV4MPEG2 readers assume without further tags
+_YCBCR_MATRIX = np.array([
+    [65.481, 128.553, 24.966],
+    [-37.797, -74.203, 112.0],
+    [112.0, -93.786, -18.214]
+], dtype=np.float32) / 255
+
+_YCBCR_OFFSET = np.array([16, 128, 128], dtype=np.float32)
+
+
+class FrameSink:
+    # receives the frames of an export as (height, width, 4) uint8 RGBA arrays on the writer threads,
+    # ordered sinks write a single stream and get a single thread, so their frames arrive in order
+
+    ordered = True
+
+    def open(self, width: int, height: int, fps: float):
+        pass
+
+    def write(self, index: int, frame: np.ndarray):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class PngSequenceSink(FrameSink):
+    # every frame is a file of its own, so any number of threads can encode them at once
+
+    ordered = False
+
+    def __init__(self, pattern: str = os.path.join("frames", "frame_{:05d}.png")):
+        self.pattern = pattern
+
+    def open(self, width, height, fps):
+        directory = os.path.dirname(self.pattern.format(0))
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, index, frame):
+        write_png(self.pattern.format(index), frame[:, :, :3])
+
+
+class Y4mSink(FrameSink):
+    # uncompressed YUV4MPEG2 with full resolution chroma, which ffmpeg, mpv and x264 read directly
+
+    def __init__(self, path: str):
+        self.path = path
+
+        self._file = None
+
+    def open(self, width, height, fps):
+        rate = Fraction(fps).limit_denominator(1001)
+
+        self._file = open(self.path, "wb")
+        self._file.write("YUV4MPEG2 W{} H{} F{}:{} Ip A1:1 C444\n".format(
+            width, height, rate.numerator, rate.denominator
+        ).encode("ascii"))
+
+    def write(self, index, frame):
+        ycbcr = frame[:, :, :3].astype(np.float32) @ _YCBCR_MATRIX.T + _YCBCR_OFFSET
+        planes = np.clip(np.rint(ycbcr), 0, 255).astype(np.uint8).transpose((2, 0, 1))
+
+        self._file.write(b"FRAME\n")
+        self._file.write(np.ascontiguousarray(planes).tobytes())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def get_ffmpeg_command(path: str,
+                       arguments: Sequence[str] = ("-c:v", "libx264", "-pix_fmt", "yuv420p", "-crf", "18")) -> List[str]:
+    # {width}, {height} and {fps} are filled in by EncoderPipeSink once the size of the frames is known
+    return [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "{width}x{height}", "-r", "{fps}", "-i", "-"
+    ] + list(arguments) + [path]
+
+
+class EncoderPipeSink(FrameSink):
+    # raw RGB frames are piped into the standard input of an external encoder such as ffmpeg
+
+    def __init__(self, command: Sequence[str]):
+        self.command = list(command)
+
+        self._process = None
+
+    def open(self, width, height, fps):
+        command = [part.format(width=width, height=height, fps=fps) for part in self.command]
+
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, index, frame):
+        self._process.stdin.write(np.ascontiguousarray(frame[:, :, :3]).tobytes())
+
+    def close(self):
+        if self._process is None:
+            return
+
+        process, self._process = self._process, None
+
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        if process.wait() != 0:
+            raise RuntimeError("{} exited with status {}".format(self.command[0], process.returncode))
+
+
+class ExportStatistics:
+    def __init__(self):
+        self.rendered = 0
+        self.written = 0
+        self.dropped = 0
+
+        # seconds spent rendering, waiting for a free slot in the queue (back-pressure) and writing, the latter
+        # summed over the writer threads
+        self.render_time = 0.0
+        self.blocked_time = 0.0
+        self.write_time = 0.0
+        self.elapsed = 0.0
+
+        self.max_queued = 0
+
+    def summary(self) -> Dict[str, float]:
+        summary = dict(vars(self))
+        summary["fps"] = self.written / self.elapsed if self.elapsed > 0 else 0.0
+
+        return summary
+
+
+class AnimationExporter:
+    def __init__(self,
+                 renderer: Renderer,
+                 sink: FrameSink,
+                 fps: float = 30.0,
+                 queue_size: int = 8,
+                 writers: Optional[int] = None,
+                 drop_frames: bool = False):
+
+        # zlib and the NumPy conversions release the GIL, so writer threads overlap with each other and the renderer
+        if writers is None:
+            writers = 1 if sink.ordered else min(4, os.cpu_count() or 1)
+
+        if sink.ordered and writers != 1:
+            raise ValueError("{} writes a single stream, it can't have {} writers".format(type(sink).__name__, writers))
+
+        self.renderer = renderer
+        self.sink = sink
+        self.fps = fps
+
+        # at most queue_size frames wait for the writers, a full queue blocks the renderer or, with drop_frames,
+        # drops the frame instead (a live capture must not stall, an offline export must not lose frames)
+        self.queue_size = max(1, queue_size)
+        self.writers = max(1, writers)
+        self.drop_frames = drop_frames
+
+    def export(self,
+               frames: Optional[int] = None,
+               start_time: float = 0.0,
+               amplitude: float = 0.0,
+               camera_path: Optional[np.ndarray] = None) -> ExportStatistics:
+
+        # with camera path records (e.g. of a CameraSpline) every frame is rendered with its record instead,
+        # pose, animation time and all
+        if frames is None:
+            frames = len(camera_path) if camera_path is not None else 0
+
+        statistics = ExportStatistics()
+        statistics_lock = threading.Lock()
+
+        frame_queue = queue.Queue(self.queue_size)
+        errors = []
+
+        def write():
+            while True:
+                item = frame_queue.get()
+
+                if item is None:
+                    return
+
+                # after a failure the remaining frames are only drained, so that the renderer never waits forever
+                if errors:
+                    continue
+
+                index, frame = item
+                write_start = time.perf_counter()
+
+                try:
+                    self.sink.write(index, frame)
+                except Exception as error:
+                    errors.append(error)
+                    continue
+
+                with statistics_lock:
+                    statistics.written += 1
+                    statistics.write_time += time.perf_counter() - write_start
+
+        self.sink.open(self.renderer.width, self.renderer.height, self.fps)
+
+        threads = [
+            threading.Thread(target=write, name="animation-writer-{}".format(i), daemon=True)
+            for i in range(self.writers)
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        export_start = time.perf_counter()
+
+        try:
+            for index in range(frames):
+                if errors:
+                    break
+
+                # the time of a frame only depends on its index, so exports are reproducible whatever their speed
+                if camera_path is not None:
+                    apply_camera_path_frame(self.renderer.render, self.renderer.camera, camera_path[index])
+                else:
+                    self.renderer.set_animation(start_time + index / self.fps, amplitude)
+
+                render_start = time.perf_counter()
+                frame = self.renderer.render_array()
+                statistics.render_time += time.perf_counter() - render_start
+                statistics.rendered += 1
+
+                if self.drop_frames:
+                    try:
+                        frame_queue.put_nowait((index, frame))
+                    except queue.Full:
+                        statistics.dropped += 1
+                        continue
+                else:
+                    put_start = time.perf_counter()
+                    frame_queue.put((index, frame))
+                    statistics.blocked_time += time.perf_counter() - put_start
+
+                statistics.max_queued = max(statistics.max_queued, frame_queue.qsize())
+
+        finally:
+            for _ in threads:
+                frame_queue.put(None)
+
+            for thread in threads:
+                thread.join()
+
+            statistics.elapsed = time.perf_counter() - export_start
+
+            self.sink.close()
+
+        if errors:
+            raise errors[0]
+
+        return statistics
+
+
+def get_sink(output: str, encoder: Optional[str] = None) -> FrameSink:
+    if encoder is not None:
+        return EncoderPipeSink(get_ffmpeg_command(output) if encoder == "ffmpeg" else encoder.split() + [output])
+
+    if output.lower().endswith(".y4m"):
+        return Y4mSink(output)
+
+    if "{" not in output:
+        raise ValueError("{!r} is neither a .y4m file nor a frame pattern such as frame_{{:05d}}.png".format(output))
+
+    return PngSequenceSink(output)
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = get_argument_parser(
+        prog="python -m src.animation_export",
+        description="Render an animation of the fractal over time without opening a window"
+    )
+
+    parser.add_argument("--frames", type=int, default=120)
+    parser.add_argument("--fps", type=float, default=30.0)
+    parser.add_argument("--queue-size", type=int, default=8, help="frames rendered ahead of the writers at most")
+    parser.add_argument("--writers", type=int, default=None, help="writer threads of PNG sequences")
+    parser.add_argument("--drop-frames", action="store_true",
+                        help="drop the frames that don't fit into the queue instead of waiting for the writers")
+    parser.add_argument("--keyframes", default=None,
+                        help="JSON file of camera keyframes the camera flies through, sampled at --fps from --time")
+    parser.add_argument("--encoder", default=None,
+                        help="pipe raw RGB frames into 'ffmpeg' (or another command) that writes the output")
+
+    parser.set_defaults(output=os.path.join("frames", "frame_{:05d}.png"))
+
+    args = parser.parse_args(argv)
+
+    sink = get_sink(args.output, args.encoder)
+    renderer = create_renderer(args)
+
+    try:
+        renderer.set_camera(position=args.position, target=args.target, zoom=args.zoom)
+
+        exporter = AnimationExporter(
+            renderer,
+            sink,
+            fps=args.fps,
+            queue_size=args.queue_size,
+            writers=args.writers,
+            drop_frames=args.drop_frames
+        )
+
+        camera_path = None
+
+        if args.keyframes is not None:
+            renderer.set_animation(args.time, args.amplitude)
+            camera_path = load_camera_spline(args.keyframes).to_camera_path(
+                args.time + np.arange(args.frames) / args.fps,
+                renderer.render
+            )
+
+        statistics = exporter.export(
+            args.frames,
+            start_time=args.time,
+            amplitude=args.amplitude,
+            camera_path=camera_path
+        )
+
+    finally:
+        renderer.close()
+
+    print("{rendered} frames rendered, {written} written, {dropped} dropped in {elapsed:.2f}s ({fps:.1f} frames/s), "
+          "render {render_time:.2f}s, waiting for writers {blocked_time:.2f}s, writing {write_time:.2f}s".format(
+              **statistics.summary()))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,9 +5,16 @@ from datetime import datetime
 from pygame.locals import *
 import numpy as np
 import os
+from contextlib import nullcontext
 
 from .render import Render
+from .multi_render import MultiDeviceRender, get_sub_devices
 from .camera import Camera
+from .camera_path import CameraPathRecorder, apply_camera_path_frame, load_camera_path, summarize_frame_times
+from .profiler import FrameProfiler
+from .resolution import ResolutionController
+from .work_group_tuning import WorkGroupTuner, get_default_tuning_path
+from .statistics import COUNTERS
 
 
 class App:
@@ -15,9 +22,21 @@ class App:
                  platform_id=0,
                  device_id=0,
                  device_type=cl.device_type.ALL,
+                 device_ids=None,
+                 sub_devices=0,
                  width=500,
                  height=500,
-                 fullscreen=False):
+                 fullscreen=False,
+                 frames_in_flight=2,
+                 target_fps=None,
+                 progressive=False,
+                 temporal_reprojection=False,
+                 cone_tile_size=0,
+                 profile=False,
+                 profile_path=None,
+                 tune_work_groups=False,
+                 record_path=None,
+                 replay_path=None):
 
         self.width = width
         self.height = height
@@ -29,7 +48,21 @@ class App:
         self.platform = cl.get_platforms()[self.platform_id]
         self.device = self.platform.get_devices()[self.device_id]
         self.context = cl.Context([self.device])
-        self.queue = cl.CommandQueue(self.context)
+        self.queue = cl.CommandQueue(
+            self.context,
+            properties=cl.command_queue_properties.PROFILING_ENABLE
+        )
+
+        # with a target frame rate the fractal is rendered at a lower resolution and upscaled to the window
+        self.resolution_controller = ResolutionController(target_fps) if target_fps else None
+
+        # the profiler shows where the frame time goes in a HUD and optionally dumps it as JSON lines
+        self.profiler = FrameProfiler(path=profile_path) if profile or profile_path else None
+
+        # a recording logs the state every frame is rendered with, a replay renders the frames of one in order
+        # instead of following the input and prints the distribution of the frame times at its end
+        self.camera_path = load_camera_path(replay_path) if replay_path is not None else None
+        self.recorder = None
 
         pygame.init()
 
@@ -42,34 +75,199 @@ class App:
         else:
             self.screen = pygame.display.set_mode((self.width, self.height))
 
+        # frames are rendered row by row in the pixel format of the screen, so presenting them is a plain copy
+        self.pixel_masks = self.screen.get_masks() if self.screen.get_bitsize() == 32 else (0xff, 0xff00, 0xff0000, 0)
+
         pygame.display.set_caption('Fractal Explorer')
         pygame.mouse.set_visible(0)
 
+        self.font = None
+
+        # screenshots in progress and the outcome of the last one, both shown in the window caption
+        self.screenshots = []
+        self.screenshot_status = None
+
         self.camera = Camera(
             self.device, self.context, self.queue, mouse_speed=5.0
         )
-        self.render = Render(
-            self.device,
-            self.context,
-            self.queue,
-            self.camera,
-            width=self.width,
-            height=self.height
-        )
 
-        self.run()
+        # the measured local sizes are kept next to the kernel cache
+        work_group_tuner = WorkGroupTuner(get_default_tuning_path()) if tune_work_groups else None
+
+        # several devices (or sub-devices of one) split every frame into bands, each renders one of them
+        devices = [self.platform.get_devices()[i] for i in device_ids] if device_ids else [self.device]
+
+        if sub_devices:
+            devices = [sub_device for device in devices for sub_device in get_sub_devices(device, sub_devices)]
+
+        if len(devices) > 1:
+            self.render = MultiDeviceRender(
+                devices,
+                self.camera,
+                width=self.width,
+                height=self.height,
+                build_in_background=True,
+                work_group_tuner=work_group_tuner,
+                row_major=True,
+                pixel_masks=self.pixel_masks
+            )
+        else:
+            self.render = Render(
+                self.device,
+                self.context,
+                self.queue,
+                self.camera,
+                width=self.width,
+                height=self.height,
+                frames_in_flight=frames_in_flight,
+                build_in_background=True,
+                progressive=progressive,
+                temporal_reprojection=temporal_reprojection,
+                cone_tile_size=cone_tile_size,
+                profiler=self.profiler,
+                work_group_tuner=work_group_tuner,
+                row_major=True,
+                pixel_masks=self.pixel_masks
+            )
+
+        if record_path is not None:
+            self.recorder = CameraPathRecorder(record_path)
+
+        try:
+            self.run()
+        finally:
+            if self.recorder is not None:
+                self.recorder.close()
+
+            if self.profiler is not None:
+                self.profiler.close()
 
     def render_fractal(self):
         self.render.render()
 
+    def _measure(self, phase):
+        return self.profiler.measure(phase) if self.profiler is not None else nullcontext()
+
     def save_image(self, path):
-        self.render.save(path)
+        # the loop only takes a snapshot of the frame, the screenshot is rendered and encoded in the background
+        self.screenshots.append(
+            self.render.save_async(path, size=(self.width, self.height), callback=self._on_screenshot_saved)
+        )
 
-    def run(self):
-        surface = pygame.pixelcopy.make_surface(
-            self.render.host_buffer.reshape((self.width, self.height, 4))[:, :, :3]
+    def _on_screenshot_saved(self, path, error):
+        # runs on a screenshot worker, the loop picks the status up with the next caption
+        if error is None:
+            self.screenshot_status = "saved {}".format(os.path.basename(path))
+        else:
+            self.screenshot_status = "screenshot failed: {}".format(error)
+
+    def print_replay_summary(self, frame_times):
+        print("replayed {} frames, frame time {}".format(len(frame_times), ", ".join(
+            "{} {:.2f} ms".format(name, value * 1e3) for name, value in summarize_frame_times(frame_times).items()
+        )))
+
+    def get_caption(self):
+        if not self.render.is_ready:
+            return 'Fractal Explorer (compiling {}...)'.format(self.render.fractal.get_name())
+
+        self.screenshots = [screenshot for screenshot in self.screenshots if not screenshot.done()]
+
+        if self.screenshots:
+            return 'Fractal Explorer (saving {} screenshot{}...)'.format(
+                len(self.screenshots),
+                "s" if len(self.screenshots) > 1 else ""
+            )
+
+        if self.screenshot_status is not None:
+            return 'Fractal Explorer ({})'.format(self.screenshot_status)
+
+        return 'Fractal Explorer'
+
+    def present(self, surface, statistics=None, counter=None):
+        with self._measure("blit"):
+            if surface is None or surface.get_size() != (self.render.width, self.render.height):
+                surface = pygame.Surface((self.render.width, self.render.height), 0, 32, self.pixel_masks)
+
+            if statistics is not None:
+                pygame.surfarray.blit_array(surface, statistics.heatmap(counter).transpose((1, 0, 2)))
+            elif surface.get_pitch() == self.render.width * 4:
+                surface.get_buffer().write(self.render.host_buffer)
+            else:
+                pixels = self.render.host_buffer.view(np.uint32).reshape((self.render.height, self.render.width))
+                pygame.surfarray.blit_array(surface, pixels.T)
+
+            if surface.get_size() == (self.width, self.height):
+                self.screen.blit(surface, (0, 0))
+            else:
+                pygame.transform.scale(surface, (self.width, self.height), self.screen)
+
+        if statistics is not None:
+            self.draw_statistics(statistics, counter)
+
+        if self.profiler is not None:
+            self.draw_profile()
+
+        with self._measure("flip"):
+            pygame.display.flip()
+
+        return surface
+
+    def draw_statistics(self, statistics, counter, bins=32, size=(256, 96)):
+        if self.font is None:
+            self.font = pygame.font.Font(None, 20)
+
+        counts, edges = statistics.histogram(counter, bins)
+
+        left, top = 8, self.height - size[1] - 8
+        bar_width = size[0] // bins
+
+        summary = statistics.summary()[counter]
+
+        text = self.font.render(
+            "{}: mean {:.1f}, p95 {:.0f}, max {}".format(counter, summary["mean"], summary["p95"], summary["max"]),
+            True,
+            (255, 255, 255)
         )
 
+        pygame.draw.rect(
+            self.screen,
+            (0, 0, 0),
+            (left - 4, top - 24, max(size[0], text.get_width()) + 8, size[1] + 28)
+        )
+        self.screen.blit(text, (left, top - 20))
+
+        for i, count in enumerate(counts):
+            bar_height = int(size[1] * count / max(1, counts.max()))
+
+            pygame.draw.rect(
+                self.screen,
+                (250, 193, 39),
+                (left + i * bar_width, top + size[1] - bar_height, max(1, bar_width - 1), bar_height)
+            )
+
+    def draw_profile(self):
+        if self.font is None:
+            self.font = pygame.font.Font(None, 20)
+
+        lines = ["{:<8} {:>7} {:>7}".format("ms", "p50", "p95")]
+
+        for phase, summary in self.profiler.summary().items():
+            lines.append("{:<8} {:>7.2f} {:>7.2f}".format(phase, summary["p50"] * 1e3, summary["p95"] * 1e3))
+
+        texts = [self.font.render(line, True, (255, 255, 255)) for line in lines]
+
+        pygame.draw.rect(
+            self.screen,
+            (0, 0, 0),
+            (4, 4, max(text.get_width() for text in texts) + 8, len(texts) * 16 + 6)
+        )
+
+        for i, text in enumerate(texts):
+            self.screen.blit(text, (8, 8 + i * 16))
+
+    def run(self):
+        surface = None
+
         default_movement_speed = 0.5
         movement_speed = default_movement_speed
 
@@ -110,7 +308,19 @@ class App:
         screenshots_path = "screenshots/"
         n_screenshots = 0
 
+        caption = 'Fractal Explorer'
+
+        # index in COUNTERS of the counter shown as a heatmap instead of the fractal, None shows the fractal
+        statistics_counter = None
+
+        replay_frame = 0
+        replay_frame_times = []
+        replayed_frame_start = None
+
         while True:
+            if self.profiler is not None:
+                self.profiler.end_frame()
+
             time_before_render = time.time()
             fractal_changed = False
 
@@ -123,30 +333,73 @@ class App:
                 "amplitude": amplitude
             }
 
-            self.render.fractal.set_time(0.0 if not time_enabled else (time.time() - start_time))
-            self.render.fractal.set_amplitude(amplitude)
+            if self.camera_path is not None:
+                if replayed_frame_start is not None:
+                    replay_frame_times.append(time.perf_counter() - replayed_frame_start)
+                    replayed_frame_start = None
 
-            self.render.render()
-            pygame.surfarray.blit_array(
-                surface,
-                self.render.host_buffer.reshape((self.width, self.height, 4))[:, :, :3]
-            )
-            self.screen.blit(surface, (0, 0))
+                if replay_frame == len(self.camera_path):
+                    self.print_replay_summary(np.array(replay_frame_times))
+                    return
 
-            pygame.display.flip()
+                frame_start = time.perf_counter()
+
+                apply_camera_path_frame(self.render, self.camera, self.camera_path[replay_frame])
+            else:
+                self.render.fractal.set_time(0.0 if not time_enabled else (time.time() - start_time))
+                self.render.fractal.set_amplitude(amplitude)
+
+            if self.recorder is not None:
+                self.recorder.record(self.render, self.camera)
+
+            if self.resolution_controller is not None:
+                self.render.resize(*self.resolution_controller.get_size(self.width, self.height))
+
+            with self._measure("render"):
+                self.render.render()
+
+            # the replay moves on once a frame was really rendered, not while its program is compiling
+            if self.camera_path is not None and self.render.is_ready:
+                replay_frame += 1
+                replayed_frame_start = frame_start
+
+            if self.resolution_controller is not None and self.render.is_ready:
+                self.resolution_controller.update(self.render.last_kernel_time)
+
+            new_caption = self.get_caption()
+
+            if new_caption != caption:
+                caption = new_caption
+                pygame.display.set_caption(caption)
+
+            if statistics_counter is not None and self.render.is_ready:
+                surface = self.present(
+                    surface,
+                    self.render.render_statistics(),
+                    COUNTERS[statistics_counter]
+                )
+            else:
+                surface = self.present(surface)
+
+            events_start = time.perf_counter()
 
             for event in pygame.event.get():
                 if event.type == QUIT:
                     return
 
+                # a replay only listens to Esc
+                elif self.camera_path is not None and not (event.type == KEYDOWN and event.key == K_ESCAPE):
+                    continue
+
                 elif event.type == MOUSEMOTION:
                     mouse_position = pygame.mouse.get_pos()
                     pygame.mouse.set_pos((self.width / 2, self.height / 2))
 
-                    self.camera.rotate(
-                        (mouse_position[0] - self.width // 2) / 500,
-                        (mouse_position[1] - self.height // 2) / 500
-                    )
+                    with self._measure("rotate"):
+                        self.camera.rotate(
+                            (mouse_position[0] - self.width // 2) / 500,
+                            (mouse_position[1] - self.height // 2) / 500
+                        )
 
                 elif event.type == KEYDOWN:
 
@@ -168,13 +421,21 @@ class App:
                     elif event.key == K_l:
                         self.render.render_simple = not self.render.render_simple
 
+                    elif event.key == K_h:
+                        if statistics_counter is None:
+                            statistics_counter = 0
+                        elif statistics_counter + 1 < len(COUNTERS):
+                            statistics_counter += 1
+                        else:
+                            statistics_counter = None
+
                     elif event.key == K_p:
                         if not os.path.exists(screenshots_path):
                             os.makedirs(screenshots_path)
 
                         n_screenshots += 1
 
-                        self.render.save(screenshots_path + str(datetime.now()) + ".png")
+                        self.save_image(screenshots_path + str(datetime.now()) + ".png")
 
                     elif event.key == K_EQUALS:
                         self.render.ray_steps_limit += 10
@@ -241,6 +502,9 @@ class App:
                     elif event.button == 2:
                         self.camera.zoom = 1.0
 
+            if self.profiler is not None:
+                self.profiler.add("events", time.perf_counter() - events_start)
+
             delta = time.time() - time_before_render
 
             shift = np.array([0, 0, 0], dtype=np.float32)
@@ -262,10 +526,9 @@ class App:
 
             if shift_l > 0:
                 shift /= shift_l
+                shift *= delta * movement_speed
 
-            shift *= delta * movement_speed
-
-            self.camera.position += shift
+                self.camera.position += shift
             self.render.epsilon = epsilon / self.camera.zoom
             self.render.fractal = self.render.fractals[fractal_index]
 
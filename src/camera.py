@@ -7,12 +7,15 @@ import pyopencl.tools
 import os
 
 from .quaternion import Quaternion
+from .tracking import Tracked
 
 
 os.environ['SDL_VIDEO_CENTERED'] = '1'
 
 
-class Camera:
+class Camera(Tracked):
+
+    _tracked_attributes = frozenset(("position", "direction", "up", "right", "zoom", "shift_multiplier"))
 
     camera_dtype = np.dtype([
         ("pos", cl.cltypes.float3),
@@ -55,6 +58,10 @@ class Camera:
         self.shift_multiplier = shift_multiplier
         self.mouse_speed = mouse_speed
 
+        # a camera without a device only describes the view, e.g. for the NumPy backend
+        if self.device is None:
+            return
+
         self._camera_dtype, self._camera_decl = cl.tools.match_dtype_to_c_struct(
             self.device,
             "Camera",
@@ -66,14 +73,6 @@ class Camera:
             self._camera_dtype
         )
 
-        self._buffer = cl.Buffer(
-            self.context,
-            cl.mem_flags.READ_ONLY,
-            self._camera_dtype.itemsize
-        )
-
-        self.sync_with_device()
-
     def look_at(self, point):
         self.direction = point - self.position
         self.direction /= np.linalg.norm(self.direction)
@@ -100,26 +99,18 @@ class Camera:
 
         self.look_at(self.position + self.direction + forward)
 
-    def sync_with_device(self):
-        camera_instance = np.array([(
-            tuple(self.position) + (0,),
-            tuple(self.direction) + (0,),
-            tuple(self.up) + (0,),
-            tuple(self.right) + (0,),
-            self.zoom,
-            self.shift_multiplier
-        )], dtype=self._camera_dtype)[0]
-
-        cl.enqueue_copy(self.queue, self._buffer, camera_instance)
+    def write_uniforms(self, camera_instance):
+        camera_instance["pos"] = tuple(self.position) + (0,)
+        camera_instance["dir"] = tuple(self.direction) + (0,)
+        camera_instance["up"] = tuple(self.up) + (0,)
+        camera_instance["right"] = tuple(self.right) + (0,)
+        camera_instance["zoom"] = self.zoom
+        camera_instance["shift_multiplier"] = self.shift_multiplier
 
     @property
     def cl_type_declaration(self):
         return self._camera_decl
 
-    @property
-    def buffer(self):
-        return self._buffer
-
     def rotate(self, dx=0.0, dy=0.0):
         deg_to_rad = math.pi / 180.0
 
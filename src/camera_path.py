@@ -0,0 +1,147 @@
+import struct
+from time import perf_counter
+from typing import Dict
+
+import numpy as np
+
+
+# everything a frame of the explorer is rendered with, one record per frame
+CAMERA_PATH_DTYPE = np.dtype([
+    ("timestamp", np.float64),
+    ("position", np.float32, 3),
+    ("direction", np.float32, 3),
+    ("up", np.float32, 3),
+    ("right", np.float32, 3),
+    ("zoom", np.float32),
+    ("epsilon", np.float32),
+    ("ray_steps_limit", np.int32),
+    ("fractal_index", np.int16),
+    ("render_simple", np.bool_),
+    ("time", np.float32),
+    ("amplitude", np.float32)
+])
+
+# magic, format version and record size, followed by the raw records
+_HEADER = struct.Struct("<6sHI")
+_MAGIC = b"FXPATH"
+_VERSION = 1
+
+
+class CameraPathRecorder:
+    def __init__(self, path: str, chunk_size: int = 256):
+        self.path = path
+        self.frames = 0
+
+        # records are collected in a fixed array and appended to the file whenever it is full
+        self._records = np.zeros(chunk_size, dtype=CAMERA_PATH_DTYPE)
+        self._count = 0
+        self._start = perf_counter()
+
+        self._file = open(path, "wb")
+        self._file.write(_HEADER.pack(_MAGIC, _VERSION, CAMERA_PATH_DTYPE.itemsize))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def record(self, render, camera):
+        record = self._records[self._count]
+
+        record["timestamp"] = perf_counter() - self._start
+        record["position"] = camera.position
+        record["direction"] = camera.direction
+        record["up"] = camera.up
+        record["right"] = camera.right
+        record["zoom"] = camera.zoom
+        record["epsilon"] = render.epsilon
+        record["ray_steps_limit"] = render.ray_steps_limit
+        record["fractal_index"] = render.fractals.index(render.fractal)
+        record["render_simple"] = render.render_simple
+        record["time"] = render.fractal.get_time()
+        record["amplitude"] = render.fractal.get_amplitude()
+
+        self._count += 1
+        self.frames += 1
+
+        if self._count == len(self._records):
+            self.flush()
+
+    def flush(self):
+        self._records[:self._count].tofile(self._file)
+        self._file.flush()
+        self._count = 0
+
+    def close(self):
+        if self._file is None:
+            return
+
+        self.flush()
+        self._file.close()
+        self._file = None
+
+
+def load_camera_path(path: str) -> np.ndarray:
+    with open(path, "rb") as f:
+        magic, version, record_size = _HEADER.unpack(f.read(_HEADER.size))
+
+    if magic != _MAGIC or version != _VERSION or record_size != CAMERA_PATH_DTYPE.itemsize:
+        raise ValueError("{} is not a camera path of version {}".format(path, _VERSION))
+
+    return np.fromfile(path, dtype=CAMERA_PATH_DTYPE, offset=_HEADER.size)
+
+
+def apply_camera_path_frame(render, camera, record: np.void):
+    render.fractal = render.fractals[int(record["fractal_index"])]
+
+    camera.position = record["position"].copy()
+    camera.direction = record["direction"].copy()
+    camera.up = record["up"].copy()
+    camera.right = record["right"].copy()
+    camera.zoom = float(record["zoom"])
+
+    render.epsilon = float(record["epsilon"])
+    render.ray_steps_limit = int(record["ray_steps_limit"])
+    render.render_simple = bool(record["render_simple"])
+
+    render.fractal.set_time(float(record["time"]))
+    render.fractal.set_amplitude(float(record["amplitude"]))
+
+
+def replay_camera_path(render, camera, records: np.ndarray) -> Dict[str, np.ndarray]:
+    # renders the frames one after another without any input, the recorded timing only matters through the
+    # recorded animation time. Returns the wall time and kernel time (NaN without a profiling queue) of every frame
+    for index in np.unique(records["fractal_index"]):
+        render.fractals[index].build()
+
+    wall_times = np.zeros(len(records))
+    kernel_times = np.full(len(records), np.nan)
+
+    for i, record in enumerate(records):
+        apply_camera_path_frame(render, camera, record)
+
+        start = perf_counter()
+        render.render()
+        render.finish()
+        wall_times[i] = perf_counter() - start
+
+        if render.last_kernel_time is not None:
+            kernel_times[i] = render.last_kernel_time
+
+    return {"wall_times": wall_times, "kernel_times": kernel_times}
+
+
+def summarize_frame_times(times: np.ndarray) -> Dict[str, float]:
+    times = times[~np.isnan(times)]
+
+    if not len(times):
+        return {}
+
+    return {
+        "mean": float(times.mean()),
+        "p50": float(np.percentile(times, 50)),
+        "p95": float(np.percentile(times, 95)),
+        "p99": float(np.percentile(times, 99)),
+        "max": float(times.max())
+    }
@@ -1,4 +1,4 @@
-from .fractal import Fractal
+from .fractal import Fractal, BoundingVolume
 
 from .mandelbox import Mandelbox
 from .mandelbulb import Mandelbulb
@@ -1,4 +1,7 @@
+import os
+import threading
 from abc import abstractmethod
+from collections import namedtuple
 from typing import Optional, List, Dict, Tuple, Union
 from string import Template
 
@@ -7,17 +10,34 @@ import pyopencl as cl
 import pyopencl.tools
 import pyopencl.cltypes
 
+from ..program_cache import build_program
+from ..tracking import Tracked
 
-class Fractal:
+
+KERNELS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kernels")
+
+# an analytic volume around the fractal every ray is clipped to before it is marched, the shape is "box" with
+# (x, y, z) half sizes or "sphere" with a radius, both centred at the origin
+BoundingVolume = namedtuple("BoundingVolume", ["shape", "size"])
+
+
+class Fractal(Tracked):
+
+    _tracked_attributes = frozenset(("_parameters", "_material", "_color", "_time", "_amplitude"))
 
     _material_dtype = np.dtype([
         ("color_diffusive", cl.cltypes.uchar3),
         ("color_specular", cl.cltypes.uchar3),
-        ("diffusion", cl.cltypes.float),
+        ("diffusive", cl.cltypes.float),
         ("specular", cl.cltypes.float),
         ("reflected", cl.cltypes.float)
     ])
 
+    # values that are the same for every pixel of a frame, computed once per uniforms upload by frame_constants
+    _frame_constants_dtype = np.dtype([
+        ("camera_in_shadow", cl.cltypes.int)
+    ])
+
     def __init__(self,
                  device: cl.Device,
                  context: cl.Context,
@@ -33,21 +53,32 @@ class Fractal:
         self._time = 0.0
         self._amplitude = 0.0
 
-        self._material_buffer = None
-        self._parameters_buffer = None
+        self._uniforms_buffer = None
+        self._uniforms_upload_event = None
+        self._frame_constants_buffer = None
+
+        # the program is compiled on first use (or ahead of time from a background thread)
+        self._core_types_decl = core_types_decl
+        self._program = None
+        self._statistics_program = None
+        self._build_lock = threading.Lock()
 
         self._material = self.get_default_material()
 
-        self._build_kernel(core_types_decl)
         self.set_parameters(parameters, color)
 
     # PRIVATE METHODS
 
     def _build_kernel(self, core_types_decl: List[str]):
+        # the derived parameters follow the regular ones in the same struct
         parameters_dtype, parameters_decl = cl.tools.match_dtype_to_c_struct(
             self.device,
             self.get_parameters_typename(),
-            self.get_numpy_dtype_parameters()
+            np.dtype([
+                (name, dtype.fields[name][0])
+                for dtype in (self.get_numpy_dtype_parameters(), self.get_numpy_dtype_derived_parameters())
+                for name in dtype.names
+            ])
         )
 
         self._parameters_dtype = cl.tools.get_or_register_dtype(
@@ -57,6 +88,46 @@ class Fractal:
 
         self._parameters_declaration = parameters_decl
 
+        material_dtype, material_decl = cl.tools.match_dtype_to_c_struct(
+            self.device,
+            "Material",
+            self._material_dtype
+        )
+
+        material_dtype = cl.tools.get_or_register_dtype("Material", material_dtype)
+
+        frame_constants_dtype, frame_constants_decl = cl.tools.match_dtype_to_c_struct(
+            self.device,
+            "FrameConstants",
+            self._frame_constants_dtype
+        )
+
+        cl.tools.get_or_register_dtype("FrameConstants", frame_constants_dtype)
+
+        # camera, quality properties, fractal parameters and material are uploaded as one block
+        self._uniforms_dtype, uniforms_decl = cl.tools.match_dtype_to_c_struct(
+            self.device,
+            "Uniforms",
+            np.dtype([
+                ("camera", cl.tools.get_or_register_dtype("Camera")),
+                ("quality_props", cl.tools.get_or_register_dtype("QualityProps")),
+                ("parameters", self._parameters_dtype),
+                ("material", material_dtype)
+            ])
+        )
+
+        self._uniforms = np.zeros(1, dtype=self._uniforms_dtype)
+        self._uniforms_buffer = cl.Buffer(
+            self.context,
+            cl.mem_flags.READ_ONLY,
+            self._uniforms_dtype.itemsize
+        )
+        self._frame_constants_buffer = cl.Buffer(
+            self.context,
+            cl.mem_flags.READ_WRITE,
+            frame_constants_dtype.itemsize
+        )
+
         self._kernel = None
         self._kernel = self.get_kernel_code()
 
@@ -64,18 +135,63 @@ class Fractal:
 
         self._kernel = template.safe_substitute(
             dict(
-                type_declarations=''.join(core_types_decl + [parameters_decl]),
+                type_declarations=''.join(
+                    core_types_decl + [parameters_decl, material_decl, uniforms_decl, frame_constants_decl]
+                ),
                 distance_function_declaration=self.get_distance_function_code(),
                 outside_of_circumscribed_figure_declaration=self.get_check_circumscribed_figure_code(),
                 fractal_parameters_typename=self.get_parameters_typename(),
-                orbit_trap_declaration=self.get_orbit_trap_code()
+                orbit_trap_declaration=self.get_orbit_trap_code(),
+                bounding_volume_declaration=self._get_bounding_volume_declaration()
             )
         )
 
-        self._program = cl.Program(self.context, self._kernel).build()
+        program = build_program(self.context, self.device, self._kernel)
+        self._render_kernel = program.render
+        self._reproject_kernel = program.reproject_depth
+        self._cone_prepass_kernel = program.cone_prepass
+        self._frame_constants_kernel = program.frame_constants
+        self._program = program
+
+    def _get_bounding_volume_declaration(self) -> str:
+        volume = self.get_bounding_volume()
+
+        if volume is None:
+            return ""
+
+        if volume.shape == "box":
+            return "#define BOUNDING_BOX (float3)({}f, {}f, {}f)\n".format(*map(float, volume.size))
+
+        if volume.shape == "sphere":
+            return "#define BOUNDING_SPHERE {}f\n".format(float(volume.size))
+
+        raise ValueError("Unknown bounding volume shape: {}".format(volume.shape))
 
     # PUBLIC METHODS
 
+    def build(self):
+        with self._build_lock:
+            if self._program is None:
+                self._build_kernel(self._core_types_decl)
+
+    def build_statistics(self):
+        # the variant of the program that counts the work done for every pixel, see COLLECT_STATISTICS
+        self.build()
+
+        with self._build_lock:
+            if self._statistics_program is None:
+                self._statistics_program = build_program(
+                    self.context,
+                    self.device,
+                    self._kernel,
+                    ["-DCOLLECT_STATISTICS"]
+                )
+                self._statistics_render_kernel = self._statistics_program.render
+
+    @property
+    def is_built(self):
+        return self._program is not None
+
     def get_diffusive_color(self):
         return self._material["color_diffusive"]
 
@@ -102,34 +218,32 @@ class Fractal:
 
         self.set_color(color if color is not None else self.get_default_color())
 
-        self.sync_with_device()
+    def get_uniforms(self) -> np.void:
+        # the host copy is reused, so a pending upload of it has to complete before it is modified
+        if self._uniforms_upload_event is not None:
+            self._uniforms_upload_event.wait()
+            self._uniforms_upload_event = None
 
-    def sync_with_device(self):
-        parameters_instance = np.array([self.get_parameters_values()], dtype=self._parameters_dtype)[0]
+        return self._uniforms[0]
 
-        self._parameters_buffer = self._parameters_buffer or cl.Buffer(
-            self.context,
-            cl.mem_flags.READ_ONLY,
-            self._parameters_dtype.itemsize
-        )
+    def write_uniforms(self, uniforms: np.void):
+        values = self.get_parameters_values()
 
-        cl.enqueue_copy(self.queue, self._parameters_buffer, parameters_instance)
+        # quality properties are written before, some derived parameters depend on the iteration limit
+        uniforms["parameters"] = values + self.get_derived_parameters_values(values, uniforms["quality_props"])
 
-        material_instance = np.array([(
-            self.get_diffusive_color() + (0, ),
-            self.get_specular_color() + (0, ),
-            self._material["diffusive"],
-            self._material["specular"],
-            self._material["reflected"]
-        )], dtype=self._material_dtype)[0]
+        material_instance = uniforms["material"]
+        material_instance["color_diffusive"] = self.get_diffusive_color() + (0, )
+        material_instance["color_specular"] = self.get_specular_color() + (0, )
+        material_instance["diffusive"] = self._material["diffusive"]
+        material_instance["specular"] = self._material["specular"]
+        material_instance["reflected"] = self._material["reflected"]
 
-        self._material_buffer = self._material_buffer or cl.Buffer(
-            self.context,
-            cl.mem_flags.READ_ONLY,
-            self._material_dtype.itemsize
-        )
+    def upload_uniforms(self, queue: cl.CommandQueue):
+        self._uniforms_upload_event = cl.enqueue_copy(queue, self._uniforms_buffer, self._uniforms, is_blocking=False)
 
-        cl.enqueue_copy(self.queue, self._material_buffer, material_instance)
+        # a single work item, launched behind the upload on the same queue, so every later launch sees the result
+        self._frame_constants_kernel(queue, (1, ), None, self._uniforms_buffer, self._frame_constants_buffer)
 
     @abstractmethod
     def get_default_color(self) -> Tuple[int, int, int]:
@@ -145,7 +259,7 @@ class Fractal:
 
     def get_kernel_code(self):
         if self._kernel is None:
-            with open("src/fractals/kernels/raymarch.cl", 'r') as f:
+            with open(os.path.join(KERNELS_PATH, "raymarch.cl"), 'r') as f:
                 self._kernel = f.read()
 
         return self._kernel
@@ -162,6 +276,39 @@ class Fractal:
     def get_check_circumscribed_figure_code(self) -> str:
         raise NotImplementedError
 
+    @staticmethod
+    def get_bounding_volume() -> Optional[BoundingVolume]:
+        # rays are only marched inside this volume, so it must contain the whole fractal, None marches them unbounded
+        return None
+
+    # the NumPy counterparts of the OpenCL functions above take (N, 3) float32 points, the values of
+    # get_parameters_values() and the iteration limit, they are static so that worker processes can call them
+
+    @staticmethod
+    @abstractmethod
+    def distance_numpy(points: np.ndarray, parameters: tuple, iteration_limit: int) -> np.ndarray:
+        raise NotImplementedError
+
+    @staticmethod
+    @abstractmethod
+    def orbit_trap_numpy(points: np.ndarray, parameters: tuple, iteration_limit: int) -> np.ndarray:
+        raise NotImplementedError
+
+    @staticmethod
+    @abstractmethod
+    def outside_of_circumscribed_figure_numpy(points: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    # derived parameters are appended to the parameters struct and computed on the host whenever the uniforms are
+    # written, from the values of get_parameters_values() and the quality properties, so that the kernel does not
+    # recompute them in every distance evaluation
+
+    def get_numpy_dtype_derived_parameters(self) -> np.dtype:
+        return np.dtype([])
+
+    def get_derived_parameters_values(self, values: tuple, quality_props: np.void) -> tuple:
+        return ()
+
     def get_parameters_declaration(self) -> str:
         return self._parameters_declaration
 
@@ -181,11 +328,14 @@ class Fractal:
     def get_default_parameters(self) -> Dict[str, Union[int, Union[float, int]]]:
         raise NotImplementedError
 
-    def get_parameters_buffer(self):
-        return self._parameters_buffer
+    def get_uniforms_buffer(self):
+        return self._uniforms_buffer
+
+    def get_frame_constants_buffer(self):
+        return self._frame_constants_buffer
 
-    def get_material_buffer(self):
-        return self._material_buffer
+    def get_uniforms_dtype(self) -> np.dtype:
+        return self._uniforms_dtype
 
     @abstractmethod
     def get_parameters_values(self) -> tuple:
@@ -195,9 +345,29 @@ class Fractal:
     def get_numpy_dtype_parameters(self) -> np.dtype:
         raise NotImplementedError
 
+    @property
+    def source(self):
+        return self._kernel
+
     @property
     def render_function(self):
-        return self._program.render
+        return self._render_kernel
+
+    def create_render_function(self) -> cl.Kernel:
+        # a render kernel object of its own for threads other than the render loop, kernel arguments are shared state
+        return cl.Kernel(self._program, "render")
+
+    @property
+    def reproject_function(self):
+        return self._reproject_kernel
+
+    @property
+    def cone_prepass_function(self):
+        return self._cone_prepass_kernel
+
+    @property
+    def statistics_render_function(self):
+        return self._statistics_render_kernel
 
     @abstractmethod
     def get_initial_camera_position(self):
@@ -214,9 +384,15 @@ class Fractal:
     def set_time(self, time: float):
         self._time = time
 
+    def get_time(self) -> float:
+        return self._time
+
     def set_amplitude(self, amplitude: float):
         self._amplitude = amplitude
 
+    def get_amplitude(self) -> float:
+        return self._amplitude
+
     def get_glow_color(self) -> Tuple[int, int, int]:
         return 255, 255, 255
 
@@ -1,20 +1,18 @@
+#define REPROJECTION_SAFETY_FACTOR 0.9f
+#define REPROJECTION_DISCONTINUITY 1.1f
+#define REPROJECTION_RADIUS 2
+#define CONE_SAFETY_FACTOR 0.9f
+
 typedef struct Ray {
     float3 pos, dir;
 } Ray;
 
-typedef struct Material {
-    uchar3 color_diffusive;
-    uchar3 color_specular;
-    float diffusive;
-    float specular;
-    float reflected;
-} Material;
-
 typedef struct Hit {
     float distance;
     float3 position;
     float3 normal;
     int depth;
+    int steps;
     bool outside;
     float min_distance_to_fractal;
     float3 position_of_min_distance;
@@ -30,10 +28,45 @@ $outside_of_circumscribed_figure_declaration
 
 $orbit_trap_declaration
 
+$bounding_volume_declaration
+
+/**********************************************************************************************************************/
+
+// the program built with -D COLLECT_STATISTICS counts the work done for every pixel, STATISTICS_PARAMETER and
+// STATISTICS_ARGUMENT pass the counters of the pixel along and vanish from the regular program
+#define STATISTICS_COUNTERS 6
+
+#ifdef COLLECT_STATISTICS
+
+typedef struct Statistics {
+    uint primary_steps;
+    uint shadow_steps;
+    uint reflection_steps;
+    uint reflection_bounces;
+    uint normal_evaluations;
+    uint distance_evaluations;
+} Statistics;
+
+#define STATISTICS_PARAMETER , Statistics * statistics
+#define STATISTICS_ARGUMENT , statistics
+#define COUNT(counter, amount) (statistics->counter += (amount))
+
+#else
+
+#define STATISTICS_PARAMETER
+#define STATISTICS_ARGUMENT
+#define COUNT(counter, amount)
+
+#endif
+
 
 float3 normal_to_fractal(float3 point,
                          __global QualityProps * quality_props,
-                         __global $fractal_parameters_typename * parameters) {
+                         __global $fractal_parameters_typename * parameters
+                         STATISTICS_PARAMETER) {
+
+    COUNT(normal_evaluations, 1);
+    COUNT(distance_evaluations, 6);
 
     float3 a = {quality_props->epsilon * 0.05f, 0.0f, 0.0f};
     float3 b = {0.0f, quality_props->epsilon * 0.05f, 0.0f};
@@ -69,24 +102,68 @@ uchar4 amplify_color(uchar4 color, float mul) {
 }
 
 
-Hit march_ray(float3 position,
-               float3 direction,
-               __global QualityProps * quality_props,
-               __global $fractal_parameters_typename * parameters) {
+// the parameters of the ray at which it enters and leaves the bounding volume, the first is larger for rays that
+// miss it, fractals without a volume march every ray from its start to the escape distance
+float2 bounding_volume_interval(float3 position, float3 direction) {
+#if defined(BOUNDING_BOX)
+    float3 inverse = 1.0f / direction;
+    float3 near = (-BOUNDING_BOX - position) * inverse;
+    float3 far = (BOUNDING_BOX - position) * inverse;
+
+    float3 entry = fmin(near, far);
+    float3 exit = fmax(near, far);
+
+    return (float2)(fmax(fmax(entry.x, entry.y), entry.z), fmin(fmin(exit.x, exit.y), exit.z));
+#elif defined(BOUNDING_SPHERE)
+    float a = dot(direction, direction);
+    float b = dot(position, direction);
+    float discriminant = b * b - a * (dot(position, position) - BOUNDING_SPHERE * BOUNDING_SPHERE);
+
+    if (discriminant < 0.0f)
+        return (float2)(INFINITY, -INFINITY);
+
+    float root = sqrt(discriminant);
+
+    return (float2)((-b - root) / a, (-b + root) / a);
+#else
+    return (float2)(0.0f, INFINITY);
+#endif
+}
+
+
+Hit march_ray_from(float3 position,
+                   float3 direction,
+                   float start_distance,
+                   __global QualityProps * quality_props,
+                   __global $fractal_parameters_typename * parameters
+                   STATISTICS_PARAMETER) {
 
     float epsilon = quality_props->epsilon;
     float glow_sharpness = quality_props->glow_sharpness;
 
+    // rays that miss the bounding volume are sky right away, the others stop where they leave it. They still start
+    // at start_distance rather than where they enter it: that would save a few steps, but it shifts every step along
+    // the ray, and with it the hit and its shading
+    float2 interval = bounding_volume_interval(position, direction);
+    bool missed = interval.x > interval.y || interval.y < 0.0f;
+
+    position += direction * start_distance;
+
     Hit hit = {
-        .distance = 0.0f,
+        .distance = start_distance,
+        .position = position,
         .depth = quality_props->ray_steps_limit,
+        .steps = 0,
         .min_distance_to_fractal = 1.0f,
         .position_of_min_distance = position
     };
 
-    for (int i = 0; i < quality_props->ray_steps_limit; i++) {
+    for (int i = 0; i < quality_props->ray_steps_limit && !missed; i++) {
         float d = fractal_distance(position, quality_props, parameters);
 
+        COUNT(distance_evaluations, 1);
+
+        hit.steps++;
         hit.distance += d * quality_props->ray_shift_multiplier;
 
         if (hit.min_distance_to_fractal > d)
@@ -106,14 +183,25 @@ Hit march_ray(float3 position,
         }
 
         if (d < epsilon && !isnan(d)) {
-            hit.normal = normal_to_fractal(hit.position, quality_props, parameters);
+            hit.normal = normal_to_fractal(hit.position, quality_props, parameters STATISTICS_ARGUMENT);
             hit.position = position + (epsilon - d) * hit.normal;
             position = hit.position;
             break;
         }
+
+        if (hit.distance > interval.y) {
+            missed = true;
+            break;
+        }
+    }
+
+    if (missed) {
+        hit.depth = quality_props->ray_steps_limit;
+        hit.distance = 1e20f;
     }
 
-    hit.outside = outside_of_circumscribed_figure(hit.position) ||
+    hit.outside = missed ||
+                  outside_of_circumscribed_figure(hit.position) ||
                   fast_length(hit.position) > 15.0f ||
                   hit.distance > 100.0f;
 
@@ -121,13 +209,24 @@ Hit march_ray(float3 position,
 }
 
 
+Hit march_ray(float3 position,
+               float3 direction,
+               __global QualityProps * quality_props,
+               __global $fractal_parameters_typename * parameters
+               STATISTICS_PARAMETER) {
+
+    return march_ray_from(position, direction, 0.0f, quality_props, parameters STATISTICS_ARGUMENT);
+}
+
+
 uchar4 blinn_phong(float3 position,
                    float3 normal,
                    float3 direction,
                    float shadow_coefficient,
                    __global QualityProps * quality_props,
                    __global $fractal_parameters_typename * parameters,
-                   __global Material * material) {
+                   __global Material * material
+                   STATISTICS_PARAMETER) {
 
     uchar3 color_diffusive = material->color_diffusive;
     uchar3 color_specular = material->color_specular;
@@ -154,7 +253,11 @@ uchar4 blinn_phong(float3 position,
         diffusive = max(0.0f, projection_length);
         specular = max(0.0f, pow(dot(reflect(-quality_props->sun_direction, normal), direction), 3.0f));
 
-        if (!march_ray(position, quality_props->sun_direction, quality_props, parameters).outside) {
+        Hit shadow_hit = march_ray(position, quality_props->sun_direction, quality_props, parameters STATISTICS_ARGUMENT);
+
+        COUNT(shadow_steps, shadow_hit.steps);
+
+        if (!shadow_hit.outside) {
             diffusive *= shadow_coefficient;
             specular *= shadow_coefficient;
         }
@@ -188,21 +291,55 @@ uchar4 blinn_phong(float3 position,
 
 
 uchar4 render_pixel(Ray ray,
+           float start_distance,
+           float safe_distance,
+           float * primary_distance,
+           bool camera_in_shadow,
            __global QualityProps * quality_props,
            __global $fractal_parameters_typename * parameters,
-           __global Material * material) {
+           __global Material * material
+           STATISTICS_PARAMETER) {
 
     uchar4 color = {0, 0, 0, 0};
 
     float epsilon = quality_props->epsilon;
 
     bool reflected = false;
-    bool camera_in_shadow = !march_ray(ray.pos, quality_props->sun_direction, quality_props, parameters).outside;
 
     uchar4 fog_color = {255, 255, 255, 255};
 
     for (int i = 0; i < quality_props->reflection_depth + 1; i++) {
-        Hit hit = march_ray(ray.pos, ray.dir, quality_props, parameters);
+        Hit hit = march_ray_from(
+            ray.pos,
+            ray.dir,
+            i == 0 ? start_distance : 0.0f,
+            quality_props,
+            parameters
+            STATISTICS_ARGUMENT
+        );
+
+        // a start distance past a surface no sample of the previous frame saw can make a ray miss everything, a
+        // primary ray that started beyond its safe distance and ends in the sky is marched again from there
+        if (i == 0 && hit.outside && start_distance > safe_distance) {
+            COUNT(primary_steps, hit.steps);
+
+            hit = march_ray_from(
+                ray.pos,
+                ray.dir,
+                safe_distance,
+                quality_props,
+                parameters
+                STATISTICS_ARGUMENT
+            );
+        }
+
+        if (i == 0) {
+            *primary_distance = hit.outside ? 1e20f : hit.distance;
+            COUNT(primary_steps, hit.steps);
+        } else {
+            COUNT(reflection_steps, hit.steps);
+            COUNT(reflection_bounces, 1);
+        }
 
         uchar4 current_color;
 
@@ -267,6 +404,7 @@ uchar4 render_pixel(Ray ray,
                     quality_props,
                     parameters,
                     material
+                    STATISTICS_ARGUMENT
                 );
 
                 float fog_mul = 1.0f - (hit.distance / 40.0f);
@@ -306,38 +444,286 @@ uchar4 render_pixel(Ray ray,
 }
 
 
-__kernel void render(__global Camera * camera,
-                     __global QualityProps * quality_props,
-                     __global $fractal_parameters_typename * parameters,
-                     __global Material * material,
-                     __global uchar * output) {
+Ray camera_ray(__global Camera * camera, float idX, float idY, int width, int height) {
+    float ratio = (float) width / (float) height;
+
+    float hx = (float)width / 2.0f;
+    float hy = (float)height / 2.0f;
+
+    float x = (idX - hx) / hx * ratio;
+    float y = -(idY - hy) / hy;
+
+    Ray ray = {.pos = camera->pos };
+    ray.dir = camera->pos + camera->right * x + camera->up * y + camera->dir * camera->zoom;
+    ray.dir = normalize(ray.dir - camera->pos);
+
+    return ray;
+}
+
+
+__kernel void reproject_depth(__global Camera * previous_camera,
+                              __global Uniforms * uniforms,
+                              __global const float * previous_depth,
+                              __global int * start_distances,
+                              int width,
+                              int height) {
 
     int idX = get_global_id(0);
     int idY = get_global_id(1);
 
-    int width = get_global_size(0);
-    int height = get_global_size(1);
+    float depth = previous_depth[idY * width + idX];
 
-    float ratio = (float) width / (float) height;
+    if (depth >= 1e19f)
+        return;
 
-    int pixel_id = idY * width + idX;
+    // surface point seen by this pixel in the previous frame, projected onto the screen of the current camera
+    __global Camera * camera = &uniforms->camera;
 
+    Ray previous_ray = camera_ray(previous_camera, idX, idY, width, height);
+    float3 v = previous_ray.pos + previous_ray.dir * depth - camera->pos;
+
+    float forward = dot(v, camera->dir);
+
+    if (forward <= 0.0f)
+        return;
+
+    float ratio = (float) width / (float) height;
     float hx = (float)width / 2.0f;
     float hy = (float)height / 2.0f;
 
-    float x = ((float)idX - hx) / hx * ratio;
-    float y = -((float)idY - hy) / hy;
+    float x = dot(v, camera->right) / forward * camera->zoom;
+    float y = dot(v, camera->up) / forward * camera->zoom;
 
-    Ray ray = {.pos = camera->pos };
-    ray.dir = camera->pos + camera->right * x + camera->up * y + camera->dir * camera->zoom;
-    ray.dir = normalize(ray.dir - camera->pos);
+    int pX = (int) floor(x / ratio * hx + hx);
+    int pY = (int) floor(-y * hy + hy);
+
+    // positive floats compare like their bit patterns, so atomic_min on ints keeps the nearest surface. Only the
+    // pixel the point lands in gets it, reprojected_start_distance turns these into start distances
+    if (pX >= 0 && pX < width && pY >= 0 && pY < height)
+        atomic_min(&start_distances[pY * width + pX], as_int(fast_length(v)));
+}
+
+
+// a surface point projected onto a pixel is somewhere in its footprint, not on its ray, and the ray may hit a nearer
+// surface the previous frame didn't see. So a pixel starts at the nearest point projected onto it and the pixels
+// around it, less the width of their footprint there, and only where all of them got a point at about the same
+// distance: around holes, silhouettes and depth discontinuities there is no start distance
+float reprojected_start_distance(__global const int * start_distances,
+                                 int idX,
+                                 int idY,
+                                 int width,
+                                 int height,
+                                 float zoom) {
 
-    uchar4 color = render_pixel(ray, quality_props, parameters, material);
+    if (idX < REPROJECTION_RADIUS || idX >= width - REPROJECTION_RADIUS ||
+        idY < REPROJECTION_RADIUS || idY >= height - REPROJECTION_RADIUS)
+        return 0.0f;
 
-    __global uchar * pixel = & output[idX * height * 4 + idY * 4];
+    float nearest = INFINITY;
+    float farthest = 0.0f;
+
+    for (int dx = -REPROJECTION_RADIUS; dx <= REPROJECTION_RADIUS; dx++) {
+        for (int dy = -REPROJECTION_RADIUS; dy <= REPROJECTION_RADIUS; dy++) {
+            int seed = start_distances[(idY + dy) * width + idX + dx];
+
+            if (seed == INT_MAX)
+                return 0.0f;
+
+            nearest = min(nearest, as_float(seed));
+            farthest = max(farthest, as_float(seed));
+        }
+    }
+
+    if (farthest > nearest * REPROJECTION_DISCONTINUITY)
+        return 0.0f;
+
+    // a pixel is 2 / height screen units wide and the screen lies zoom units in front of the camera, the
+    // neighbourhood reaches REPROJECTION_RADIUS pixels from the center ray
+    float footprint = nearest * REPROJECTION_RADIUS * M_SQRT2_F * 2.0f / (float) height / zoom;
+
+    return max(0.0f, nearest * REPROJECTION_SAFETY_FACTOR - footprint);
+}
+
+
+// every primary ray starts at the camera, so whether it is in the shadow is computed once per uniforms upload
+__kernel void frame_constants(__global Uniforms * uniforms, __global FrameConstants * constants) {
+
+#ifdef COLLECT_STATISTICS
+    Statistics unused = {0};
+    Statistics * statistics = &unused;
+#endif
+
+    __global QualityProps * quality_props = &uniforms->quality_props;
+
+    Hit camera_shadow_hit = march_ray(
+        uniforms->camera.pos,
+        quality_props->sun_direction,
+        quality_props,
+        &uniforms->parameters
+        STATISTICS_ARGUMENT
+    );
 
-    pixel[0] = color.x;
-    pixel[1] = color.y;
-    pixel[2] = color.z;
-    pixel[3] = color.w;
+    constants->camera_in_shadow = !camera_shadow_hit.outside;
+}
+
+
+__kernel void cone_prepass(__global Uniforms * uniforms,
+                           __global float * tile_start_distances,
+                           int width,
+                           int height,
+                           int cone_tile_size) {
+
+    __global Camera * camera = &uniforms->camera;
+    __global QualityProps * quality_props = &uniforms->quality_props;
+    __global $fractal_parameters_typename * parameters = &uniforms->parameters;
+
+    int tile_x = get_global_id(0);
+    int tile_y = get_global_id(1);
+
+    // one cone through the center of the tile, wide enough to contain the rays of all of its pixels:
+    // a pixel is 2 / height screen units wide and the screen lies camera->zoom units in front of the camera
+    Ray ray = camera_ray(
+        camera,
+        ((float) tile_x + 0.5f) * (float) cone_tile_size,
+        ((float) tile_y + 0.5f) * (float) cone_tile_size,
+        width,
+        height
+    );
+
+    float cone_slope = M_SQRT2_F * (float) cone_tile_size / (float) height / camera->zoom;
+
+    float distance = 0.0f;
+
+    for (int i = 0; i < quality_props->ray_steps_limit; i++) {
+        float d = fractal_distance(ray.pos + ray.dir * distance, quality_props, parameters);
+
+        // every pixel ray is within the cone radius of the center one, so it is free of the fractal for
+        // at least d - radius from its own point at this distance
+        float step = d - distance * cone_slope;
+
+        if (isnan(d) || step < quality_props->epsilon || distance > 100.0f)
+            break;
+
+        distance += step;
+    }
+
+    tile_start_distances[tile_y * get_global_size(0) + tile_x] = distance * CONE_SAFETY_FACTOR;
+}
+
+
+__kernel void render(__global Uniforms * uniforms,
+                     __global uint * output,
+                     __global const FrameConstants * frame_constants,
+                     int offset_x,
+                     int offset_y,
+                     int width,
+                     int height,
+                     int tile_width,
+                     int tile_height,
+                     int pixel_stride,
+                     int skip_stride,
+                     __global float * depth_output,
+                     __global const int * start_distances,
+                     __global const float * tile_start_distances,
+                     int cone_tile_size,
+                     int row_major,
+                     uint4 channel_shifts
+#ifdef COLLECT_STATISTICS
+                     // STATISTICS_COUNTERS planes of (height, width) counters
+                     , __global uint * statistics_output
+#endif
+                     ) {
+
+    __global Camera * camera = &uniforms->camera;
+    __global QualityProps * quality_props = &uniforms->quality_props;
+    __global $fractal_parameters_typename * parameters = &uniforms->parameters;
+    __global Material * material = &uniforms->material;
+
+    // the launch covers a (tile_width, tile_height) tile of the (width, height) image starting at
+    // (offset_x, offset_y), every work item renders one pixel and fills a pixel_stride wide block with it
+    int tile_x = get_global_id(0) * pixel_stride;
+    int tile_y = get_global_id(1) * pixel_stride;
+
+    if (tile_x >= tile_width || tile_y >= tile_height)
+        return;
+
+    // pixels of the coarser grid of the previous refinement pass already hold their final color
+    if (skip_stride > 0 && tile_x % skip_stride == 0 && tile_y % skip_stride == 0)
+        return;
+
+    int idX = offset_x + tile_x;
+    int idY = offset_y + tile_y;
+
+    Ray ray = camera_ray(camera, idX, idY, width, height);
+
+    // the cone start distance is safe, the one reprojected from the previous frame is an estimate, the further
+    // one is used and the cone's is where rays fall back to
+    float safe_distance = 0.0f;
+
+    if (tile_start_distances) {
+        int tiles_x = (width + cone_tile_size - 1) / cone_tile_size;
+
+        safe_distance = tile_start_distances[(idY / cone_tile_size) * tiles_x + idX / cone_tile_size];
+    }
+
+    float start_distance = safe_distance;
+
+    if (start_distances) {
+        start_distance = max(
+            start_distance,
+            reprojected_start_distance(start_distances, idX, idY, width, height, camera->zoom)
+        );
+    }
+
+    float primary_distance;
+
+#ifdef COLLECT_STATISTICS
+    Statistics pixel_statistics = {0, 0, 0, 0, 0, 0};
+    Statistics * statistics = &pixel_statistics;
+#endif
+
+    uchar4 color = render_pixel(
+        ray,
+        start_distance,
+        safe_distance,
+        &primary_distance,
+        frame_constants->camera_in_shadow,
+        quality_props,
+        parameters,
+        material
+        STATISTICS_ARGUMENT
+    );
+
+    int block_width = min(pixel_stride, tile_width - tile_x);
+    int block_height = min(pixel_stride, tile_height - tile_y);
+
+    for (int block_x = 0; block_x < block_width; block_x++) {
+        for (int block_y = 0; block_y < block_height; block_y++) {
+            // the tile is stored row by row or column by column, every pixel as one 32-bit word with the channels
+            // at the given bit offsets, which is RGBA in memory for offsets of 0, 8, 16 and 24 on little endian
+            int index = row_major
+                ? (tile_y + block_y) * tile_width + tile_x + block_x
+                : (tile_x + block_x) * tile_height + tile_y + block_y;
+
+            output[index] = (uint) color.x << channel_shifts.x
+                | (uint) color.y << channel_shifts.y
+                | (uint) color.z << channel_shifts.z
+                | (uint) color.w << channel_shifts.w;
+
+            if (depth_output)
+                depth_output[(idY + block_y) * width + idX + block_x] = primary_distance;
+
+#ifdef COLLECT_STATISTICS
+            __global uint * counters = &statistics_output[(idY + block_y) * width + idX + block_x];
+            uint plane = width * height;
+
+            counters[0] = statistics->primary_steps;
+            counters[plane] = statistics->shadow_steps;
+            counters[2 * plane] = statistics->reflection_steps;
+            counters[3 * plane] = statistics->reflection_bounces;
+            counters[4 * plane] = statistics->normal_evaluations;
+            counters[5 * plane] = statistics->distance_evaluations;
+#endif
+        }
+    }
 }
@@ -5,7 +5,7 @@ import numpy as np
 import pyopencl as cl
 import pyopencl.cltypes
 
-from .fractal import Fractal
+from .fractal import Fractal, BoundingVolume
 
 
 class Mandelbox(Fractal):
@@ -30,6 +30,11 @@ class Mandelbox(Fractal):
         ("scale", cl.cltypes.float)
     ])
 
+    mandelbox_derived_parameters = np.dtype([
+        ("c1", cl.cltypes.float),
+        ("c2", cl.cltypes.float)
+    ])
+
     # ---------------------------------------------------------------------------------------------------------------- #
     def get_default_material(self):
         return self._default_material
@@ -85,8 +90,8 @@ class Mandelbox(Fractal):
             float r2 = -1;
             float scale = parameters->scale;
         
-            float c1 = fabs(scale - 1.0f);
-            float c2 = pow(fabs(scale), 1 - quality_props->iteration_limit);
+            float c1 = parameters->c1;
+            float c2 = parameters->c2;
         
             for (int i = 0; i < quality_props->iteration_limit; i++) {
                 fold_box(&p);
@@ -166,6 +171,63 @@ class Mandelbox(Fractal):
         }
         """
 
+    @staticmethod
+    def _iterate_numpy(points, parameters, iteration_limit):
+        r_min, escape_time, scale = parameters
+
+        r_min_2 = np.float32(r_min) ** 2
+        escape = np.float32(escape_time) ** 2
+
+        p = points.copy()
+        d_factor = np.ones(len(points), dtype=np.float32)
+        orbit = np.zeros_like(points)
+
+        # points that escaped keep the values of the iteration they escaped at
+        active = np.ones(len(points), dtype=bool)
+
+        for _ in range(iteration_limit):
+            folded = np.where(p > 1, 2 - p, np.where(p < -1, -2 - p, p))
+            r2 = np.sum(folded * folded, axis=1)
+
+            with np.errstate(divide="ignore"):
+                factor = np.where(r2 < r_min_2, 1 / r_min_2, np.where(r2 < 1, 1 / r2, np.float32(1)))
+
+            folded = folded * factor[:, None] * np.float32(scale) + points
+
+            p = np.where(active[:, None], folded, p)
+            d_factor = np.where(active, d_factor * factor * np.float32(abs(scale)) + 1, d_factor)
+            orbit = np.where(active[:, None], np.maximum(orbit, p), orbit)
+
+            active &= ~(r2 > escape)
+
+            if not active.any():
+                break
+
+        return p, d_factor, orbit
+
+    @staticmethod
+    def distance_numpy(points, parameters, iteration_limit):
+        scale = parameters[2]
+
+        p, d_factor, _ = Mandelbox._iterate_numpy(points, parameters, iteration_limit)
+
+        c1 = np.float32(abs(scale - 1))
+        c2 = np.float32(abs(scale)) ** np.float32(1 - iteration_limit)
+
+        return (np.sqrt(np.sum(p * p, axis=1)) - c1) / d_factor - c2
+
+    @staticmethod
+    def orbit_trap_numpy(points, parameters, iteration_limit):
+        return Mandelbox._iterate_numpy(points, parameters, iteration_limit)[2]
+
+    @staticmethod
+    def get_bounding_volume():
+        return BoundingVolume("box", (6.1, 6.1, 6.1))
+
+    @staticmethod
+    def outside_of_circumscribed_figure_numpy(points):
+        return np.any(np.abs(points) > 6.1, axis=1)
+
     def get_name(self):
         return "Mandelbox"
 
@@ -191,6 +253,17 @@ class Mandelbox(Fractal):
     def get_numpy_dtype_parameters(self):
         return self.mandelbox_parameters
 
+    def get_numpy_dtype_derived_parameters(self):
+        return self.mandelbox_derived_parameters
+
+    def get_derived_parameters_values(self, values, quality_props):
+        scale = np.float32(values[2])
+
+        return (
+            abs(scale - np.float32(1)),
+            abs(scale) ** np.float32(1 - int(quality_props["iteration_limit"]))
+        )
+
     def get_initial_camera_position(self):
         return np.array([-10, 0, 0], dtype=np.float32)
 
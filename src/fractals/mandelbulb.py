@@ -5,7 +5,7 @@ import numpy as np
 import pyopencl as cl
 import pyopencl.cltypes
 
-from .fractal import Fractal
+from .fractal import Fractal, BoundingVolume
 
 
 class Mandelbulb(Fractal):
@@ -145,6 +145,57 @@ class Mandelbulb(Fractal):
         }
         """
 
+    @staticmethod
+    def distance_numpy(points, parameters, iteration_limit):
+        power = np.float32(parameters[0])
+
+        z = points.copy()
+        dr = np.ones(len(points), dtype=np.float32)
+        r = np.zeros(len(points), dtype=np.float32)
+
+        active = np.ones(len(points), dtype=bool)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for i in range(iteration_limit + 2):
+                length = np.sqrt(np.sum(z * z, axis=1))
+
+                # a point stops iterating at the iteration its radius exceeds 2 or the limit is passed
+                stops = active & ((length > 2) | (i > iteration_limit))
+                r = np.where(stops, length, r)
+                active &= ~stops
+
+                if not active.any():
+                    break
+
+                ph = np.arctan(z[:, 1] / z[:, 0])
+                th = np.arccos(z[:, 2] / length)
+
+                zn = np.stack([
+                    np.sin(power * th) * np.cos(power * ph),
+                    np.sin(power * th) * np.sin(power * ph),
+                    np.cos(power * th)
+                ], axis=1) * (length ** power)[:, None] + points
+
+                dr = np.where(active, length ** (power - 1) * power * dr + 1, dr)
+                z = np.where(active[:, None], zn, z)
+
+            return 0.5 * np.log(r) * r / dr
+
+    @staticmethod
+    def orbit_trap_numpy(points, parameters, iteration_limit):
+        orbit = np.zeros_like(points)
+        orbit[:, 1] = 1
+
+        return orbit
+
+    @staticmethod
+    def get_bounding_volume():
+        return BoundingVolume("box", (5.1, 5.1, 5.1))
+
+    @staticmethod
+    def outside_of_circumscribed_figure_numpy(points):
+        return np.any(np.abs(points) > 5.1, axis=1)
+
     def get_name(self):
         return "Mandelbulb"
 
@@ -5,7 +5,7 @@ import numpy as np
 import pyopencl as cl
 import pyopencl.cltypes
 
-from .fractal import Fractal
+from .fractal import Fractal, BoundingVolume
 
 
 class MengerSponge(Fractal):
@@ -25,6 +25,10 @@ class MengerSponge(Fractal):
         ("scale", cl.cltypes.float),
     ])
 
+    menger_sponge_derived_parameters = np.dtype([
+        ("psni", cl.cltypes.float),
+    ])
+
     # ---------------------------------------------------------------------------------------------------------------- #
     def get_default_material(self):
         return self._default_material
@@ -57,7 +61,7 @@ class MengerSponge(Fractal):
             const float scaleM = 3.0f - 1.0f;
             const float3 offset = (float3)(1.0f, 1.0f, 1.0f);
             const int iters = quality_props->iteration_limit;
-            const float psni = pow(scale, -(float)iters);
+            const float psni = parameters->psni;
             
             for (int n = 0; n < iters; n++) {
                 pos = fabs(pos);
@@ -115,6 +119,46 @@ class MengerSponge(Fractal):
         }
         """
 
+    @staticmethod
+    def _iterate_numpy(points, parameters, iteration_limit):
+        scale = np.float32(parameters[0])
+        scale_m = np.float32(3 - 1)
+
+        pos = points.copy()
+        orbit = np.zeros_like(points)
+        m = np.array([0.42, 0.38, 0.19], dtype=np.float32)
+
+        for _ in range(iteration_limit):
+            # the conditional swaps of the kernel sort the absolute coordinates in descending order
+            pos = -np.sort(-np.abs(pos), axis=1)
+
+            pos = pos * scale - scale_m
+            pos[:, 2] = np.where(pos[:, 2] < -0.5 * scale_m, pos[:, 2] + scale_m, pos[:, 2])
+
+            orbit = np.maximum(orbit, pos * m)
+
+        return pos, orbit
+
+    @staticmethod
+    def distance_numpy(points, parameters, iteration_limit):
+        scale = np.float32(parameters[0])
+
+        pos, _ = MengerSponge._iterate_numpy(points, parameters, iteration_limit)
+
+        return (np.max(np.abs(pos), axis=1) - scale * np.float32(0.3333334)) * scale ** np.float32(-iteration_limit)
+
+    @staticmethod
+    def orbit_trap_numpy(points, parameters, iteration_limit):
+        return MengerSponge._iterate_numpy(points, parameters, iteration_limit)[1]
+
+    @staticmethod
+    def get_bounding_volume():
+        return BoundingVolume("box", (5.2, 5.2, 5.2))
+
+    @staticmethod
+    def outside_of_circumscribed_figure_numpy(points):
+        return np.any(np.abs(points) > 5.2, axis=1)
+
     def get_name(self):
         return "Menger Sponge"
 
@@ -143,6 +187,12 @@ class MengerSponge(Fractal):
     def get_numpy_dtype_parameters(self):
         return self.mandelbox_parameters
 
+    def get_numpy_dtype_derived_parameters(self):
+        return self.menger_sponge_derived_parameters
+
+    def get_derived_parameters_values(self, values, quality_props):
+        return (np.float32(values[0]) ** np.float32(-int(quality_props["iteration_limit"])), )
+
     def get_initial_camera_position(self):
         return np.array([2, 0, 2], dtype=np.float32)
 
@@ -5,7 +5,7 @@ import numpy as np
 import pyopencl as cl
 import pyopencl.cltypes
 
-from .fractal import Fractal
+from .fractal import Fractal, BoundingVolume
 
 
 class SierpinskiTriangle(Fractal):
@@ -27,6 +27,10 @@ class SierpinskiTriangle(Fractal):
         ("offset", cl.cltypes.float)
     ])
 
+    sierpinski_derived_parameters = np.dtype([
+        ("distance_scale", cl.cltypes.float)
+    ])
+
     # ---------------------------------------------------------------------------------------------------------------- #
     def get_default_material(self):
         return self._default_material
@@ -83,7 +87,7 @@ class SierpinskiTriangle(Fractal):
                 z = scale * z - offset * (scale - 1.0f);
             }
          
-            return fast_length(z) * pow(scale, (float)(-quality_props->iteration_limit));
+            return fast_length(z) * parameters->distance_scale;
         }
         """
 
@@ -136,6 +140,50 @@ class SierpinskiTriangle(Fractal):
         }
         """
 
+    @staticmethod
+    def _iterate_numpy(points, parameters, iteration_limit):
+        scale, offset = np.float32(parameters[0]), np.float32(parameters[1])
+
+        x, y, z = points[:, 0].copy(), points[:, 1].copy(), points[:, 2].copy()
+        orbit = np.zeros_like(points)
+        m = np.array([0.42, 0.38, 0.19], dtype=np.float32)
+
+        for _ in range(iteration_limit):
+            swap = (x + y) < 0
+            x, y = np.where(swap, -y, x), np.where(swap, -x, y)
+
+            swap = (x + z) < 0
+            x, z = np.where(swap, -z, x), np.where(swap, -x, z)
+
+            swap = (z + y) < 0
+            z, y = np.where(swap, -y, z), np.where(swap, -z, y)
+
+            x = scale * x - offset * (scale - 1)
+            y = scale * y - offset * (scale - 1)
+            z = scale * z - offset * (scale - 1)
+
+            orbit = np.maximum(orbit, np.stack([x, y, z], axis=1) * m)
+
+        return np.stack([x, y, z], axis=1), orbit
+
+    @staticmethod
+    def distance_numpy(points, parameters, iteration_limit):
+        z, _ = SierpinskiTriangle._iterate_numpy(points, parameters, iteration_limit)
+
+        return np.sqrt(np.sum(z * z, axis=1)) * np.float32(parameters[0]) ** np.float32(-iteration_limit)
+
+    @staticmethod
+    def orbit_trap_numpy(points, parameters, iteration_limit):
+        return SierpinskiTriangle._iterate_numpy(points, parameters, iteration_limit)[1]
+
+    @staticmethod
+    def get_bounding_volume():
+        return BoundingVolume("box", (5.2, 5.2, 5.2))
+
+    @staticmethod
+    def outside_of_circumscribed_figure_numpy(points):
+        return np.any(np.abs(points) > 5.2, axis=1)
+
     def get_name(self):
         return "Sierpinski Triangle"
 
@@ -164,6 +212,12 @@ class SierpinskiTriangle(Fractal):
     def get_numpy_dtype_parameters(self):
         return self.sierpinski_parameters
 
+    def get_numpy_dtype_derived_parameters(self):
+        return self.sierpinski_derived_parameters
+
+    def get_derived_parameters_values(self, values, quality_props):
+        return (np.float32(values[0]) ** np.float32(-int(quality_props["iteration_limit"])), )
+
     def get_initial_camera_position(self):
         return np.array([2, 0, 2], dtype=np.float32)
 
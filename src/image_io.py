@@ -0,0 +1,160 @@
+import io
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+
+
+TIFF_EXTENSIONS = (".tif", ".tiff")
+RAW_EXTENSIONS = (".raw", ".rgba")
+
+_PNG_COLOR_TYPES = {1: 0, 3: 2, 4: 6}
+_PNG_ROWS_PER_CHUNK = 64
+
+
+def _tiff_entry(tag, value_type, count, value):
+    # classic TIFF entries hold their value inline when it fits into four bytes
+    if value_type == 3 and count == 1:
+        return struct.pack("<HHIHH", tag, value_type, count, value, 0)
+
+    return struct.pack("<HHII", tag, value_type, count, value)
+
+
+def open_tiff_memmap(path: str, width: int, height: int, channels: int = 4) -> np.memmap:
+    bits_per_sample_offset = 8
+    entries_count = 11 if channels == 4 else 10
+    ifd_offset = bits_per_sample_offset + 2 * channels
+    ifd_offset += ifd_offset % 2
+    data_offset = ifd_offset + 2 + entries_count * 12 + 4
+    data_offset += (-data_offset) % 16
+
+    data_size = width * height * channels
+
+    if data_offset + data_size >= 2 ** 32:
+        raise ValueError("{}x{} image is too large for a classic TIFF file, use a .raw output".format(width, height))
+
+    entries = [
+        _tiff_entry(256, 4, 1, width),
+        _tiff_entry(257, 4, 1, height),
+        _tiff_entry(258, 3, channels, 8 if channels == 1 else bits_per_sample_offset),
+        _tiff_entry(259, 3, 1, 1),
+        _tiff_entry(262, 3, 1, 1 if channels == 1 else 2),
+        _tiff_entry(273, 4, 1, data_offset),
+        _tiff_entry(277, 3, 1, channels),
+        _tiff_entry(278, 4, 1, height),
+        _tiff_entry(279, 4, 1, data_size),
+        _tiff_entry(284, 3, 1, 1)
+    ]
+
+    if channels == 4:
+        entries.append(_tiff_entry(338, 3, 1, 2))
+
+    header = bytearray(data_offset)
+    header[0:8] = struct.pack("<2sHI", b"II", 42, ifd_offset)
+    header[bits_per_sample_offset:bits_per_sample_offset + 2 * channels] = struct.pack("<" + "H" * channels, *[8] * channels)
+    header[ifd_offset:ifd_offset + 2] = struct.pack("<H", entries_count)
+
+    for i, entry in enumerate(entries):
+        position = ifd_offset + 2 + i * 12
+        header[position:position + 12] = entry
+
+    with open(path, "wb") as f:
+        f.write(header)
+        f.truncate(data_offset + data_size)
+
+    return np.memmap(path, dtype=np.uint8, mode="r+", offset=data_offset, shape=(height, width, channels))
+
+
+def open_raw_memmap(path: str, width: int, height: int, channels: int = 4) -> np.memmap:
+    return np.memmap(path, dtype=np.uint8, mode="w+", shape=(height, width, channels))
+
+
+def write_png(path: str, image: np.ndarray):
+    with open(path, "wb") as f:
+        _write_png(f, image)
+
+
+def encode_png(image: np.ndarray) -> bytes:
+    f = io.BytesIO()
+    _write_png(f, image)
+
+    return f.getvalue()
+
+
+def _write_png(f, image: np.ndarray):
+    height, width, channels = image.shape
+
+    def chunk(f, kind, data):
+        f.write(struct.pack(">I", len(data)))
+        f.write(kind)
+        f.write(data)
+        f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff))
+
+    compressor = zlib.compressobj(6)
+    filter_bytes = np.zeros((_PNG_ROWS_PER_CHUNK, 1), dtype=np.uint8)
+
+    f.write(b"\x89PNG\r\n\x1a\n")
+    chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, _PNG_COLOR_TYPES[channels], 0, 0, 0))
+
+    # rows are streamed from the (possibly memory mapped) image a few at a time
+    for y in range(0, height, _PNG_ROWS_PER_CHUNK):
+        rows = np.ascontiguousarray(image[y:y + _PNG_ROWS_PER_CHUNK]).reshape((-1, width * channels))
+        data = compressor.compress(np.hstack((filter_bytes[:len(rows)], rows)).tobytes())
+
+        if data:
+            chunk(f, b"IDAT", data)
+
+    chunk(f, b"IDAT", compressor.flush())
+    chunk(f, b"IEND", b"")
+
+
+class ImageFile:
+    # (height, width, channels) memory mapped image: TIFF and raw files are mapped directly,
+    # PNG files are streamed from a temporary raw file when closed, anything else goes through PIL
+
+    def __init__(self, path: str, width: int, height: int, channels: int = 4):
+        self.path = path
+        self.extension = os.path.splitext(path)[1].lower()
+        self._temporary_path = None
+
+        if self.extension in TIFF_EXTENSIONS:
+            self.image = open_tiff_memmap(path, width, height, channels)
+        elif self.extension in RAW_EXTENSIONS:
+            self.image = open_raw_memmap(path, width, height, channels)
+        else:
+            descriptor, self._temporary_path = tempfile.mkstemp(
+                suffix=".raw",
+                dir=os.path.dirname(os.path.abspath(path))
+            )
+            os.close(descriptor)
+
+            self.image = open_raw_memmap(self._temporary_path, width, height, channels)
+
+    def __enter__(self):
+        return self.image
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(discard=exc_type is not None)
+
+    def close(self, discard=False):
+        self.image.flush()
+
+        try:
+            if self._temporary_path is None or discard:
+                return
+
+            if self.extension == ".png":
+                write_png(self.path, self.image)
+            else:
+                from PIL import Image
+
+                Image.fromarray(np.asarray(self.image)).save(self.path)
+
+        finally:
+            image, self.image = self.image, None
+            del image
+
+            if self._temporary_path is not None:
+                os.remove(self._temporary_path)
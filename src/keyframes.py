@@ -0,0 +1,308 @@
+import json
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+
+from .camera_path import CAMERA_PATH_DTYPE
+
+
+# every function below works on whole arrays of poses: (N, 3) vectors and (N, 4) quaternions in the (x, y, z, w)
+# order of Quaternion, so that thousands of frames are evaluated without a Python object per frame
+
+def quaternion_multiply(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    av, aw = a[..., :3], a[..., 3:]
+    bv, bw = b[..., :3], b[..., 3:]
+
+    return np.concatenate((
+        av * bw + bv * aw + np.cross(av, bv),
+        aw * bw - np.sum(av * bv, axis=-1, keepdims=True)
+    ), axis=-1)
+
+
+def quaternion_conjugate(q: np.ndarray) -> np.ndarray:
+    return np.concatenate((-q[..., :3], q[..., 3:]), axis=-1)
+
+
+def quaternion_log(q: np.ndarray) -> np.ndarray:
+    # of unit quaternions, a pure quaternion (w = 0) of half the rotation angle around the axis
+    v = q[..., :3]
+    length = np.linalg.norm(v, axis=-1, keepdims=True)
+    angle = np.arctan2(length, q[..., 3:])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = np.where(length > 1e-12, angle / length, 1.0)
+
+    return np.concatenate((v * scale, np.zeros_like(angle)), axis=-1)
+
+
+def quaternion_exp(q: np.ndarray) -> np.ndarray:
+    # of pure quaternions
+    v = q[..., :3]
+    angle = np.linalg.norm(v, axis=-1, keepdims=True)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = np.where(angle > 1e-12, np.sin(angle) / angle, 1.0)
+
+    return np.concatenate((v * scale, np.cos(angle)), axis=-1)
+
+
+def quaternion_slerp(a: np.ndarray, b: np.ndarray, t: np.ndarray) -> np.ndarray:
+    # takes the arc from a to b as given, callers pick the hemisphere of b
+    t = np.asarray(t, dtype=np.float64)[..., None]
+    dot = np.clip(np.sum(a * b, axis=-1, keepdims=True), -1.0, 1.0)
+
+    angle = np.arccos(dot)
+    sin_angle = np.sin(angle)
+
+    # nearly equal rotations are interpolated linearly, the weights of the arc are unstable there
+    close = np.abs(sin_angle) < 1e-6
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weight_a = np.where(close, 1.0 - t, np.sin((1.0 - t) * angle) / sin_angle)
+        weight_b = np.where(close, t, np.sin(t * angle) / sin_angle)
+
+    result = weight_a * a + weight_b * b
+
+    return result / np.linalg.norm(result, axis=-1, keepdims=True)
+
+
+def quaternions_from_matrices(matrices: np.ndarray) -> np.ndarray:
+    # (N, 3, 3) rotation matrices, the largest of the four candidates is taken for a stable square root
+    m = matrices
+    m00, m11, m22 = m[..., 0, 0], m[..., 1, 1], m[..., 2, 2]
+
+    candidates = np.stack((m00 + m11 + m22, m00 - m11 - m22, m11 - m00 - m22, m22 - m00 - m11), axis=-1)
+    s = np.sqrt(np.maximum(1.0 + candidates, 1e-12)) * 2.0
+
+    xy, yx = m[..., 0, 1], m[..., 1, 0]
+    xz, zx = m[..., 0, 2], m[..., 2, 0]
+    yz, zy = m[..., 1, 2], m[..., 2, 1]
+
+    quaternions = np.stack((
+        np.stack(((zy - yz) / s[..., 0], (xz - zx) / s[..., 0], (yx - xy) / s[..., 0], s[..., 0] / 4), axis=-1),
+        np.stack((s[..., 1] / 4, (xy + yx) / s[..., 1], (xz + zx) / s[..., 1], (zy - yz) / s[..., 1]), axis=-1),
+        np.stack(((xy + yx) / s[..., 2], s[..., 2] / 4, (yz + zy) / s[..., 2], (xz - zx) / s[..., 2]), axis=-1),
+        np.stack(((xz + zx) / s[..., 3], (yz + zy) / s[..., 3], s[..., 3] / 4, (yx - xy) / s[..., 3]), axis=-1)
+    ), axis=-2)
+
+    case = np.argmax(candidates, axis=-1)[..., None, None]
+
+    return np.take_along_axis(quaternions, case, axis=-2)[..., 0, :]
+
+
+def matrices_from_quaternions(q: np.ndarray) -> np.ndarray:
+    x, y, z, w = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+
+    return np.stack((
+        np.stack((1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)), axis=-1),
+        np.stack((2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)), axis=-1),
+        np.stack((2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)), axis=-1)
+    ), axis=-2)
+
+
+def _normalize(vectors):
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def quaternions_from_cameras(directions: np.ndarray, ups: np.ndarray) -> np.ndarray:
+    # the basis of Camera.look_at, (right, up, -direction) as the columns of a rotation matrix
+    directions = _normalize(np.asarray(directions, dtype=np.float64))
+    rights = _normalize(np.cross(directions, np.asarray(ups, dtype=np.float64)))
+    ups = np.cross(rights, directions)
+
+    return quaternions_from_matrices(np.stack((rights, ups, -directions), axis=-1))
+
+
+def cameras_from_quaternions(q: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # (directions, ups, rights)
+    matrices = matrices_from_quaternions(q)
+
+    return -matrices[..., 2], matrices[..., 1], matrices[..., 0]
+
+
+class CameraSpline:
+    def __init__(self,
+                 times: Sequence[float],
+                 positions: np.ndarray,
+                 orientations: np.ndarray,
+                 zooms: Optional[Sequence[float]] = None,
+                 position_mode: str = "catmull-rom",
+                 orientation_mode: str = "squad",
+                 handles: Optional[np.ndarray] = None):
+
+        if position_mode not in ("catmull-rom", "bezier"):
+            raise ValueError("Unknown position mode {!r}, expected 'catmull-rom' or 'bezier'".format(position_mode))
+
+        if orientation_mode not in ("squad", "slerp"):
+            raise ValueError("Unknown orientation mode {!r}, expected 'squad' or 'slerp'".format(orientation_mode))
+
+        self.times = np.asarray(times, dtype=np.float64)
+
+        if len(self.times) < 2 or np.any(np.diff(self.times) <= 0):
+            raise ValueError("A camera spline needs at least two keyframes with increasing times")
+
+        self.positions = np.asarray(positions, dtype=np.float64)
+        self.zooms = np.asarray(zooms, dtype=np.float64) if zooms is not None else np.ones(len(self.times))
+        self.position_mode = position_mode
+        self.orientation_mode = orientation_mode
+
+        # neighbouring keyframes are put into the same hemisphere, so that every segment takes the short arc
+        orientations = _normalize(np.asarray(orientations, dtype=np.float64))
+
+        for i in range(1, len(orientations)):
+            if np.dot(orientations[i - 1], orientations[i]) < 0:
+                orientations[i] = -orientations[i]
+
+        self.orientations = orientations
+
+        # Catmull-Rom tangents from the neighbouring keyframes (one-sided at the ends), scaled to the keyframe times
+        tangents = np.empty_like(self.positions)
+        tangents[1:-1] = (self.positions[2:] - self.positions[:-2]) / (self.times[2:] - self.times[:-2])[:, None]
+        tangents[0] = (self.positions[1] - self.positions[0]) / (self.times[1] - self.times[0])
+        tangents[-1] = (self.positions[-1] - self.positions[-2]) / (self.times[-1] - self.times[-2])
+
+        self.tangents = tangents
+
+        # (keyframes - 1, 2, 3) inner control points of the Bezier segments, by default the ones of the Catmull-Rom
+        # curve, so both modes only differ with handles of their own
+        if handles is None:
+            durations = np.diff(self.times)[:, None]
+
+            handles = np.stack((
+                self.positions[:-1] + self.tangents[:-1] * durations / 3,
+                self.positions[1:] - self.tangents[1:] * durations / 3
+            ), axis=1)
+
+        self.handles = np.asarray(handles, dtype=np.float64)
+
+        # squad control quaternions s_i = q_i exp(-(log(q_i* q_i+1) + log(q_i* q_i-1)) / 4), the ends are their own
+        inverse = quaternion_conjugate(orientations[1:-1])
+
+        self.squad_controls = orientations.copy()
+        self.squad_controls[1:-1] = quaternion_multiply(orientations[1:-1], quaternion_exp(-0.25 * (
+            quaternion_log(quaternion_multiply(inverse, orientations[2:])) +
+            quaternion_log(quaternion_multiply(inverse, orientations[:-2]))
+        )))
+
+    @classmethod
+    def from_look_at(cls, times, positions, targets, world_up=(0, 1, 0), **kwargs):
+        directions = np.asarray(targets, dtype=np.float64) - np.asarray(positions, dtype=np.float64)
+        ups = np.broadcast_to(np.asarray(world_up, dtype=np.float64), directions.shape)
+
+        return cls(times, positions, quaternions_from_cameras(directions, ups), **kwargs)
+
+    @property
+    def duration(self):
+        return self.times[-1] - self.times[0]
+
+    def sample_times(self, fps: float) -> np.ndarray:
+        return self.times[0] + np.arange(int(self.duration * fps) + 1) / fps
+
+    def _locate(self, times):
+        # the segment of every time and the position within it, times outside of the keyframes are clamped
+        times = np.asarray(times, dtype=np.float64)
+        segments = np.clip(np.searchsorted(self.times, times, side="right") - 1, 0, len(self.times) - 2)
+
+        start = self.times[segments]
+        duration = self.times[segments + 1] - start
+
+        return segments, np.clip((times - start) / duration, 0.0, 1.0), duration
+
+    def evaluate_positions(self, times) -> np.ndarray:
+        segments, t, duration = self._locate(times)
+        t = t[:, None]
+
+        p0 = self.positions[segments]
+        p3 = self.positions[segments + 1]
+
+        if self.position_mode == "catmull-rom":
+            t2 = t * t
+            t3 = t2 * t
+
+            return (
+                (2 * t3 - 3 * t2 + 1) * p0 +
+                (t3 - 2 * t2 + t) * self.tangents[segments] * duration[:, None] +
+                (3 * t2 - 2 * t3) * p3 +
+                (t3 - t2) * self.tangents[segments + 1] * duration[:, None]
+            )
+
+        p1 = self.handles[segments, 0]
+        p2 = self.handles[segments, 1]
+        s = 1 - t
+
+        return s * s * s * p0 + 3 * s * s * t * p1 + 3 * s * t * t * p2 + t * t * t * p3
+
+    def evaluate_orientations(self, times) -> np.ndarray:
+        segments, t, _ = self._locate(times)
+
+        q0 = self.orientations[segments]
+        q1 = self.orientations[segments + 1]
+
+        if self.orientation_mode == "slerp":
+            return quaternion_slerp(q0, q1, t)
+
+        return quaternion_slerp(
+            quaternion_slerp(q0, q1, t),
+            quaternion_slerp(self.squad_controls[segments], self.squad_controls[segments + 1], t),
+            2 * t * (1 - t)
+        )
+
+    def evaluate_zooms(self, times) -> np.ndarray:
+        return np.interp(times, self.times, self.zooms)
+
+    def evaluate_cameras(self, times) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        # (positions, directions, ups, rights) as float32 (N, 3) arrays, the layout of Camera
+        directions, ups, rights = cameras_from_quaternions(self.evaluate_orientations(times))
+
+        return tuple(
+            vectors.astype(np.float32)
+            for vectors in (self.evaluate_positions(times), directions, ups, rights)
+        )
+
+    def to_camera_path(self, times, render) -> np.ndarray:
+        # camera path records for replay_camera_path and AnimationExporter, the animation time of the fractal follows
+        # the clock of the spline, everything else but the pose is taken from the current state of the render
+        times = np.asarray(times, dtype=np.float64)
+        positions, directions, ups, rights = self.evaluate_cameras(times)
+
+        records = np.zeros(len(times), dtype=CAMERA_PATH_DTYPE)
+
+        records["timestamp"] = times
+        records["position"] = positions
+        records["direction"] = directions
+        records["up"] = ups
+        records["right"] = rights
+        records["zoom"] = self.evaluate_zooms(times)
+        records["epsilon"] = render.epsilon
+        records["ray_steps_limit"] = render.ray_steps_limit
+        records["fractal_index"] = render.fractals.index(render.fractal)
+        records["render_simple"] = render.render_simple
+        records["time"] = times
+        records["amplitude"] = render.fractal.get_amplitude()
+
+        return records
+
+
+def load_camera_spline(path: str) -> CameraSpline:
+    # {"position_mode": ..., "orientation_mode": ..., "keyframes": [{"time", "position", "target" or "direction",
+    # optional "up" and "zoom"}, ...]}
+    with open(path) as f:
+        description = json.load(f)
+
+    keyframes = description["keyframes"]
+
+    positions = np.array([keyframe["position"] for keyframe in keyframes], dtype=np.float64)
+    directions = np.array([
+        np.subtract(keyframe["target"], keyframe["position"]) if "target" in keyframe else keyframe["direction"]
+        for keyframe in keyframes
+    ], dtype=np.float64)
+    ups = np.array([keyframe.get("up", (0, 1, 0)) for keyframe in keyframes], dtype=np.float64)
+
+    return CameraSpline(
+        [keyframe["time"] for keyframe in keyframes],
+        positions,
+        quaternions_from_cameras(directions, ups),
+        zooms=[keyframe.get("zoom", 1.0) for keyframe in keyframes],
+        position_mode=description.get("position_mode", "catmull-rom"),
+        orientation_mode=description.get("orientation_mode", "squad")
+    )
@@ -0,0 +1,65 @@
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+
+class BandBalancer:
+    def __init__(self, devices: int, smoothing: float = 0.5, min_rows: int = 1):
+        self.devices = devices
+        self.smoothing = smoothing
+        self.min_rows = min_rows
+
+        # estimated cost of every row of the image, in seconds of the device that rendered it last
+        self.row_costs = None
+
+        self._edges = None
+
+    def reset(self):
+        self.row_costs = None
+        self._edges = None
+
+    def get_bands(self, height: int) -> List[int]:
+        # devices + 1 edges, device i renders the rows edges[i] to edges[i + 1]
+        if self._edges is None or self._edges[-1] != height:
+            self.row_costs = None
+            self._edges = self._split(np.ones(height), height)
+
+        return list(self._edges)
+
+    def update(self, kernel_times: Sequence[Optional[float]]) -> List[int]:
+        edges = np.array(self._edges)
+        rows = np.diff(edges)
+        height = int(edges[-1])
+
+        if any(time is None or time <= 0.0 for time in kernel_times) or not rows.all():
+            return list(self._edges)
+
+        # the time of a band is spread evenly over its rows, so a slow device makes its rows look expensive
+        # and hands some of them over to the others
+        row_costs = np.repeat(np.array(kernel_times) / rows, rows)
+
+        if self.row_costs is None:
+            self.row_costs = row_costs
+        else:
+            self.row_costs += (row_costs - self.row_costs) * self.smoothing
+
+        self._edges = self._split(self.row_costs, height)
+
+        return list(self._edges)
+
+    def _split(self, row_costs, height):
+        cumulative = np.concatenate([[0.0], np.cumsum(row_costs)])
+        targets = cumulative[-1] * np.arange(1, self.devices) / self.devices
+
+        edges = [0] + list(np.searchsorted(cumulative, targets)) + [height]
+
+        # every device keeps at least min_rows rows (as long as there are enough of them)
+        min_rows = min(self.min_rows, height // self.devices)
+
+        for i in range(1, self.devices):
+            edges[i] = int(max(edges[i], edges[i - 1] + min_rows))
+
+        for i in range(self.devices - 1, 0, -1):
+            edges[i] = int(min(edges[i], edges[i + 1] - min_rows))
+
+        return edges
@@ -0,0 +1,181 @@
+import time
+from concurrent.futures import Future
+from typing import List, Sequence
+
+import numpy as np
+import pyopencl as cl
+
+from .camera import Camera
+from .fractals import Fractal
+from .load_balancing import BandBalancer
+from .render import Render
+from .statistics import FrameStatistics
+from .tracking import Tracked
+
+
+def get_sub_devices(device: cl.Device, count: int) -> List[cl.Device]:
+    # splits a device (usually a CPU) into `count` sub-devices with equal shares of its compute units,
+    # devices that can't be partitioned are returned as they are
+    units = device.max_compute_units // count
+
+    if count < 2 or units < 1:
+        return [device]
+
+    try:
+        return device.create_sub_devices([cl.device_partition_property.EQUALLY, units])[:count]
+    except (cl.Error, AttributeError):
+        return [device]
+
+
+class MultiDeviceRender(Tracked):
+
+    _tracked_attributes = Render._tracked_attributes
+
+    quality_fields = tuple(sorted(Render._tracked_attributes))
+
+    def __init__(self,
+                 devices: Sequence[cl.Device],
+                 camera: Camera,
+                 width: int = 500, height: int = 500,
+                 build_in_background=False,
+                 smoothing=0.5,
+                 **quality):
+
+        self.camera = camera
+
+        self.width = max(1, width)
+        self.height = max(1, height)
+
+        # every device gets its own context, profiling queue, programs and frame buffer, the camera is shared
+        self.renders = []
+
+        for device in devices:
+            context = cl.Context([device])
+            queue = cl.CommandQueue(context, properties=cl.command_queue_properties.PROFILING_ENABLE)
+
+            self.renders.append(Render(
+                device,
+                context,
+                queue,
+                camera,
+                width=self.width,
+                height=self.height,
+                build_in_background=build_in_background,
+                **quality
+            ))
+
+        primary = self.renders[0]
+
+        for name in self.quality_fields:
+            setattr(self, name, getattr(primary, name))
+
+        # the fractals of the first device are the ones the caller sees and modifies, the others follow them
+        self.fractals = primary.fractals
+        self.fractal_by_name = primary.fractal_by_name
+        self.fractal = primary.fractal
+
+        self.balancer = BandBalancer(len(self.renders), smoothing=smoothing)
+
+        # kernel time of every device and of the slowest one in the last frame
+        self.kernel_times = [None] * len(self.renders)
+        self.last_kernel_time = None
+
+        self._host_image_buffer = np.zeros(self.width * self.height * 4, dtype=np.uint8)
+
+    def _mirror(self):
+        index = self.fractals.index(self.fractal)
+
+        for render in self.renders:
+            fractal = render.fractals[index]
+
+            if fractal is not self.fractal:
+                for name in Fractal._tracked_attributes:
+                    setattr(fractal, name, getattr(self.fractal, name))
+
+            render.fractal = fractal
+
+            for name in self.quality_fields:
+                setattr(render, name, getattr(self, name))
+
+    @property
+    def is_ready(self):
+        return all(render.is_ready for render in self.renders)
+
+    def resize(self, width, height):
+        width = max(1, width)
+        height = max(1, height)
+
+        if (width, height) == (self.width, self.height):
+            return
+
+        self.width = width
+        self.height = height
+
+        for render in self.renders:
+            render.resize(width, height)
+
+        self._host_image_buffer = np.zeros(self.width * self.height * 4, dtype=np.uint8)
+
+    def render(self):
+        self._mirror()
+
+        ready = [render.ensure_ready() for render in self.renders]
+
+        if not all(ready):
+            return self.renders[0].present_placeholder()
+
+        edges = self.balancer.get_bands(self.height)
+
+        # every device renders its band of rows, all of them are submitted before the first one is waited for
+        for i, render in enumerate(self.renders):
+            if edges[i + 1] > edges[i]:
+                render.submit_band(edges[i], edges[i + 1] - edges[i])
+
+        row_major = self.renders[0].row_major
+
+        for i, render in enumerate(self.renders):
+            if edges[i + 1] == edges[i]:
+                self.kernel_times[i] = None
+                continue
+
+            band = render.wait_band()
+
+            # in the row-major layout the bands are consecutive parts of the frame
+            if row_major:
+                self._host_image_buffer[edges[i] * self.width * 4:edges[i + 1] * self.width * 4] = band
+            else:
+                self._host_image_buffer.reshape((self.width, self.height, 4))[:, edges[i]:edges[i + 1]] = \
+                    band.reshape((self.width, -1, 4))
+
+            self.kernel_times[i] = render.last_kernel_time
+
+        self.last_kernel_time = max(time for time in self.kernel_times if time is not None)
+
+        self.balancer.update(self.kernel_times)
+
+        return self._host_image_buffer
+
+    def finish(self):
+        for render in self.renders:
+            render.finish()
+
+    def save(self, path, scale=5, size=None):
+        # screenshots are rendered tile by tile on the first device
+        self._mirror()
+        self.renders[0].save(path, scale=scale, size=size)
+
+    def save_async(self, path, scale=5, size=None, callback=None) -> Future:
+        self._mirror()
+        return self.renders[0].save_async(path, scale=scale, size=size, callback=callback)
+
+    def render_statistics(self) -> FrameStatistics:
+        self._mirror()
+        return self.renders[0].render_statistics()
+
+    def close(self):
+        for render in self.renders:
+            render.close()
+
+    @property
+    def host_buffer(self):
+        return self._host_image_buffer
@@ -0,0 +1,517 @@
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import numpy as np
+
+from .camera import Camera
+from .fractals import fractals
+from .image_io import ImageFile
+from .tracking import Tracked
+
+
+# everything a worker process needs to render a tile, the fractal is passed as its class
+NumpyScene = namedtuple("NumpyScene", [
+    "fractal_class",
+    "parameters",
+    "iteration_limit",
+    "ray_steps_limit",
+    "epsilon",
+    "ray_shift_multiplier",
+    "render_simple",
+    "sun_direction",
+    "reflection_depth",
+    "use_orbit_trap",
+    "glow_color",
+    "glow_sharpness",
+    "color_diffusive",
+    "color_specular",
+    "diffusive",
+    "specular",
+    "reflected",
+    "camera_position",
+    "camera_direction",
+    "camera_up",
+    "camera_right",
+    "camera_zoom"
+])
+
+_SKY_COLOR = np.array([135, 206, 235], dtype=np.int32)
+
+
+# the functions below follow raymarch.cl step by step, so that the two backends can be compared pixel by pixel
+
+def _normalize(vectors):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return vectors / np.sqrt(np.sum(vectors * vectors, axis=-1, keepdims=True))
+
+
+def _reflect(directions, normals):
+    return _normalize(directions - 2 * np.sum(directions * normals, axis=-1, keepdims=True) * normals)
+
+
+def _distance(scene, points):
+    return scene.fractal_class.distance_numpy(points, scene.parameters, scene.iteration_limit)
+
+
+def _orbit_trap(scene, points):
+    return scene.fractal_class.orbit_trap_numpy(points, scene.parameters, scene.iteration_limit)
+
+
+def normals_to_fractal(scene, points):
+    offset = np.float32(scene.epsilon * 0.05)
+    result = np.empty_like(points)
+
+    for axis in range(3):
+        shift = np.zeros(3, dtype=np.float32)
+        shift[axis] = offset
+
+        result[:, axis] = _distance(scene, points + shift) - _distance(scene, points - shift)
+
+    return _normalize(result)
+
+
+def bounding_volume_intervals(volume, origins, directions):
+    # (entry, exit) parameters of (N, 3) rays, entry > exit for the ones that miss the volume
+    count = len(origins)
+
+    if volume is None:
+        return np.zeros(count, dtype=np.float32), np.full(count, np.inf, dtype=np.float32)
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        if volume.shape == "box":
+            size = np.array(volume.size, dtype=np.float32)
+            inverse = np.float32(1) / directions
+            near = (-size - origins) * inverse
+            far = (size - origins) * inverse
+
+            return np.fmin(near, far).max(axis=1), np.fmax(near, far).min(axis=1)
+
+        a = np.sum(directions * directions, axis=1)
+        b = np.sum(origins * directions, axis=1)
+        discriminant = b * b - a * (np.sum(origins * origins, axis=1) - np.float32(volume.size) ** 2)
+        root = np.sqrt(discriminant)
+
+        entry = np.where(discriminant < 0, np.inf, (-b - root) / a).astype(np.float32)
+        exit = np.where(discriminant < 0, -np.inf, (-b + root) / a).astype(np.float32)
+
+        return entry, exit
+
+
+def march_rays(scene, origins, directions):
+    # sphere tracing of (N, 3) rays, only the rays still marching are evaluated at every step
+    count = len(origins)
+
+    epsilon = np.float32(scene.epsilon)
+    shift = np.float32(scene.ray_shift_multiplier)
+
+    # rays that miss the bounding volume of the fractal are sky, the others are marched from their origin as in the
+    # kernel and stop where they leave it
+    entry, exit = bounding_volume_intervals(scene.fractal_class.get_bounding_volume(), origins, directions)
+    missed = (entry > exit) | (exit < 0)
+
+    position = origins.astype(np.float32)
+    distance = np.zeros(count, dtype=np.float32)
+    depth = np.full(count, scene.ray_steps_limit, dtype=np.int32)
+    min_distance = np.ones(count, dtype=np.float32)
+    normal = np.zeros((count, 3), dtype=np.float32)
+
+    active = np.flatnonzero(~missed)
+
+    for i in range(scene.ray_steps_limit):
+        if not len(active):
+            break
+
+        d = _distance(scene, position[active])
+
+        distance[active] += d * shift
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            min_distance[active] = np.fmin(min_distance[active], scene.glow_sharpness * d / distance[active])
+
+        moved = position[active] + d[:, None] * directions[active] * shift
+        position[active] = moved
+        depth[active] = i
+
+        with np.errstate(invalid="ignore"):
+            escaped = d > 100
+            converged = d < epsilon
+
+        depth[active[escaped]] = scene.ray_steps_limit
+        distance[active[escaped]] = 1e20
+
+        if converged.any():
+            hit = active[converged]
+
+            normal[hit] = normals_to_fractal(scene, moved[converged])
+            position[hit] = moved[converged] + (epsilon - d[converged])[:, None] * normal[hit]
+
+        left = ~(escaped | converged) & (distance[active] > exit[active])
+        missed[active[left]] = True
+
+        active = active[~(escaped | converged | left)]
+
+    depth[missed] = scene.ray_steps_limit
+    distance[missed] = 1e20
+
+    with np.errstate(invalid="ignore"):
+        outside = (
+            missed |
+            scene.fractal_class.outside_of_circumscribed_figure_numpy(position) |
+            (np.sqrt(np.sum(position * position, axis=1)) > 15) |
+            (distance > 100)
+        )
+
+    return {
+        "distance": distance,
+        "position": position,
+        "normal": normal,
+        "depth": depth,
+        "outside": outside,
+        "min_distance_to_fractal": min_distance
+    }
+
+
+def _material_colors(scene, points):
+    diffusive = np.broadcast_to(np.array(scene.color_diffusive, dtype=np.float32), points.shape)
+    specular = np.broadcast_to(np.array(scene.color_specular, dtype=np.float32), points.shape)
+
+    if scene.use_orbit_trap:
+        diffusive = np.trunc(_normalize(_orbit_trap(scene, points)) * 255)
+        specular = diffusive
+
+    return diffusive, specular
+
+
+def blinn_phong(scene, positions, normals, directions, shadow_coefficient):
+    color_diffusive, color_specular = _material_colors(scene, positions)
+
+    sun = np.array(scene.sun_direction, dtype=np.float32)
+
+    positions = positions + normals * np.float32(scene.epsilon * 2)
+    projection_length = normals @ sun
+
+    lit = projection_length > 0
+
+    diffusive = np.where(lit, np.maximum(projection_length, 0), np.float32(0.2))
+    specular = np.where(lit, np.maximum(np.sum(_reflect(-sun, normals) * directions, axis=1) ** 3, 0), 0)
+
+    if lit.any():
+        shadow = ~march_rays(scene, positions[lit], np.broadcast_to(sun, positions[lit].shape))["outside"]
+
+        diffusive[np.flatnonzero(lit)[shadow]] *= shadow_coefficient
+        specular[np.flatnonzero(lit)[shadow]] *= shadow_coefficient
+
+    color = np.full((len(positions), 4), 255, dtype=np.int32)
+
+    # an orbit trap of zero length normalizes to NaN, whose conversion is as undefined here as in the kernel
+    with np.errstate(invalid="ignore"):
+        color[:, :3] = np.trunc(np.clip(
+            np.clip(diffusive[:, None] * color_diffusive, 0, color_diffusive) * scene.diffusive +
+            np.clip(specular[:, None] * color_specular, 0, color_specular) * scene.specular,
+            0,
+            255
+        ))
+
+    return color
+
+
+def render_pixels(scene, origins, directions):
+    count = len(origins)
+
+    color = np.zeros((count, 4), dtype=np.int32)
+
+    # the camera is the origin of every primary ray, so whether it is in shadow is the same for all of them
+    camera_in_shadow = not march_rays(
+        scene,
+        np.array([scene.camera_position], dtype=np.float32),
+        np.array([scene.sun_direction], dtype=np.float32)
+    )["outside"][0]
+
+    shadow_coefficient = np.float32(0.5 if camera_in_shadow else 0.4)
+
+    ray_position = origins.astype(np.float32)
+    ray_direction = directions.astype(np.float32)
+
+    active = np.arange(count)
+
+    for i in range(scene.reflection_depth + 1):
+        if not len(active):
+            break
+
+        hit = march_rays(scene, ray_position[active], ray_direction[active])
+        outside = hit["outside"]
+        inside = ~outside
+
+        current = np.zeros((len(active), 4), dtype=np.int32)
+
+        if outside.any():
+            glow_color = np.broadcast_to(np.array(scene.glow_color, dtype=np.int32), (outside.sum(), 3))
+
+            if sum(scene.glow_color) == 0:
+                trap = _normalize(_orbit_trap(scene, hit["position"][outside]))
+
+                with np.errstate(invalid="ignore"):
+                    glow_color = np.trunc(trap).astype(np.int32) * 255
+
+            glow_mul = (1 - hit["min_distance_to_fractal"][outside]) ** 2
+
+            current[outside, :3] = np.clip(
+                _SKY_COLOR + np.trunc(glow_color * glow_mul[:, None]).astype(np.int32),
+                0,
+                255
+            )
+
+        if inside.any() and scene.render_simple:
+            color_diffusive, _ = _material_colors(scene, hit["position"][inside])
+
+            color_strength = 1 - hit["depth"][inside].astype(np.float32) / scene.ray_steps_limit
+
+            # as in blinn_phong, an orbit trap of zero length normalizes to NaN, whose conversion is undefined
+            with np.errstate(invalid="ignore"):
+                current[inside, :3] = np.trunc(np.clip(color_strength[:, None] * color_diffusive, 0, color_diffusive))
+            current[inside, 3] = 255
+
+        elif inside.any():
+            phong = blinn_phong(
+                scene,
+                hit["position"][inside],
+                hit["normal"][inside],
+                ray_direction[active[inside]],
+                shadow_coefficient
+            )
+
+            fog_mul = 1 - hit["distance"][inside] / 40
+
+            # the kernel adds uchar4 vectors, the sums wrap around
+            phong[:, :3] = np.trunc(phong[:, :3] * fog_mul[:, None]) + np.trunc(255 * (1 - fog_mul))[:, None]
+            phong[:, 3] = 255 + 255
+
+            current[inside] = phong % 256
+
+            ray_direction[active[inside]] = _reflect(ray_direction[active[inside]], hit["normal"][inside])
+            ray_position[active[inside]] = hit["position"][inside] + hit["normal"][inside] * np.float32(scene.epsilon * 2)
+
+        if i == 0:
+            reflected_power = np.where(
+                scene.render_simple | outside,
+                np.float32(1),
+                np.float32(1 - scene.reflected)
+            )
+        else:
+            reflected_power = np.full(len(active), np.float32(scene.reflected) ** i)
+
+        color[active, :3] = (color[active, :3] + np.trunc(reflected_power[:, None] * current[:, :3]).astype(np.int32)) % 256
+
+        if i == 0:
+            color[active, 3] = current[:, 3]
+
+        active = active[~(outside | scene.render_simple | (reflected_power * 255 < 1))]
+
+    return color.astype(np.uint8)
+
+
+def camera_rays(scene, xs, ys, width, height):
+    ratio = np.float32(width / height)
+
+    hx = np.float32(width / 2)
+    hy = np.float32(height / 2)
+
+    x = (xs.astype(np.float32) - hx) / hx * ratio
+    y = -(ys.astype(np.float32) - hy) / hy
+
+    directions = (
+        np.outer(x, scene.camera_right) +
+        np.outer(y, scene.camera_up) +
+        scene.camera_direction * np.float32(scene.camera_zoom)
+    ).astype(np.float32)
+
+    origins = np.broadcast_to(np.array(scene.camera_position, dtype=np.float32), directions.shape)
+
+    return origins, _normalize(directions)
+
+
+def render_tile(scene, image_size, tile_offset, tile_size):
+    # (tile_width, tile_height, RGBA) tile, column by column like the output of the kernel
+    width, height = image_size
+    tile_width, tile_height = tile_size
+
+    xs, ys = np.meshgrid(
+        np.arange(tile_offset[0], tile_offset[0] + tile_width),
+        np.arange(tile_offset[1], tile_offset[1] + tile_height),
+        indexing="ij"
+    )
+
+    origins, directions = camera_rays(scene, xs.ravel(), ys.ravel(), width, height)
+
+    return render_pixels(scene, origins, directions).reshape((tile_width, tile_height, 4))
+
+
+class NumpyRender(Tracked):
+
+    _tracked_attributes = frozenset((
+        "iteration_limit",
+        "ray_steps_limit",
+        "epsilon",
+        "ray_shift_multiplier",
+        "render_simple",
+        "sun_direction",
+        "reflection_depth",
+        "use_orbit_trap"
+    ))
+
+    def __init__(self,
+                 camera: Camera,
+                 width: int = 500, height: int = 500,
+                 iteration_limit=None,
+                 ray_steps_limit=200,
+                 epsilon=0.001,
+                 render_simple=True,
+                 sun_direction=(-1, 1, -1),
+                 reflection_depth=1,
+                 use_orbit_trap=True,
+                 ray_shift_multiplier=1.0,
+                 tile_size=64,
+                 workers: Optional[int] = None):
+
+        self.camera = camera
+
+        self.width = width
+        self.height = height
+
+        self.iteration_limit = iteration_limit
+        self.ray_steps_limit = ray_steps_limit
+        self.epsilon = epsilon
+        self.render_simple = render_simple
+        self.sun_direction = sun_direction
+        self.reflection_depth = reflection_depth
+        self.use_orbit_trap = use_orbit_trap
+        self.ray_shift_multiplier = ray_shift_multiplier
+
+        # tiles are rendered by `workers` processes (all cores by default), 0 renders them in this process
+        self.tile_size = tile_size
+        self.workers = os.cpu_count() if workers is None else workers
+        self._executor = None
+
+        # the fractals are never compiled, they only provide their parameters and NumPy distance estimators
+        self.fractals = [fractal_class(None, None, None, []) for fractal_class in fractals]
+        self.fractal_by_name = {fractal.get_name(): fractal for fractal in self.fractals}
+        self.fractal = self.fractals[0]
+
+        # same layout as the OpenCL host buffer: (width, height, RGBA) flattened
+        self._host_image_buffer = np.zeros(self.width * self.height * 4, dtype=np.uint8)
+
+        # wall time of the last render in seconds
+        self.last_kernel_time = None
+
+    @property
+    def is_ready(self):
+        return True
+
+    def build_fractal(self, fractal):
+        pass
+
+    def get_scene(self) -> NumpyScene:
+        fractal = self.fractal
+        material = fractal.get_material()
+
+        return NumpyScene(
+            fractal_class=type(fractal),
+            parameters=tuple(fractal.get_parameters_values()),
+            iteration_limit=(
+                self.iteration_limit if self.iteration_limit is not None else fractal.get_default_iterations()
+            ),
+            ray_steps_limit=self.ray_steps_limit,
+            epsilon=self.epsilon,
+            ray_shift_multiplier=self.ray_shift_multiplier,
+            render_simple=bool(self.render_simple),
+            sun_direction=tuple(self.sun_direction),
+            reflection_depth=self.reflection_depth,
+            use_orbit_trap=bool(self.use_orbit_trap),
+            glow_color=tuple(fractal.get_glow_color()),
+            glow_sharpness=fractal.get_glow_sharpness(),
+            color_diffusive=tuple(material["color_diffusive"]),
+            color_specular=tuple(material["color_specular"]),
+            diffusive=material["diffusive"],
+            specular=material["specular"],
+            reflected=material["reflected"],
+            camera_position=np.array(self.camera.position, dtype=np.float32),
+            camera_direction=np.array(self.camera.direction, dtype=np.float32),
+            camera_up=np.array(self.camera.up, dtype=np.float32),
+            camera_right=np.array(self.camera.right, dtype=np.float32),
+            camera_zoom=self.camera.zoom
+        )
+
+    def _render_tiles(self, image_size):
+        # yields (tile_offset, tile) pairs covering an image of image_size
+        width, height = image_size
+
+        offsets = [
+            (tile_x, tile_y)
+            for tile_y in range(0, height, self.tile_size)
+            for tile_x in range(0, width, self.tile_size)
+        ]
+        sizes = [
+            (min(self.tile_size, width - tile_x), min(self.tile_size, height - tile_y))
+            for tile_x, tile_y in offsets
+        ]
+
+        scene = self.get_scene()
+
+        if self.workers == 0:
+            tiles = map(render_tile, [scene] * len(offsets), [image_size] * len(offsets), offsets, sizes)
+        else:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self.workers)
+
+            tiles = self._executor.map(render_tile, [scene] * len(offsets), [image_size] * len(offsets), offsets, sizes)
+
+        return zip(offsets, tiles)
+
+    def resize(self, width, height):
+        width = max(1, width)
+        height = max(1, height)
+
+        if (width, height) == (self.width, self.height):
+            return
+
+        self.width = width
+        self.height = height
+
+        self._host_image_buffer = np.zeros(self.width * self.height * 4, dtype=np.uint8)
+
+    def render(self):
+        start = time.perf_counter()
+
+        image = self._host_image_buffer.reshape((self.width, self.height, 4))
+
+        for (tile_x, tile_y), tile in self._render_tiles((self.width, self.height)):
+            image[tile_x:tile_x + tile.shape[0], tile_y:tile_y + tile.shape[1]] = tile
+
+        self.last_kernel_time = time.perf_counter() - start
+
+        return self._host_image_buffer
+
+    def finish(self):
+        pass
+
+    def save(self, path, scale=5, size=None):
+        base_width, base_height = size if size is not None else (self.width, self.height)
+
+        width = base_width * scale
+        height = base_height * scale
+
+        with ImageFile(path, width, height, channels=4) as image:
+            for (tile_x, tile_y), tile in self._render_tiles((width, height)):
+                image[tile_y:tile_y + tile.shape[1], tile_x:tile_x + tile.shape[0]] = tile.transpose((1, 0, 2))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    @property
+    def host_buffer(self):
+        return self._host_image_buffer
@@ -0,0 +1,101 @@
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import pyopencl as cl
+
+
+class FrameProfiler:
+    def __init__(self, capacity: int = 240, path: Optional[str] = None):
+        # the timings of the last `capacity` frames in seconds, one {phase: seconds} dict per frame
+        self.frames = deque(maxlen=capacity)
+
+        # phases in the order they were first recorded, which is the order the HUD lists them in
+        self.phases = []
+
+        self._current = {}
+        self._frame_index = 0
+        self._frame_start = None
+
+        # every finished frame is appended to this file as a line of JSON
+        self._dump = open(path, "a") if path is not None else None
+
+    @contextmanager
+    def measure(self, phase: str):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add(phase, time.perf_counter() - start)
+
+    def add(self, phase: str, seconds: float):
+        if phase not in self.phases:
+            self.phases.append(phase)
+
+        # phases measured several times within a frame are summed up
+        self._current[phase] = self._current.get(phase, 0.0) + seconds
+
+    def add_event(self, phase: str, event: cl.Event):
+        # the event has to be complete and come from a queue created with PROFILING_ENABLE
+        self.add(phase, (event.profile.end - event.profile.start) * 1e-9)
+
+    def end_frame(self):
+        now = time.perf_counter()
+
+        # the time between two calls is the duration of the whole frame
+        if self._frame_start is not None:
+            self.add("frame", now - self._frame_start)
+
+        self._frame_start = now
+
+        if not self._current:
+            return
+
+        self.frames.append(self._current)
+
+        if self._dump is not None:
+            record = {"index": self._frame_index, "time": time.time()}
+            record.update(self._current)
+
+            self._dump.write(json.dumps(record) + "\n")
+
+        self._current = {}
+        self._frame_index += 1
+
+    def get_times(self, phase: str) -> np.ndarray:
+        return np.array([frame[phase] for frame in self.frames if phase in frame])
+
+    def percentiles(self, phase: str, q: Sequence[float] = (50, 95, 99)) -> Optional[np.ndarray]:
+        times = self.get_times(phase)
+
+        return np.percentile(times, q) if len(times) else None
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        summary = {}
+
+        for phase in self.phases:
+            times = self.get_times(phase)
+
+            if not len(times):
+                continue
+
+            p50, p95, p99 = np.percentile(times, (50, 95, 99))
+
+            summary[phase] = {
+                "mean": float(times.mean()),
+                "p50": float(p50),
+                "p95": float(p95),
+                "p99": float(p99),
+                "max": float(times.max())
+            }
+
+        return summary
+
+    def close(self):
+        if self._dump is not None:
+            self._dump.close()
+            self._dump = None
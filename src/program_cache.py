@@ -0,0 +1,211 @@
+import hashlib
+import os
+import tempfile
+from typing import Optional, Sequence
+
+import pyopencl as cl
+
+
+CACHE_DIRECTORY_VARIABLE = "PYFRACTALEXPLORER_CACHE_DIR"
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+# bump when the layout of the cache entries changes
+_FORMAT_VERSION = b"1"
+_MAGIC = b"PFXPROG" + _FORMAT_VERSION + b"\n"
+_EXTENSION = ".bin"
+
+
+def get_default_cache_directory() -> Optional[str]:
+    # an empty PYFRACTALEXPLORER_CACHE_DIR disables the cache
+    directory = os.environ.get(CACHE_DIRECTORY_VARIABLE)
+
+    if directory is not None:
+        return directory or None
+
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+
+    return os.path.join(base, "pyfractalexplorer", "programs")
+
+
+class ProgramCache:
+    def __init__(self, directory: Optional[str] = None, max_size: int = DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def get_key(self, device: cl.Device, source: str, options: Sequence[str] = ()) -> str:
+        digest = hashlib.sha256(_FORMAT_VERSION)
+
+        for part in (
+            source,
+            device.name,
+            device.vendor,
+            device.version,
+            device.driver_version,
+            device.platform.name,
+            device.platform.version,
+            cl.VERSION_TEXT,
+            "\0".join(options)
+        ):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+
+        return digest.hexdigest()
+
+    def build(self,
+              context: cl.Context,
+              device: cl.Device,
+              source: str,
+              options: Sequence[str] = ()) -> cl.Program:
+
+        options = list(options)
+
+        if not self.enabled:
+            return cl.Program(context, source).build(options=options, devices=[device])
+
+        path = os.path.join(self.directory, self.get_key(device, source, options) + _EXTENSION)
+
+        binary = self._load(path)
+
+        if binary is not None:
+            try:
+                program = cl.Program(context, [device], [binary]).build(options=options, devices=[device])
+                self.hits += 1
+                self._touch(path)
+
+                return program
+
+            except (cl.Error, RuntimeError):
+                # a binary the driver refuses is as good as a corrupted one
+                self._remove(path)
+
+        self.misses += 1
+
+        program = cl.Program(context, source).build(options=options, devices=[device])
+
+        binaries = program.get_info(cl.program_info.BINARIES)
+        devices = program.get_info(cl.program_info.DEVICES)
+
+        self._store(path, binaries[devices.index(device)])
+
+        return program
+
+    def clear(self):
+        for path, _, _ in self._entries():
+            self._remove(path)
+
+    # PRIVATE METHODS
+
+    def _load(self, path: str) -> Optional[bytes]:
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        header_size = len(_MAGIC) + hashlib.sha256().digest_size
+        binary = data[header_size:]
+
+        if data[:len(_MAGIC)] != _MAGIC or data[len(_MAGIC):header_size] != hashlib.sha256(binary).digest() or not binary:
+            self._remove(path)
+            return None
+
+        return binary
+
+    def _store(self, path: str, binary: bytes):
+        if not binary:
+            return
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+
+            # written to a temporary file first, so concurrent workers never read a partial entry
+            descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+
+            with os.fdopen(descriptor, "wb") as f:
+                f.write(_MAGIC)
+                f.write(hashlib.sha256(binary).digest())
+                f.write(binary)
+
+            os.replace(temporary_path, path)
+
+        except OSError:
+            return
+
+        self._evict()
+
+    def _entries(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+
+        entries = []
+
+        for name in names:
+            if not name.endswith(_EXTENSION):
+                continue
+
+            path = os.path.join(self.directory, name)
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            entries.append((path, stat.st_mtime, stat.st_size))
+
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        total_size = sum(size for _, _, size in entries)
+
+        # least recently used entries go first, hits refresh the modification time
+        for path, _, size in entries:
+            if total_size <= self.max_size:
+                break
+
+            self._remove(path)
+            total_size -= size
+
+    @staticmethod
+    def _touch(path: str):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+_default_cache = None
+
+
+def get_default_cache() -> ProgramCache:
+    global _default_cache
+
+    if _default_cache is None:
+        _default_cache = ProgramCache(get_default_cache_directory())
+
+    return _default_cache
+
+
+def build_program(context: cl.Context,
+                  device: cl.Device,
+                  source: str,
+                  options: Sequence[str] = ()) -> cl.Program:
+
+    return get_default_cache().build(context, device, source, options)
@@ -0,0 +1,72 @@
+from collections import namedtuple
+from typing import Optional, Sequence
+
+
+# render_simple / reflection_depth of None keep the Render settings, ray_steps_scale multiplies ray_steps_limit
+RefinementStage = namedtuple(
+    "RefinementStage",
+    ["pixel_stride", "render_simple", "ray_steps_scale", "reflection_depth"]
+)
+
+
+DEFAULT_STAGES = (
+    RefinementStage(pixel_stride=4, render_simple=True, ray_steps_scale=0.5, reflection_depth=0),
+    RefinementStage(pixel_stride=2, render_simple=True, ray_steps_scale=1.0, reflection_depth=0),
+    RefinementStage(pixel_stride=1, render_simple=True, ray_steps_scale=1.0, reflection_depth=0),
+    RefinementStage(pixel_stride=1, render_simple=None, ray_steps_scale=1.0, reflection_depth=None)
+)
+
+
+class ProgressiveRefiner:
+    def __init__(self, stages: Sequence[RefinementStage] = DEFAULT_STAGES):
+        # the first stage is used while the scene changes, the following ones refine a still image
+        self.stages = tuple(stages)
+
+        self._scene = None
+        self._stage_index = None
+
+    def reset(self):
+        self._scene = None
+        self._stage_index = None
+
+    @property
+    def is_finished(self):
+        return self._stage_index is not None and self._stage_index >= len(self.stages) - 1
+
+    @property
+    def stage(self) -> Optional[RefinementStage]:
+        return None if self._stage_index is None else self.stages[self._stage_index]
+
+    def next_stage(self, scene) -> Optional[RefinementStage]:
+        # returns None once the final stage of an unchanged scene has been rendered
+        if scene != self._scene:
+            self._scene = scene
+            self._stage_index = 0
+
+        elif self.is_finished:
+            return None
+
+        else:
+            self._stage_index += 1
+
+        return self.stages[self._stage_index]
+
+    def get_skip_stride(self, render_simple, reflection_depth) -> int:
+        # a pass may keep the pixels of the previous one when it only halves the stride at the same quality
+        if not self._stage_index:
+            return 0
+
+        previous = self.stages[self._stage_index - 1]
+        current = self.stages[self._stage_index]
+
+        def quality(stage):
+            return (
+                render_simple if stage.render_simple is None else stage.render_simple,
+                stage.ray_steps_scale,
+                reflection_depth if stage.reflection_depth is None else stage.reflection_depth
+            )
+
+        if previous.pixel_stride == 2 * current.pixel_stride and quality(previous) == quality(current):
+            return previous.pixel_stride
+
+        return 0
@@ -2,13 +2,79 @@ import pyopencl as cl
 import pyopencl.cltypes
 import pyopencl.tools
 import numpy as np
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Optional, Dict, Tuple
 
 from .camera import Camera
 from .fractals import fractals
+from .image_io import ImageFile
+from .progressive import ProgressiveRefiner
+from .statistics import COUNTERS, FrameStatistics
+from .work_group_tuning import get_candidate_local_sizes, pad_global_size
+from .tracking import Tracked
 
 
-class Render:
+def get_channel_shifts(pixel_masks=None, little_endian=True) -> Tuple[int, int, int, int]:
+    # bit offsets of R, G, B and A in the 32-bit pixels the kernel writes, RGBA bytes without pixel masks
+    if pixel_masks is None:
+        return (0, 8, 16, 24) if little_endian else (24, 16, 8, 0)
+
+    shifts = []
+
+    for mask in pixel_masks:
+        shift = int(mask).bit_length() - 8
+
+        if mask and (shift < 0 or shift % 8 or mask != 0xff << shift):
+            raise ValueError("Pixel masks {} are not a packed 32-bit format with 8-bit channels".format(
+                tuple(hex(mask) for mask in pixel_masks)
+            ))
+
+        shifts.append(shift if mask else None)
+
+    # the alpha of formats without one goes into the unused byte
+    unused = [shift for shift in (0, 8, 16, 24) if shift not in shifts]
+
+    return tuple(shift if shift is not None else unused.pop(0) for shift in shifts)
+
+
+class FrameSnapshot:
+    # device copies of the uniforms and frame constants of the current frame and a render kernel of its own, so that
+    # the frame can be rendered on another thread and queue while the render loop uploads the next ones
+
+    def __init__(self, render: "Render"):
+        fractal = render.fractal
+
+        self.kernel = fractal.create_render_function()
+        self.local_size = render._local_sizes.get((fractal, render._get_quality_mode()))
+
+        self.uniforms = cl.Buffer(render.context, cl.mem_flags.READ_ONLY, fractal.get_uniforms_buffer().size)
+        self.frame_constants = cl.Buffer(
+            render.context,
+            cl.mem_flags.READ_ONLY,
+            fractal.get_frame_constants_buffer().size
+        )
+
+        # the copies follow the upload of the frame on the render queue, renders of the snapshot wait for them
+        self.events = [
+            cl.enqueue_copy(render.queue, self.uniforms, fractal.get_uniforms_buffer()),
+            cl.enqueue_copy(render.queue, self.frame_constants, fractal.get_frame_constants_buffer())
+        ]
+
+
+class Render(Tracked):
+
+    _tracked_attributes = frozenset((
+        "iteration_limit",
+        "ray_steps_limit",
+        "epsilon",
+        "ray_shift_multiplier",
+        "render_simple",
+        "sun_direction",
+        "reflection_depth",
+        "use_orbit_trap"
+    ))
 
     quality_props = np.dtype([
         ("iteration_limit", cl.cltypes.int),
@@ -36,7 +102,18 @@ class Render:
                  sun_direction=(-1, 1, -1),
                  reflection_depth=1,
                  use_orbit_trap=True,
-                 ray_shift_multiplier=1.0):
+                 ray_shift_multiplier=1.0,
+                 frames_in_flight=1,
+                 tile_size=256,
+                 screenshot_workers=2,
+                 build_in_background=False,
+                 progressive=False,
+                 temporal_reprojection=False,
+                 cone_tile_size=0,
+                 profiler=None,
+                 work_group_tuner=None,
+                 row_major=False,
+                 pixel_masks=None):
 
         self.device = device
         self.context = context
@@ -55,6 +132,66 @@ class Render:
 
         self.camera = camera
 
+        # with more than one frame in flight the kernel of the next frame runs while the previous
+        # one is read back (on a separate queue) and presented
+        self.frames_in_flight = max(1, frames_in_flight)
+        self._readback_queue = self.queue if self.frames_in_flight == 1 else cl.CommandQueue(
+            self.context,
+            self.device,
+            properties=self.queue.properties
+        )
+        self._pending_frames = deque()
+
+        # render and readback events of the band submitted with submit_band, until wait_band
+        self._band_events = None
+        self._next_frame_slot = 0
+        self._size_changed = False
+
+        # kernel execution time of the last presented frame in seconds, needs a profiling queue
+        self.last_kernel_time = None
+
+        # an optional FrameProfiler that gets the upload, wait, kernel and readback times of every frame
+        self.profiler = profiler
+
+        # in the progressive mode a changing scene is rendered coarsely, a still one is refined over the following
+        # frames in a persistent image buffer and not rendered at all once the final stage is reached
+        self.progressive = ProgressiveRefiner() if progressive else None
+        self._stage = None
+        self._accumulation_readback_event = None
+
+        # with temporal reprojection every frame keeps its primary hit distances, the next one projects them
+        # into its own view and starts each primary ray that far from the camera
+        self.temporal_reprojection = temporal_reprojection
+        self._depth_index = 0
+        self._depth_key = None
+
+        # a non-zero cone_tile_size marches one cone per square tile of that many pixels first, which gives
+        # every pixel of the tile a distance its ray can skip. Rays that start there take other steps than from the
+        # camera, so the shading changes (see the README), it is off by default
+        self.cone_tile_size = cone_tile_size
+
+        # with a WorkGroupTuner the render kernel is launched with the fastest local size measured for the
+        # device, fractal and quality mode, the first frame of each of them benchmarks the candidates
+        self.work_group_tuner = work_group_tuner
+        self._local_sizes = {}
+
+        # screenshots are rendered tile by tile through one reusable buffer, allocated on first use
+        self.tile_size = tile_size
+
+        # save_async renders screenshots on a queue of their own and encodes them on these threads
+        self.screenshot_workers = max(1, screenshot_workers)
+        self._screenshot_executor = None
+        self._screenshot_queue = None
+
+        # frames are stored column by column (width, height) by default or row by row (height, width), every pixel
+        # as RGBA bytes or packed with the (R, G, B, A) masks of a 32-bit format, e.g. the one of a pygame surface
+        self.row_major = row_major
+        self.pixel_masks = pixel_masks
+        self._channel_shifts = get_channel_shifts(pixel_masks, self.device.endian_little)
+        self._rgba_shifts = get_channel_shifts(None, self.device.endian_little)
+        self._host_tile_buffer = None
+        self._tile_buffer = None
+
         self._quality_props_dtype, self._quality_props_decl = cl.tools.match_dtype_to_c_struct(
             self.device,
             "QualityProps",
@@ -76,120 +213,695 @@ class Render:
 
         self.fractal_by_name = {fractal.get_name(): fractal for fractal in self.fractals}
 
+        # (render, camera, fractal) versions of the uniforms last uploaded for every fractal
+        self._uploaded_versions = {}
+
         self.fractal = self.fractals[0]
 
+        # programs are compiled when a fractal is first rendered. In the background mode a placeholder
+        # frame is presented until the program is ready and the neighbouring fractals are compiled ahead
+        self.build_in_background = build_in_background
+        self._build_executor = None
+        self._builds = {}
+
+        self._allocate_image_buffers()
+
+    def _allocate_image_buffers(self):
+        # buffers keep their capacity when the render resolution shrinks, smaller frames use a prefix of them
+        self._image_capacity = self.width * self.height * 4
+
+        # the frames are rendered into host accessible memory and mapped instead of copied to the host,
+        # each slot stays mapped from its readback until it is rendered into again
+        self._image_buffers = [
+            cl.Buffer(
+                self.context,
+                cl.mem_flags.READ_WRITE | cl.mem_flags.ALLOC_HOST_PTR,
+                self._image_capacity
+            )
+            for _ in range(self.frames_in_flight)
+        ]
+        self._host_image_buffers = [None] * self.frames_in_flight
+        self._readback_events = [None] * self.frames_in_flight
+        self._render_events = [None] * self.frames_in_flight
+
+        if self.progressive is not None:
+            self._accumulation_buffer = cl.Buffer(self.context, cl.mem_flags.READ_WRITE, self._image_capacity)
+            self._accumulation_readback_event = None
+
+        if self.temporal_reprojection:
+            # one float (depth) or int (start distance) per pixel takes as much space as an RGBA pixel
+            self._depth_buffers = [
+                cl.Buffer(self.context, cl.mem_flags.READ_WRITE, self._image_capacity)
+                for _ in range(2)
+            ]
+            self._start_distances_buffer = cl.Buffer(self.context, cl.mem_flags.READ_WRITE, self._image_capacity)
+            self._depth_camera_buffer = cl.Buffer(
+                self.context,
+                cl.mem_flags.READ_WRITE,
+                cl.tools.get_or_register_dtype("Camera").itemsize
+            )
+            self._depth_key = None
+
+        # allocated on first use, so that the cone prepass can be switched on at any time
+        self._cone_buffer = None
+        self._cone_capacity = 0
+
+        # presented until the first frame comes back
         self._host_image_buffer = np.zeros(self.width * self.height * 4, dtype=np.uint8)
-        self._host_large_image_buffer = np.zeros(self.width * 5 * self.height * 5 * 4, dtype=np.uint8)
+        self._host_placeholder_buffer = None
+
+    def _map_image(self, slot, byte_count, wait_for=None):
+        self._host_image_buffers[slot], event = cl.enqueue_map_buffer(
+            self._readback_queue,
+            self._image_buffers[slot],
+            cl.map_flags.READ,
+            0,
+            (byte_count, ),
+            np.uint8,
+            wait_for=wait_for,
+            is_blocking=False
+        )
 
-        self._image_buffer = cl.Buffer(
-            self.context,
-            cl.mem_flags.READ_WRITE,
-            self._host_image_buffer.nbytes
+        return event
+
+    def _unmap_image(self, slot, wait_for=None):
+        # the host view of the slot is invalid afterwards, so its frame has to be presented (or copied) by now
+        host_image_buffer = self._host_image_buffers[slot]
+
+        if host_image_buffer is None:
+            return
+
+        self._host_image_buffers[slot] = None
+
+        if host_image_buffer is self._host_image_buffer:
+            self._host_image_buffer = None
+
+        host_image_buffer.base.release(self.queue, wait_for=wait_for)
+
+    def _unmap_images(self):
+        for slot in range(len(self._image_buffers)):
+            self._unmap_image(slot)
+
+    def present_placeholder(self):
+        self.finish()
+
+        if self._host_placeholder_buffer is None or self._host_placeholder_buffer.size != self.width * self.height * 4:
+            sky = sum(channel << shift for channel, shift in zip((135, 206, 235, 255), self._channel_shifts))
+
+            self._host_placeholder_buffer = np.full(self.width * self.height, sky, dtype=np.uint32).view(np.uint8)
+
+        self._host_image_buffer = self._host_placeholder_buffer
+
+        return self._host_image_buffer
+
+    def build_fractal_async(self, fractal):
+        if fractal.is_built:
+            return None
+
+        if fractal not in self._builds:
+            if self._build_executor is None:
+                self._build_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fractal-build")
+
+            self._builds[fractal] = self._build_executor.submit(fractal.build)
+
+        return self._builds[fractal]
+
+    def build_fractal(self, fractal):
+        build = self._builds.get(fractal)
+
+        if build is not None:
+            # re-raises compilation errors of the background build
+            build.result()
+
+        fractal.build()
+
+    def prefetch_neighbours(self, distance=1):
+        index = self.fractals.index(self.fractal)
+
+        for shift in range(1, distance + 1):
+            self.build_fractal_async(self.fractals[(index + shift) % len(self.fractals)])
+            self.build_fractal_async(self.fractals[(index - shift) % len(self.fractals)])
+
+    @property
+    def is_ready(self):
+        return self.fractal.is_built
+
+    def ensure_ready(self):
+        if self.fractal.is_built:
+            return True
+
+        if not self.build_in_background:
+            self.build_fractal(self.fractal)
+            return True
+
+        build = self.build_fractal_async(self.fractal)
+
+        if build is not None and build.done():
+            build.result()
+
+        return self.fractal.is_built
+
+    def resize(self, width, height):
+        width = max(1, width)
+        height = max(1, height)
+
+        if (width, height) == (self.width, self.height):
+            return
+
+        self.finish()
+
+        self.width = width
+        self.height = height
+
+        if self.width * self.height * 4 > self._image_capacity:
+            self._unmap_images()
+            self._allocate_image_buffers()
+
+        # the next render waits for its own frame instead of presenting one of the old size
+        self._size_changed = True
+        self._depth_key = None
+
+    def _write_quality_props(self, quality_props_instance):
+        stage = self._stage
+
+        quality_props_instance["iteration_limit"] = (
+            self.iteration_limit if self.iteration_limit is not None else self.fractal.get_default_iterations()
         )
-        self._large_image_buffer = cl.Buffer(
-            self.context,
-            cl.mem_flags.READ_WRITE,
-            self._host_large_image_buffer.nbytes
+        quality_props_instance["ray_steps_limit"] = (
+            self.ray_steps_limit if stage is None else max(1, int(self.ray_steps_limit * stage.ray_steps_scale))
+        )
+        quality_props_instance["epsilon"] = self.epsilon
+        quality_props_instance["ray_shift_multiplier"] = self.ray_shift_multiplier
+        quality_props_instance["render_simple"] = (
+            self.render_simple if stage is None or stage.render_simple is None else stage.render_simple
+        )
+        quality_props_instance["sun_direction"] = tuple(self.sun_direction) + (0, )
+        quality_props_instance["reflection_depth"] = (
+            self.reflection_depth if stage is None or stage.reflection_depth is None else stage.reflection_depth
         )
+        quality_props_instance["use_orbit_trap"] = self.use_orbit_trap
+        quality_props_instance["glow_color"] = tuple(self.fractal.get_glow_color()) + (0, )
+        quality_props_instance["glow_sharpness"] = self.fractal.get_glow_sharpness()
 
-        self._quality_props_buffer = cl.Buffer(
-            self.context,
-            cl.mem_flags.READ_ONLY,
-            self._quality_props_dtype.itemsize
+    def sync_with_device(self):
+        versions = (self.version, self.camera.version, self.fractal.version, self._stage)
+
+        if self._uploaded_versions.get(self.fractal) == versions:
+            return
+
+        uniforms = self.fractal.get_uniforms()
+
+        self.camera.write_uniforms(uniforms["camera"])
+        self._write_quality_props(uniforms["quality_props"])
+        self.fractal.write_uniforms(uniforms)
+
+        self.fractal.upload_uniforms(self.queue)
+
+        self._uploaded_versions[self.fractal] = versions
+
+    def _enqueue_render(self,
+                        queue,
+                        output,
+                        image_size,
+                        tile_offset=(0, 0),
+                        tile_size=None,
+                        pixel_stride=1,
+                        skip_stride=0,
+                        depth_output=None,
+                        start_distances=None,
+                        tile_start_distances=None,
+                        statistics_output=None,
+                        row_major=None,
+                        channel_shifts=None,
+                        snapshot=None,
+                        wait_for=None):
+
+        width, height = image_size
+        tile_width, tile_height = tile_size if tile_size is not None else image_size
+
+        # the instrumented program takes the buffer of the per-pixel counters as an extra argument
+        if snapshot is not None:
+            kernel, extra_arguments = snapshot.kernel, ()
+        elif statistics_output is None:
+            kernel, extra_arguments = self.fractal.render_function, ()
+        else:
+            kernel, extra_arguments = self.fractal.statistics_render_function, (statistics_output, )
+
+        if snapshot is not None:
+            uniforms, frame_constants = snapshot.uniforms, snapshot.frame_constants
+            wait_for = list(wait_for or ()) + snapshot.events
+        else:
+            uniforms, frame_constants = self.fractal.get_uniforms_buffer(), self.fractal.get_frame_constants_buffer()
+
+        global_size = (-(-tile_width // pixel_stride), -(-tile_height // pixel_stride))
+
+        arguments = (
+            uniforms,
+            output,
+            frame_constants,
+            np.int32(tile_offset[0]),
+            np.int32(tile_offset[1]),
+            np.int32(width),
+            np.int32(height),
+            np.int32(tile_width),
+            np.int32(tile_height),
+            np.int32(pixel_stride),
+            np.int32(skip_stride),
+            depth_output,
+            start_distances,
+            tile_start_distances,
+            np.int32(self.cone_tile_size or 1),
+            np.int32(self.row_major if row_major is None else row_major),
+            cl.cltypes.make_uint4(*(self._channel_shifts if channel_shifts is None else channel_shifts)),
+            *extra_arguments
         )
 
-        self.sync_with_device()
+        def launch(local_size):
+            return kernel(
+                queue,
+                pad_global_size(global_size, local_size),
+                local_size,
+                *arguments,
+                wait_for=wait_for
+            )
 
-    def resize(self, width, height):
-        self.width = max(1, width)
-        self.height = max(1, height)
+        local_size = None
 
-        self._host_image_buffer = np.zeros(self.width * self.height * 4, dtype=np.uint8)
-        self._image_buffer = cl.Buffer(
-            self.context,
-            cl.mem_flags.READ_ONLY,
-            self._host_image_buffer.nbytes
+        if snapshot is not None:
+            local_size = snapshot.local_size
+        elif self.work_group_tuner is not None and statistics_output is None:
+            local_size = self._get_local_size(launch)
+
+        return launch(local_size)
+
+    def _get_quality_mode(self):
+        return "simple" if self.render_simple else "phong-{}".format(self.reflection_depth)
+
+    def _get_local_size(self, launch):
+        mode = self._get_quality_mode()
+
+        if (self.fractal, mode) not in self._local_sizes:
+            key = self.work_group_tuner.get_key(self.device, self.fractal.source, mode)
+
+            # the candidates are measured on the launch that needs the local size first
+            self._local_sizes[self.fractal, mode] = self.work_group_tuner.tune(
+                key,
+                get_candidate_local_sizes(self.fractal.render_function, self.device),
+                launch
+            )
+
+        return self._local_sizes[self.fractal, mode]
+
+    def _run_cone_prepass(self):
+        tiles = (-(-self.width // self.cone_tile_size), -(-self.height // self.cone_tile_size))
+
+        # one float start distance per tile
+        size = tiles[0] * tiles[1] * 4
+
+        if size > self._cone_capacity:
+            self._cone_buffer = cl.Buffer(self.context, cl.mem_flags.READ_WRITE, size)
+            self._cone_capacity = size
+
+        self.fractal.cone_prepass_function(
+            self.queue,
+            tiles,
+            None,
+            self.fractal.get_uniforms_buffer(),
+            self._cone_buffer,
+            np.int32(self.width),
+            np.int32(self.height),
+            np.int32(self.cone_tile_size)
         )
 
-    def sync_with_device(self):
-        quality_props_instance = np.array([(
-            self.iteration_limit if self.iteration_limit is not None else self.fractal.get_default_iterations(),
-            self.ray_steps_limit,
-            self.epsilon,
-            self.ray_shift_multiplier,
-            self.render_simple,
-            self.sun_direction + (0, ),
-            self.reflection_depth,
-            self.use_orbit_trap,
-            self.fractal.get_glow_color() + (0, ),
-            self.fractal.get_glow_sharpness()
-        )], dtype=self._quality_props_dtype)[0]
-
-        event = cl.enqueue_copy(self.queue, self._quality_props_buffer, quality_props_instance)
-        event.wait()
-
-        self.camera.sync_with_device()
-        self.fractal.sync_with_device()
+        return self._cone_buffer
+
+    def _reproject_depth(self, depth_key):
+        # returns the buffer of start distances for this frame, None when the previous depth does not apply
+        if self._depth_key != depth_key:
+            return None
 
-    def render(self):
         self.sync_with_device()
 
-        render_event = self.fractal.render_function(
+        cl.enqueue_fill_buffer(
+            self.queue,
+            self._start_distances_buffer,
+            np.int32(np.iinfo(np.int32).max),
+            0,
+            self.width * self.height * 4
+        )
+
+        self.fractal.reproject_function(
             self.queue,
             (self.width, self.height),
             None,
-            self.camera.buffer,
-            self._quality_props_buffer,
-            self.fractal.get_parameters_buffer(),
-            self.fractal.get_material_buffer(),
-            self._image_buffer
+            self._depth_camera_buffer,
+            self.fractal.get_uniforms_buffer(),
+            self._depth_buffers[1 - self._depth_index],
+            self._start_distances_buffer,
+            np.int32(self.width),
+            np.int32(self.height)
         )
 
-        render_event.wait()
+        return self._start_distances_buffer
+
+    def _copy_depth_camera(self):
+        # the camera the depth of this frame is rendered with, which the next frame reprojects it from. The uniforms
+        # can't be read then, screenshots, depth and statistics renders upload newer cameras between frames
+        camera_dtype, camera_offset = self.fractal.get_uniforms_dtype().fields["camera"][:2]
 
         cl.enqueue_copy(
             self.queue,
-            self._host_image_buffer,
-            self._image_buffer
-        ).wait()
+            self._depth_camera_buffer,
+            self.fractal.get_uniforms_buffer(),
+            byte_count=camera_dtype.itemsize,
+            src_offset=camera_offset
+        )
 
-        self.queue.finish()
+    def submit_frame(self):
+        if not self.fractal.is_built:
+            self.build_fractal(self.fractal)
 
-    def save(self, path):
-        self.sync_with_device()
+        slot = self._next_frame_slot
+        self._next_frame_slot = (slot + 1) % self.frames_in_flight
+
+        # the image buffer of this slot may only be overwritten once its previous readback is done
+        previous_readback = self._readback_events[slot]
+
+        self._unmap_image(slot, wait_for=[previous_readback] if previous_readback is not None else None)
+
+        if self._stage is None:
+            output = self._image_buffers[slot]
+            pixel_stride, skip_stride = 1, 0
+        else:
+            # refinement passes build on the previous ones, so they all go through one persistent buffer
+            output = self._accumulation_buffer
+            previous_readback = self._accumulation_readback_event
+            pixel_stride = self._stage.pixel_stride
+            skip_stride = self.progressive.get_skip_stride(self.render_simple, self.reflection_depth)
+
+        depth_output = None
+        start_distances = None
+
+        # coarse passes share one depth per block, which is not a safe start distance for its other pixels
+        if self.temporal_reprojection and pixel_stride == 1 and skip_stride == 0:
+            depth_key = (self.fractal, self.fractal.version, self.width, self.height, self.iteration_limit)
 
-        render_event = self.fractal.render_function(
+            start_distances = self._reproject_depth(depth_key)
+            depth_output = self._depth_buffers[self._depth_index]
+
+            self._depth_index = 1 - self._depth_index
+            self._depth_key = depth_key
+        else:
+            self._depth_key = None
+
+        with self._measure("upload"):
+            self.sync_with_device()
+
+        if depth_output is not None:
+            self._copy_depth_camera()
+
+        tile_start_distances = self._run_cone_prepass() if self.cone_tile_size else None
+
+        render_event = self._enqueue_render(
             self.queue,
-            (self.width * 5, self.height * 5),
-            None,
-            self.camera.buffer,
-            self._quality_props_buffer,
-            self.fractal.get_parameters_buffer(),
-            self.fractal.get_material_buffer(),
-            self._large_image_buffer
+            output,
+            (self.width, self.height),
+            pixel_stride=pixel_stride,
+            skip_stride=skip_stride,
+            depth_output=depth_output,
+            start_distances=start_distances,
+            tile_start_distances=tile_start_distances,
+            wait_for=[previous_readback] if previous_readback is not None else None
         )
+        self.queue.flush()
 
-        render_event.wait()
+        self._render_events[slot] = render_event
 
-        cl.enqueue_copy(
+        byte_count = self.width * self.height * 4
+        readback_wait_for = [render_event]
+
+        if self._stage is not None:
+            # the accumulated image is copied to the slot on the device, the following passes keep refining it
+            self._accumulation_readback_event = cl.enqueue_copy(
+                self._readback_queue,
+                self._image_buffers[slot],
+                output,
+                byte_count=byte_count,
+                wait_for=readback_wait_for
+            )
+            readback_wait_for = [self._accumulation_readback_event]
+
+        self._readback_events[slot] = self._map_image(slot, byte_count, wait_for=readback_wait_for)
+        self._readback_queue.flush()
+
+        self._pending_frames.append(slot)
+
+    def wait_frame(self):
+        slot = self._pending_frames.popleft()
+
+        with self._measure("wait"):
+            self._readback_events[slot].wait()
+
+        if self.queue.properties & cl.command_queue_properties.PROFILING_ENABLE:
+            profile = self._render_events[slot].profile
+            self.last_kernel_time = (profile.end - profile.start) * 1e-9
+
+            # with several frames in flight these belong to an earlier frame than the host timings
+            if self.profiler is not None:
+                self.profiler.add("kernel", self.last_kernel_time)
+                self.profiler.add_event("readback", self._readback_events[slot])
+
+        self._host_image_buffer = self._host_image_buffers[slot]
+
+        return self._host_image_buffer
+
+    def submit_band(self, first_row, rows):
+        # renders rows [first_row, first_row + rows) of the current frame into the first image buffer and maps them,
+        # without waiting, so that several renders (e.g. one per device) can have their bands in flight at once
+        if self._band_events is not None:
+            self.wait_band()
+
+        self.finish()
+        self.sync_with_device()
+
+        self._unmap_image(0)
+
+        render_event = self._enqueue_render(
             self.queue,
-            self._host_large_image_buffer,
-            self._large_image_buffer
-        ).wait()
+            self._image_buffers[0],
+            (self.width, self.height),
+            tile_offset=(0, first_row),
+            tile_size=(self.width, rows)
+        )
+        self.queue.flush()
+
+        readback_event = self._map_image(0, self.width * rows * 4, wait_for=[render_event])
+        self._readback_queue.flush()
+
+        self._band_events = (render_event, readback_event)
+
+    def wait_band(self) -> np.ndarray:
+        # the band of the last submit_band in the frame layout: rows * width pixels in the row-major layout,
+        # width columns of rows pixels otherwise. It stays valid until the next band or frame is rendered
+        render_event, readback_event = self._band_events
+        self._band_events = None
+
+        readback_event.wait()
+
+        if self.queue.properties & cl.command_queue_properties.PROFILING_ENABLE:
+            self.last_kernel_time = (render_event.profile.end - render_event.profile.start) * 1e-9
+
+        return self._host_image_buffers[0]
+
+    def _measure(self, phase):
+        return self.profiler.measure(phase) if self.profiler is not None else nullcontext()
+
+    def finish(self):
+        while self._pending_frames:
+            self.wait_frame()
+
+    def close(self):
+        self.finish()
+        self._unmap_images()
+
+        if self._build_executor is not None:
+            self._build_executor.shutdown()
+            self._build_executor = None
+
+        # screenshots still on their way are finished
+        if self._screenshot_executor is not None:
+            self._screenshot_executor.shutdown()
+            self._screenshot_executor = None
+
+    def render(self):
+        if not self.ensure_ready():
+            return self.present_placeholder()
+
+        if self.build_in_background:
+            self.prefetch_neighbours()
+
+        if self.progressive is not None:
+            self._stage = self.progressive.next_stage(
+                (self.version, self.camera.version, self.fractal, self.fractal.version, self.width, self.height)
+            )
+
+            if self._stage is None:
+                # the final stage of this scene is already on its way to (or in) the host buffer
+                self.finish()
+                return self._host_image_buffer
 
-        self.queue.finish()
+        self.submit_frame()
 
-        from PIL import Image
+        if self._size_changed:
+            self._size_changed = False
+            self.finish()
 
-        image = Image\
-            .fromarray(
-                self._host_large_image_buffer.reshape(
-                    (self.width * 5, self.height * 5, 4)
+        # keeps up to frames_in_flight - 1 frames queued behind the one being presented
+        while len(self._pending_frames) >= self.frames_in_flight:
+            self.wait_frame()
+
+        return self._host_image_buffer
+
+    def _allocate_tile_buffers(self):
+        if self._tile_buffer is not None and self._host_tile_buffer.size == self.tile_size * self.tile_size * 4:
+            return
+
+        self._host_tile_buffer = np.zeros(self.tile_size * self.tile_size * 4, dtype=np.uint8)
+        self._tile_buffer = cl.Buffer(
+            self.context,
+            cl.mem_flags.WRITE_ONLY,
+            self._host_tile_buffer.nbytes
+        )
+
+    def save(self, path, scale=5, size=None):
+        self.build_fractal(self.fractal)
+        self.finish()
+
+        # screenshots always use the full quality, whatever the refinement stage of the last frame
+        self._stage = None
+        self.sync_with_device()
+        self._allocate_tile_buffers()
+
+        # size is the base resolution of the screenshot, by default the current render resolution
+        base_width, base_height = size if size is not None else (self.width, self.height)
+
+        with ImageFile(path, base_width * scale, base_height * scale, channels=4) as image:
+            self._render_tiles(self.queue, image, self.tile_size, self._tile_buffer, self._host_tile_buffer)
+
+    def save_async(self, path, scale=5, size=None, callback=None) -> Future:
+        # only the snapshot of the current frame is taken on the calling thread, the tiles are rendered on a queue of
+        # their own and the image is encoded by the screenshot workers. callback(path, error) runs on a worker
+        self.build_fractal(self.fractal)
+
+        self._stage = None
+        self.sync_with_device()
+
+        snapshot = FrameSnapshot(self)
+
+        base_width, base_height = size if size is not None else (self.width, self.height)
+
+        if self._screenshot_executor is None:
+            self._screenshot_queue = cl.CommandQueue(self.context, self.device)
+            self._screenshot_executor = ThreadPoolExecutor(
+                max_workers=self.screenshot_workers,
+                thread_name_prefix="screenshot"
+            )
+
+        future = self._screenshot_executor.submit(
+            self._save_snapshot,
+            path,
+            snapshot,
+            base_width * scale,
+            base_height * scale,
+            self.tile_size
+        )
+
+        if callback is not None:
+            future.add_done_callback(lambda done: callback(path, done.exception()))
+
+        return future
+
+    def _save_snapshot(self, path, snapshot, width, height, tile_size):
+        # every job has tile buffers of its own, so that several screenshots can be in progress at once
+        host_tile_buffer = np.zeros(tile_size * tile_size * 4, dtype=np.uint8)
+        tile_buffer = cl.Buffer(self.context, cl.mem_flags.WRITE_ONLY, host_tile_buffer.nbytes)
+
+        with ImageFile(path, width, height, channels=4) as image:
+            self._render_tiles(self._screenshot_queue, image, tile_size, tile_buffer, host_tile_buffer, snapshot)
+
+        return path
+
+    def _render_tiles(self, queue, image, tile_size, tile_buffer, host_tile_buffer, snapshot=None):
+        height, width = image.shape[:2]
+
+        for tile_y in range(0, height, tile_size):
+            for tile_x in range(0, width, tile_size):
+                tile_width = min(tile_size, width - tile_x)
+                tile_height = min(tile_size, height - tile_y)
+
+                # tiles are rendered as RGBA rows, so they go into the image without a transpose
+                render_event = self._enqueue_render(
+                    queue,
+                    tile_buffer,
+                    (width, height),
+                    tile_offset=(tile_x, tile_y),
+                    tile_size=(tile_width, tile_height),
+                    row_major=True,
+                    channel_shifts=self._rgba_shifts,
+                    snapshot=snapshot
                 )
-            )\
-            .transpose(Image.ROTATE_90)\
-            .transpose(Image.FLIP_TOP_BOTTOM)
-        image.save(path)
+
+                host_tile = host_tile_buffer[:tile_width * tile_height * 4]
+
+                cl.enqueue_copy(queue, host_tile, tile_buffer, wait_for=[render_event])
+
+                image[tile_y:tile_y + tile_height, tile_x:tile_x + tile_width] = host_tile\
+                    .reshape((tile_height, tile_width, 4))
+
+    def render_depth(self) -> np.ndarray:
+        # (height, width) distances from the camera to the surface hit by the primary rays, 1e20 for the sky
+        self.build_fractal(self.fractal)
+        self.finish()
+
+        self._stage = None
+        self.sync_with_device()
+
+        depth = np.zeros((self.height, self.width), dtype=np.float32)
+
+        output = cl.Buffer(self.context, cl.mem_flags.WRITE_ONLY, self.width * self.height * 4)
+        depth_buffer = cl.Buffer(self.context, cl.mem_flags.WRITE_ONLY, depth.nbytes)
+
+        render_event = self._enqueue_render(self.queue, output, (self.width, self.height), depth_output=depth_buffer)
+
+        cl.enqueue_copy(self.queue, depth, depth_buffer, wait_for=[render_event])
+
+        return depth
+
+    def render_statistics(self) -> FrameStatistics:
+        # renders the current view at full quality with the instrumented program, the image itself is discarded
+        self.build_fractal(self.fractal)
+        self.fractal.build_statistics()
+        self.finish()
+
+        self._stage = None
+        self.sync_with_device()
+
+        counters = np.zeros((len(COUNTERS), self.height, self.width), dtype=np.uint32)
+
+        output = cl.Buffer(self.context, cl.mem_flags.WRITE_ONLY, self.width * self.height * 4)
+        counters_buffer = cl.Buffer(self.context, cl.mem_flags.WRITE_ONLY, counters.nbytes)
+
+        render_event = self._enqueue_render(
+            self.queue,
+            output,
+            (self.width, self.height),
+            tile_start_distances=self._run_cone_prepass() if self.cone_tile_size else None,
+            statistics_output=counters_buffer
+        )
+
+        cl.enqueue_copy(self.queue, counters, counters_buffer, wait_for=[render_event])
+
+        return FrameStatistics(counters)
 
     @property
     def cl_type_declaration(self):
@@ -0,0 +1,641 @@
+import argparse
+import asyncio
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from time import perf_counter
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .image_io import encode_png
+from .renderer import Renderer, create_renderer, get_argument_parser
+
+
+_FORMATS = {"png": "image/png", "raw": "application/octet-stream"}
+
+_MAX_BODY_SIZE = 1 << 16
+
+# the type of every quality property and the smallest value it may have, numbers without a minimum have to be
+# positive. Only the iteration limit may be null, which is the default of the fractal
+_QUALITY_TYPES = {
+    "iteration_limit": (int, 1),
+    "ray_steps_limit": (int, 1),
+    "epsilon": (float, None),
+    "ray_shift_multiplier": (float, None),
+    "render_simple": (bool, None),
+    "sun_direction": (tuple, None),
+    "reflection_depth": (int, 0),
+    "use_orbit_trap": (bool, None)
+}
+
+
+class ServiceError(Exception):
+    def __init__(self, status: HTTPStatus, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class RenderJob:
+    # a validated request, rendered by the first free device. The future is cancelled when the client goes away
+    # or the job times out, a device skips the job if that happens before it gets to it
+
+    def __init__(self,
+                 spec: dict,
+                 default_fractal: str,
+                 fractal_parameters: Dict[str, dict],
+                 max_pixels: int,
+                 camera_positions: Dict[str, np.ndarray],
+                 world_up: np.ndarray):
+
+        if not isinstance(spec, dict):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "expected a JSON object")
+
+        unknown = set(spec) - {
+            "fractal", "width", "height", "camera", "parameters", "color", "quality", "time", "amplitude", "format",
+            "timeout"
+        }
+
+        if unknown:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "unknown fields: {}".format(", ".join(sorted(unknown))))
+
+        self.fractal = spec.get("fractal", default_fractal)
+
+        if self.fractal not in fractal_parameters:
+            raise ServiceError(HTTPStatus.NOT_FOUND, "unknown fractal {!r}, expected one of: {}".format(
+                self.fractal, ", ".join(fractal_parameters)))
+
+        self.width = _get_number(spec, "width", int, 500)
+        self.height = _get_number(spec, "height", int, 500)
+
+        if self.width < 1 or self.height < 1:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "width and height have to be positive")
+
+        if self.width * self.height > max_pixels:
+            raise ServiceError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "at most {} pixels per job".format(max_pixels))
+
+        camera = _get_object(spec, "camera")
+        self.position = _get_vector(camera, "position")
+        self.target = _get_vector(camera, "target")
+        self.direction = _get_vector(camera, "direction")
+        self.zoom = _get_number(camera, "zoom", float, 1.0)
+
+        # a job that doesn't set the position looks from the initial one of the fractal
+        _check_view(
+            self.position if self.position is not None else camera_positions[self.fractal],
+            self.target,
+            self.direction,
+            world_up
+        )
+
+        # parameters that aren't given keep the defaults of the fractal, whatever the previous job used
+        defaults = fractal_parameters[self.fractal]
+        parameters = _get_object(spec, "parameters")
+
+        if set(parameters) - set(defaults):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "unknown parameters of {}: {}".format(
+                self.fractal, ", ".join(sorted(set(parameters) - set(defaults)))))
+
+        self.parameters = {name: _get_number(parameters, name, type(value), value) for name, value in defaults.items()}
+
+        self.color = _get_vector(spec, "color", int)
+
+        if self.color is not None and not all(0 <= component <= 255 for component in self.color):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "the components of color have to be between 0 and 255")
+
+        # quality properties that aren't given are reset to the ones the service was started with
+        quality = _get_object(spec, "quality")
+        unknown = set(quality) - set(_QUALITY_TYPES)
+
+        if unknown:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "unknown quality properties: {}".format(
+                ", ".join(sorted(unknown))))
+
+        self.quality = {name: _get_quality(quality, name) for name in quality}
+
+        self.time = _get_number(spec, "time", float, 0.0)
+        self.amplitude = _get_number(spec, "amplitude", float, 0.0)
+
+        self.format = spec.get("format", "png")
+
+        if self.format not in _FORMATS:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "unknown format {!r}, expected one of: {}".format(
+                self.format, ", ".join(_FORMATS)))
+
+        self.timeout = _get_number(spec, "timeout", float, None)
+
+        self.future = asyncio.get_running_loop().create_future()
+        self.created = perf_counter()
+        self.queue_time = None
+        self.render_time = None
+
+
+def _get_object(spec, name) -> dict:
+    value = spec.get(name, {})
+
+    if not isinstance(value, dict):
+        raise ServiceError(HTTPStatus.BAD_REQUEST, "{} has to be an object".format(name))
+
+    return dict(value)
+
+
+def _get_number(spec, name, number_type, default):
+    value = spec.get(name)
+
+    if value is None:
+        return default
+
+    # JSON booleans are numbers to Python, so they are told apart explicitly
+    if (number_type is bool) != isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ServiceError(HTTPStatus.BAD_REQUEST, "{} has to be {}".format(
+            name, "true or false" if number_type is bool else "a number"))
+
+    # Python's json module accepts NaN and Infinity
+    if isinstance(value, float) and not math.isfinite(value):
+        raise ServiceError(HTTPStatus.BAD_REQUEST, "{} has to be a finite number".format(name))
+
+    # 2.0 is an integer, 2.5 isn't rounded down to one
+    if number_type is int and isinstance(value, float) and not value.is_integer():
+        raise ServiceError(HTTPStatus.BAD_REQUEST, "{} has to be an integer".format(name))
+
+    return number_type(value)
+
+
+def _get_quality(quality, name):
+    number_type, minimum = _QUALITY_TYPES[name]
+
+    if quality[name] is None:
+        if name != "iteration_limit":
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "{} can't be null".format(name))
+
+        return None
+
+    if number_type is tuple:
+        vector = tuple(_get_vector(quality, name))
+
+        if not any(vector):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "{} can't be zero".format(name))
+
+        return vector
+
+    value = _get_number(quality, name, number_type, None)
+
+    if number_type is not bool and (value < minimum if minimum is not None else value <= 0):
+        raise ServiceError(HTTPStatus.BAD_REQUEST, "{} has to be {}".format(
+            name, "at least {}".format(minimum) if minimum is not None else "positive"))
+
+    return value
+
+
+def _get_vector(spec, name, number_type=float) -> Optional[list]:
+    value = spec.get(name)
+
+    if value is None:
+        return None
+
+    if not isinstance(value, list) or len(value) != 3:
+        raise ServiceError(HTTPStatus.BAD_REQUEST, "{} has to be a list of 3 numbers".format(name))
+
+    vector = [_get_number({name: component}, name, number_type, None) for component in value]
+
+    # the renderer works in single precision
+    if number_type is float and any(abs(component) > float(np.finfo(np.float32).max) for component in vector):
+        raise ServiceError(HTTPStatus.BAD_REQUEST, "{} is out of range".format(name))
+
+    return vector
+
+
+def _check_view(position, target, direction, world_up):
+    # the camera turns to the target, or else along the direction, as Camera.look_at does in single precision. A view
+    # of zero length or along the up vector leaves it without an orientation, every pixel would be NaN
+    if target is None and direction is None:
+        return
+
+    position = np.array(position, dtype=np.float32)
+
+    with np.errstate(over="ignore", invalid="ignore"):
+        if target is not None:
+            view = np.array(target, dtype=np.float32) - position
+        else:
+            view = (position + np.array(direction, dtype=np.float32)) - position
+
+        length = np.linalg.norm(view)
+
+    if not np.isfinite(length):
+        raise ServiceError(HTTPStatus.BAD_REQUEST, "the camera is out of range")
+
+    if length == 0:
+        raise ServiceError(HTTPStatus.BAD_REQUEST, "the camera target can't be its position" if target is not None
+                           else "the camera direction can't be zero")
+
+    if np.linalg.norm(np.cross(view / length, world_up)) < 1e-4:
+        raise ServiceError(HTTPStatus.BAD_REQUEST, "the camera can't look straight up or down")
+
+
+class ServiceStatistics:
+    def __init__(self):
+        self.accepted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.timed_out = 0
+        self.rejected = 0
+
+        # seconds the completed jobs waited in the queue and spent on a device
+        self.queue_time = 0.0
+        self.render_time = 0.0
+
+
+class RenderService:
+    def __init__(self,
+                 renderers: Sequence[Renderer],
+                 queue_size: int = 16,
+                 max_connections: int = 64,
+                 max_pixels: int = 4096 * 4096,
+                 job_timeout: Optional[float] = 60.0,
+                 request_timeout: float = 10.0,
+                 build: bool = False):
+
+        # every renderer (one per device) keeps its context, buffers and compiled programs for the lifetime of the
+        # service and renders one job at a time on a thread of its own, so each program is compiled once per device
+        self.renderers = list(renderers)
+
+        # at most queue_size jobs wait for a device and max_connections requests are handled at once,
+        # anything beyond that is answered with 503 right away instead of piling up
+        self.queue_size = max(1, queue_size)
+        self.max_connections = max(1, max_connections)
+        self.max_pixels = max_pixels
+        self.job_timeout = job_timeout
+        self.request_timeout = request_timeout
+        self.build = build
+
+        self.statistics = ServiceStatistics()
+
+        render = self.renderers[0].render
+        self.default_fractal = render.fractal.get_name()
+        self.fractal_parameters = {fractal.get_name(): fractal.get_default_parameters() for fractal in render.fractals}
+
+        # what jobs look from when they don't set the position, and the up vector the cameras are turned around
+        self._camera_positions = {
+            fractal.get_name(): fractal.get_initial_camera_position() for fractal in render.fractals
+        }
+        self._world_up = self.renderers[0].camera.world_up
+
+        # the quality a job doesn't set is reset to the one the renderers were created with
+        self._default_quality = [
+            {name: getattr(renderer.render, name) for name in Renderer.quality_fields}
+            for renderer in self.renderers
+        ]
+
+        self._device_jobs = [0] * len(self.renderers)
+        self._connections = 0
+        self._queue = None
+        self._executors = []
+        self._workers = []
+        self._server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8000):
+        loop = asyncio.get_running_loop()
+
+        self._queue = asyncio.Queue(self.queue_size)
+        self._executors = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="render-device-{}".format(i))
+            for i in range(len(self.renderers))
+        ]
+
+        if self.build:
+            await asyncio.gather(*(
+                loop.run_in_executor(executor, self._build_fractals, renderer)
+                for renderer, executor in zip(self.renderers, self._executors)
+            ))
+
+        self._workers = [
+            asyncio.create_task(self._run_device(index))
+            for index in range(len(self.renderers))
+        ]
+
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+
+        return self._server
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+        for worker in self._workers:
+            worker.cancel()
+
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+        while not self._queue.empty():
+            self._queue.get_nowait().future.cancel()
+
+        # a job still on a device is finished before its executor goes away
+        for executor in self._executors:
+            executor.shutdown()
+
+        self._executors = []
+
+    @staticmethod
+    def _build_fractals(renderer):
+        for fractal in renderer.render.fractals:
+            renderer.render.build_fractal(fractal)
+
+    async def _run_device(self, index):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            job = await self._queue.get()
+
+            # cancelled while it was queued
+            if job.future.done():
+                continue
+
+            start = perf_counter()
+            job.queue_time = start - job.created
+
+            try:
+                image = await loop.run_in_executor(self._executors[index], self._render_job, index, job)
+            except Exception as error:
+                self.statistics.failed += 1
+
+                if not job.future.done():
+                    job.future.set_exception(error)
+
+                continue
+
+            job.render_time = perf_counter() - start
+
+            self._device_jobs[index] += 1
+            self.statistics.completed += 1
+            self.statistics.queue_time += job.queue_time
+            self.statistics.render_time += job.render_time
+
+            if not job.future.done():
+                job.future.set_result(image)
+
+    def _render_job(self, index, job) -> np.ndarray:
+        renderer = self.renderers[index]
+
+        # the whole state of the renderer is set, nothing of the previous job carries over
+        renderer.set_fractal(job.fractal)
+        renderer.render.fractal.set_parameters(dict(job.parameters), job.color)
+        renderer.set_quality(**dict(self._default_quality[index], **job.quality))
+        renderer.set_camera(position=job.position, target=job.target, direction=job.direction, zoom=job.zoom)
+        renderer.set_animation(job.time, job.amplitude)
+        renderer.render.resize(job.width, job.height)
+
+        return renderer.render_array()
+
+    def get_status(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "queue_size": self.queue_size,
+            "connections": self._connections,
+            "statistics": dict(vars(self.statistics)),
+            "devices": [
+                {
+                    "name": renderer.device.name if hasattr(renderer, "device") else "numpy",
+                    "jobs": jobs,
+                    "built_fractals": [fractal.get_name() for fractal in renderer.render.fractals if fractal.is_built]
+                }
+                for renderer, jobs in zip(self.renderers, self._device_jobs)
+            ],
+            "fractals": self.fractal_parameters
+        }
+
+    async def _handle_connection(self, reader, writer):
+        # one request per connection, the response always closes it. The connection counts toward max_connections
+        # until it is closed, also while a large response is still being sent
+        self._connections += 1
+
+        try:
+            response = await self._handle_request(reader)
+
+            if response is not None:
+                writer.write(_format_response(*response))
+                await writer.drain()
+
+            writer.close()
+            await writer.wait_closed()
+
+        except ConnectionError:
+            pass
+
+        finally:
+            self._connections -= 1
+
+    async def _handle_request(self, reader):
+        try:
+            if self._connections > self.max_connections:
+                self.statistics.rejected += 1
+                raise ServiceError(HTTPStatus.SERVICE_UNAVAILABLE, "too many connections")
+
+            method, path, body = await asyncio.wait_for(self._read_request(reader), self.request_timeout)
+
+            if path == "/status" and method == "GET":
+                return HTTPStatus.OK, "application/json", json.dumps(self.get_status()).encode(), {}
+
+            if path == "/render" and method == "POST":
+                return await self._handle_render(reader, body)
+
+            if path in ("/status", "/render"):
+                raise ServiceError(HTTPStatus.METHOD_NOT_ALLOWED, "{} doesn't allow {}".format(path, method))
+
+            raise ServiceError(HTTPStatus.NOT_FOUND, "no such path {}".format(path))
+
+        except ServiceError as error:
+            return _get_error_response(error.status, str(error))
+
+        except asyncio.TimeoutError:
+            return _get_error_response(HTTPStatus.REQUEST_TIMEOUT, "the request wasn't received in time")
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            return None
+
+        except Exception as error:
+            return _get_error_response(HTTPStatus.INTERNAL_SERVER_ERROR, "{}: {}".format(
+                type(error).__name__, error))
+
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").split()
+
+        if len(request_line) != 3 or not request_line[2].startswith("HTTP/1."):
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "malformed request line")
+
+        method, path, _ = request_line
+        headers = {}
+
+        while True:
+            line = (await reader.readline()).decode("latin-1")
+
+            if line in ("\r\n", "\n", ""):
+                break
+
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "malformed Content-Length")
+
+        if length > _MAX_BODY_SIZE:
+            raise ServiceError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "the request body is too large")
+
+        body = await reader.readexactly(length) if length > 0 else b""
+
+        return method, path.split("?", 1)[0], body
+
+    async def _handle_render(self, reader, body):
+        try:
+            spec = json.loads(body or b"{}")
+        except ValueError as error:
+            raise ServiceError(HTTPStatus.BAD_REQUEST, "malformed JSON: {}".format(error))
+
+        job = RenderJob(
+            spec,
+            self.default_fractal,
+            self.fractal_parameters,
+            self.max_pixels,
+            self._camera_positions,
+            self._world_up
+        )
+
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self.statistics.rejected += 1
+            raise ServiceError(HTTPStatus.SERVICE_UNAVAILABLE, "the job queue is full")
+
+        self.statistics.accepted += 1
+
+        # the client closing the connection cancels the job, as does the timeout. A client that only shuts down its
+        # side of the connection after the request (a half-close) can't be told apart from one that is gone, so
+        # half-closed connections aren't supported: their jobs are cancelled as well
+        disconnect = asyncio.ensure_future(_wait_for_disconnect(reader))
+        timeout = job.timeout if job.timeout is not None else self.job_timeout
+
+        try:
+            done, _ = await asyncio.wait((job.future, disconnect), timeout=timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            disconnect.cancel()
+
+        if job.future not in done:
+            job.future.cancel()
+
+            if disconnect in done:
+                self.statistics.cancelled += 1
+                return None
+
+            self.statistics.timed_out += 1
+            raise ServiceError(HTTPStatus.GATEWAY_TIMEOUT, "the job didn't finish within {}s".format(timeout))
+
+        image = job.future.result()
+
+        # encoding releases the GIL for the most part and runs beside the next job of the device
+        content = await asyncio.get_running_loop().run_in_executor(None, _encode_image, image, job.format)
+
+        return HTTPStatus.OK, _FORMATS[job.format], content, {
+            "X-Image-Width": image.shape[1],
+            "X-Image-Height": image.shape[0],
+            "X-Queue-Time": "{:.6f}".format(job.queue_time),
+            "X-Render-Time": "{:.6f}".format(job.render_time)
+        }
+
+
+async def _wait_for_disconnect(reader):
+    # anything the client sends after its request is ignored, only the end of the stream counts
+    while await reader.read(4096):
+        pass
+
+
+def _encode_image(image, image_format) -> bytes:
+    if image_format == "png":
+        return encode_png(image[:, :, :3])
+
+    # raw frames are (height, width, RGBA) bytes
+    return np.ascontiguousarray(image).tobytes()
+
+
+def _get_error_response(status, message):
+    return status, "application/json", json.dumps({"error": message}).encode(), {}
+
+
+def _format_response(status, content_type, content, headers) -> bytes:
+    lines = ["HTTP/1.1 {} {}".format(status.value, status.phrase)]
+    lines += ["{}: {}".format(name, value) for name, value in dict(headers, **{
+        "Content-Type": content_type,
+        "Content-Length": len(content),
+        "Connection": "close"
+    }).items()]
+
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + content
+
+
+async def serve(service: RenderService, host: str, port: int):
+    await service.start(host, port)
+
+    print("Serving {} render device(s) on http://{}:{}".format(len(service.renderers), *service.address))
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await service.close()
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = get_argument_parser(
+        prog="python -m src.render_service",
+        description="Render frames for HTTP clients on this machine, with the programs compiled once"
+    )
+
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--devices", type=int, nargs="+", default=None,
+                        help="indices of the devices of --platform that render jobs, --device by default")
+    parser.add_argument("--queue-size", type=int, default=16, help="jobs waiting for a device at most")
+    parser.add_argument("--max-connections", type=int, default=64)
+    parser.add_argument("--max-pixels", type=int, default=4096 * 4096, help="largest width * height of a job")
+    parser.add_argument("--job-timeout", type=float, default=60.0, help="seconds until a job is cancelled")
+    parser.add_argument("--build", action="store_true", help="compile every fractal before accepting jobs")
+
+    args = parser.parse_args(argv)
+
+    devices = args.devices if args.devices is not None and args.backend == "opencl" else [args.device]
+    renderers = []
+
+    try:
+        for device in devices:
+            renderers.append(create_renderer(argparse.Namespace(**dict(vars(args), device=device))))
+
+        service = RenderService(
+            renderers,
+            queue_size=args.queue_size,
+            max_connections=args.max_connections,
+            max_pixels=args.max_pixels,
+            job_timeout=args.job_timeout,
+            build=args.build
+        )
+
+        asyncio.run(serve(service, args.host, args.port))
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        for renderer in renderers:
+            renderer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import argparse
+import os
+from typing import Optional, Sequence
+
+import numpy as np
+import pyopencl as cl
+
+from .camera import Camera
+from .numpy_render import NumpyRender
+from .render import Render
+
+
+class Renderer:
+
+    quality_fields = (
+        "iteration_limit",
+        "ray_steps_limit",
+        "epsilon",
+        "ray_shift_multiplier",
+        "render_simple",
+        "sun_direction",
+        "reflection_depth",
+        "use_orbit_trap"
+    )
+
+    def __init__(self,
+                 platform_id=0,
+                 device_id=0,
+                 width: int = 500,
+                 height: int = 500,
+                 fractal: Optional[str] = None,
+                 backend: str = "opencl",
+                 workers: Optional[int] = None,
+                 **quality):
+
+        # the NumPy backend needs no OpenCL device, `workers` is its number of processes
+        if backend == "numpy":
+            self.camera = Camera(None, None, None)
+            self.render = NumpyRender(self.camera, width=width, height=height, workers=workers)
+
+        elif backend == "opencl":
+            self.platform = cl.get_platforms()[platform_id]
+            self.device = self.platform.get_devices()[device_id]
+            self.context = cl.Context([self.device])
+            self.queue = cl.CommandQueue(self.context)
+
+            self.camera = Camera(self.device, self.context, self.queue)
+            self.render = Render(
+                self.device,
+                self.context,
+                self.queue,
+                self.camera,
+                width=width,
+                height=height
+            )
+
+        else:
+            raise ValueError("Unknown backend {!r}, expected 'opencl' or 'numpy'".format(backend))
+
+        self.set_quality(**quality)
+        self.set_fractal(fractal if fractal is not None else self.render.fractal.get_name())
+
+    @property
+    def width(self):
+        return self.render.width
+
+    @property
+    def height(self):
+        return self.render.height
+
+    @property
+    def fractal_names(self):
+        return [fractal.get_name() for fractal in self.render.fractals]
+
+    def set_fractal(self, name: str):
+        if name not in self.render.fractal_by_name:
+            raise ValueError("Unknown fractal {!r}, expected one of: {}".format(name, ", ".join(self.fractal_names)))
+
+        self.render.fractal = self.render.fractal_by_name[name]
+
+        self.camera.position = self.render.fractal.get_initial_camera_position()
+        self.camera.look_at(self.render.fractal.get_initial_camera_target())
+
+    def set_camera(self, position=None, target=None, direction=None, zoom=None):
+        if position is not None:
+            self.camera.position = np.array(position, dtype=np.float32)
+
+        if target is not None:
+            self.camera.look_at(np.array(target, dtype=np.float32))
+        elif direction is not None:
+            self.camera.look_at(self.camera.position + np.array(direction, dtype=np.float32))
+
+        if zoom is not None:
+            self.camera.zoom = zoom
+
+    def set_quality(self, **quality):
+        for name, value in quality.items():
+            if name not in self.quality_fields:
+                raise ValueError("Unknown quality property {!r}".format(name))
+
+            setattr(self.render, name, value)
+
+    def set_animation(self, time=0.0, amplitude=0.0):
+        self.render.fractal.set_time(time)
+        self.render.fractal.set_amplitude(amplitude)
+
+    def render_array(self) -> np.ndarray:
+        self.render.render()
+
+        # the kernel writes pixels column by column, the returned image is (height, width, RGBA)
+        return self.render.host_buffer\
+            .reshape((self.width, self.height, 4))\
+            .transpose((1, 0, 2))\
+            .copy()
+
+    def render_to_file(self, path: str):
+        image = self.render_array()
+
+        if path.endswith(".npy"):
+            np.save(path, image)
+            return
+
+        from PIL import Image
+
+        Image.fromarray(image[:, :, :3]).save(path)
+
+    def render_poster(self, path: str, scale: int, tile_size: Optional[int] = None):
+        if tile_size is not None:
+            self.render.tile_size = tile_size
+
+        self.render.save(path, scale=scale)
+
+    def close(self):
+        self.render.close()
+
+
+def get_argument_parser(prog="python -m src.renderer",
+                        description="Render a single fractal frame without opening a window"):
+
+    parser = argparse.ArgumentParser(prog=prog, description=description)
+
+    parser.add_argument("--backend", choices=("opencl", "numpy"), default="opencl",
+                        help="the NumPy backend renders on the CPU without OpenCL")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="processes of the NumPy backend, all cores by default, 0 renders in this process")
+    parser.add_argument("--platform", type=int, default=0, help="OpenCL platform index")
+    parser.add_argument("--device", type=int, default=0, help="OpenCL device index")
+    parser.add_argument("--fractal", default=None, help="fractal name, e.g. Mandelbox")
+    parser.add_argument("--width", type=int, default=500)
+    parser.add_argument("--height", type=int, default=500)
+
+    parser.add_argument("--position", type=float, nargs=3, metavar=("X", "Y", "Z"))
+    parser.add_argument("--target", type=float, nargs=3, metavar=("X", "Y", "Z"))
+    parser.add_argument("--zoom", type=float, default=None)
+
+    parser.add_argument("--iteration-limit", type=int, default=None)
+    parser.add_argument("--ray-steps-limit", type=int, default=200)
+    parser.add_argument("--epsilon", type=float, default=0.001)
+    parser.add_argument("--ray-shift-multiplier", type=float, default=1.0)
+    parser.add_argument("--phong", action="store_true", help="use Blinn-Phong shading instead of the simple mode")
+    parser.add_argument("--reflection-depth", type=int, default=1)
+    parser.add_argument("--no-orbit-trap", action="store_true")
+    parser.add_argument("--sun-direction", type=float, nargs=3, default=(-1, 1, -1), metavar=("X", "Y", "Z"))
+
+    parser.add_argument("--time", type=float, default=0.0)
+    parser.add_argument("--amplitude", type=float, default=0.0)
+
+    parser.add_argument("--scale", type=int, default=None,
+                        help="render a poster of scale * (width, height) pixels tile by tile, "
+                             "use a .tiff or .raw output to keep memory usage bounded")
+    parser.add_argument("--tile-size", type=int, default=None)
+
+    parser.add_argument("--list-fractals", action="store_true")
+    parser.add_argument("-o", "--output", default="render.png", help="output file (.png, .tiff, .raw, .npy, ...)")
+
+    return parser
+
+
+def parse_arguments(argv: Optional[Sequence[str]] = None):
+    return get_argument_parser().parse_args(argv)
+
+
+def create_renderer(args) -> Renderer:
+    return Renderer(
+        platform_id=args.platform,
+        device_id=args.device,
+        width=args.width,
+        height=args.height,
+        fractal=args.fractal,
+        backend=args.backend,
+        workers=args.workers,
+        iteration_limit=args.iteration_limit,
+        ray_steps_limit=args.ray_steps_limit,
+        epsilon=args.epsilon,
+        ray_shift_multiplier=args.ray_shift_multiplier,
+        render_simple=not args.phong,
+        sun_direction=tuple(args.sun_direction),
+        reflection_depth=args.reflection_depth,
+        use_orbit_trap=not args.no_orbit_trap
+    )
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    args = parse_arguments(argv)
+
+    renderer = create_renderer(args)
+
+    try:
+        if args.list_fractals:
+            print("\n".join(renderer.fractal_names))
+            return
+
+        renderer.set_camera(position=args.position, target=args.target, zoom=args.zoom)
+        renderer.set_animation(args.time, args.amplitude)
+
+        directory = os.path.dirname(args.output)
+
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        if args.scale is not None:
+            renderer.render_poster(args.output, args.scale, args.tile_size)
+        else:
+            renderer.render_to_file(args.output)
+
+    finally:
+        renderer.close()
+
+
+if __name__ == "__main__":
+    main()
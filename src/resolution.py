@@ -0,0 +1,65 @@
+import math
+from typing import Tuple
+
+
+class ResolutionController:
+    def __init__(self,
+                 target_fps: float = 30.0,
+                 min_scale: float = 0.25,
+                 max_scale: float = 1.0,
+                 hysteresis: float = 0.15,
+                 smoothing: float = 0.3,
+                 max_step: float = 1.25,
+                 granularity: float = 1.0 / 32.0):
+
+        self.target_fps = target_fps
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.hysteresis = hysteresis
+        self.smoothing = smoothing
+        self.max_step = max_step
+        self.granularity = granularity
+
+        self.scale = max_scale
+        self.frame_time = None
+
+    @property
+    def target_frame_time(self):
+        return 1.0 / self.target_fps
+
+    def reset(self):
+        self.scale = self.max_scale
+        self.frame_time = None
+
+    def update(self, frame_time: float) -> float:
+        if frame_time is None or frame_time <= 0.0:
+            return self.scale
+
+        if self.frame_time is None:
+            self.frame_time = frame_time
+        else:
+            self.frame_time += (frame_time - self.frame_time) * self.smoothing
+
+        target = self.target_frame_time
+
+        # inside the hysteresis band the scale is left alone, so the resolution does not flicker
+        if target * (1.0 - self.hysteresis) <= self.frame_time <= target * (1.0 + self.hysteresis):
+            return self.scale
+
+        # the kernel cost is roughly proportional to the number of pixels, i.e. to scale ** 2
+        ratio = math.sqrt(target / self.frame_time)
+        ratio = min(self.max_step, max(1.0 / self.max_step, ratio))
+
+        scale = self.scale * ratio
+        scale = round(scale / self.granularity) * self.granularity
+        scale = min(self.max_scale, max(self.min_scale, scale))
+
+        if scale != self.scale:
+            # the measured time belongs to the old resolution, rescale it to the new one
+            self.frame_time *= (scale / self.scale) ** 2
+            self.scale = scale
+
+        return self.scale
+
+    def get_size(self, width: int, height: int) -> Tuple[int, int]:
+        return max(1, int(round(width * self.scale))), max(1, int(round(height * self.scale)))
@@ -0,0 +1,83 @@
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+
+# in the order of the counter planes written by the program built with COLLECT_STATISTICS
+COUNTERS = (
+    "primary_steps",
+    "shadow_steps",
+    "reflection_steps",
+    "reflection_bounces",
+    "normal_evaluations",
+    "distance_evaluations"
+)
+
+# false colour palette from cold (little work) to hot (a lot of work)
+_PALETTE = np.array([
+    (0, 0, 4),
+    (40, 11, 84),
+    (101, 21, 110),
+    (159, 42, 99),
+    (212, 72, 66),
+    (245, 125, 21),
+    (250, 193, 39),
+    (252, 255, 164)
+], dtype=np.float32)
+
+
+class FrameStatistics:
+    def __init__(self, counters: np.ndarray):
+        # (len(COUNTERS), height, width) array of per-pixel counters
+        self.counters = counters
+
+    @property
+    def width(self):
+        return self.counters.shape[2]
+
+    @property
+    def height(self):
+        return self.counters.shape[1]
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if name not in COUNTERS:
+            raise KeyError("Unknown counter {!r}, expected one of: {}".format(name, ", ".join(COUNTERS)))
+
+        return self.counters[COUNTERS.index(name)]
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        summary = {}
+
+        for name in COUNTERS:
+            values = self[name]
+
+            summary[name] = {
+                "mean": float(values.mean()),
+                "median": float(np.median(values)),
+                "p95": float(np.percentile(values, 95)),
+                "max": int(values.max()),
+                "total": int(values.sum(dtype=np.uint64))
+            }
+
+        return summary
+
+    def histogram(self, name: str, bins: int = 32) -> Tuple[np.ndarray, np.ndarray]:
+        values = self[name]
+
+        return np.histogram(values, bins=bins, range=(0, max(1, int(values.max()) + 1)))
+
+    def heatmap(self, name: str, maximum: Optional[float] = None) -> np.ndarray:
+        # (height, width, RGB) false colour image, by default the 99th percentile is the hottest colour
+        # so that a few pathological pixels don't flatten the rest of the image
+        values = self[name].astype(np.float32)
+
+        if maximum is None:
+            maximum = np.percentile(values, 99)
+
+        normalized = np.clip(values / max(float(maximum), 1.0), 0.0, 1.0) * (len(_PALETTE) - 1)
+
+        lower = np.floor(normalized).astype(np.int32)
+        upper = np.minimum(lower + 1, len(_PALETTE) - 1)
+        fraction = (normalized - lower)[..., None]
+
+        return (_PALETTE[lower] * (1.0 - fraction) + _PALETTE[upper] * fraction).astype(np.uint8)
@@ -0,0 +1,30 @@
+import numpy as np
+
+
+_missing = object()
+
+
+class Tracked:
+
+    # names of the attributes whose assignment invalidates what was uploaded to the device
+    _tracked_attributes = frozenset()
+
+    version = 0
+
+    def __setattr__(self, name, value):
+        if name in self._tracked_attributes and self._changes(name, value):
+            object.__setattr__(self, "version", self.version + 1)
+
+        object.__setattr__(self, name, value)
+
+    def _changes(self, name, value):
+        previous = self.__dict__.get(name, _missing)
+
+        # arrays are usually updated in place (`camera.position += shift`), so any assignment counts
+        if previous is _missing or isinstance(value, np.ndarray) or isinstance(previous, np.ndarray):
+            return True
+
+        return type(previous) is not type(value) or previous != value
+
+    def touch(self):
+        object.__setattr__(self, "version", self.version + 1)
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pyopencl as cl
+
+from .program_cache import get_default_cache_directory
+
+
+TUNING_FILE_NAME = "work_group_sizes.json"
+
+# 2D tiles tried besides the driver default, the ones the kernel or the device can't run are dropped
+CANDIDATE_SHAPES = (
+    (8, 8), (16, 4), (4, 16), (16, 8), (8, 16), (16, 16), (32, 2), (32, 4), (8, 4), (4, 8), (4, 4)
+)
+
+LocalSize = Optional[Tuple[int, int]]
+
+
+def get_default_tuning_path() -> Optional[str]:
+    directory = get_default_cache_directory()
+
+    return os.path.join(directory, TUNING_FILE_NAME) if directory is not None else None
+
+
+def get_candidate_local_sizes(kernel: cl.Kernel, device: cl.Device) -> List[LocalSize]:
+    max_size = kernel.get_work_group_info(cl.kernel_work_group_info.WORK_GROUP_SIZE, device)
+    multiple = kernel.get_work_group_info(cl.kernel_work_group_info.PREFERRED_WORK_GROUP_SIZE_MULTIPLE, device)
+    max_x, max_y = device.max_work_item_sizes[:2]
+
+    # rows as wide as the preferred multiple keep whole SIMD batches on neighbouring pixels
+    shapes = list(CANDIDATE_SHAPES) + [(multiple, 1), (multiple, 2), (multiple, 4)]
+
+    candidates = [None]
+
+    for shape in shapes:
+        if shape not in candidates and shape[0] * shape[1] <= max_size and shape[0] <= max_x and shape[1] <= max_y:
+            candidates.append(shape)
+
+    return candidates
+
+
+def pad_global_size(global_size: Sequence[int], local_size: LocalSize) -> Tuple[int, ...]:
+    # the kernel skips the work items past the end of the tile, so the padding renders nothing
+    if local_size is None:
+        return tuple(global_size)
+
+    return tuple(-(-size // local) * local for size, local in zip(global_size, local_size))
+
+
+class WorkGroupTuner:
+    def __init__(self, path: Optional[str] = None, repeats: int = 3):
+        # winners are kept in this JSON file, without one they only live as long as the tuner
+        self.path = path
+        self.repeats = repeats
+
+        self._local_sizes = self._load()
+
+    def get_key(self, device: cl.Device, source: str, mode: str) -> str:
+        digest = hashlib.sha256()
+
+        for part in (
+            source,
+            device.name,
+            device.vendor,
+            device.driver_version,
+            device.platform.name,
+            str(device.max_compute_units)
+        ):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+
+        return digest.hexdigest() + ":" + mode
+
+    def get(self, key: str) -> Tuple[bool, LocalSize]:
+        # (False, None) for keys that were never tuned, the driver default is a valid winner as well
+        if key not in self._local_sizes:
+            return False, None
+
+        local_size = self._local_sizes[key]
+
+        return True, tuple(local_size) if local_size is not None else None
+
+    def tune(self,
+             key: str,
+             candidates: Sequence[LocalSize],
+             launch: Callable[[LocalSize], cl.Event]) -> LocalSize:
+
+        found, local_size = self.get(key)
+
+        if found:
+            return local_size
+
+        times: Dict[LocalSize, float] = {}
+
+        for candidate in candidates:
+            try:
+                # the first launch is not measured, it warms up caches and the driver
+                launch(candidate).wait()
+
+                samples = []
+
+                for _ in range(self.repeats):
+                    start = time.perf_counter()
+                    launch(candidate).wait()
+                    samples.append(time.perf_counter() - start)
+
+            except cl.Error:
+                # e.g. out of resources, the kernel needs more registers than such a group has
+                continue
+
+            times[candidate] = float(np.median(samples))
+
+        local_size = min(times, key=times.get) if times else None
+
+        self._local_sizes[key] = list(local_size) if local_size is not None else None
+        self._store()
+
+        return local_size
+
+    def clear(self):
+        self._local_sizes = {}
+
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    # PRIVATE METHODS
+
+    def _load(self) -> Dict[str, Optional[List[int]]]:
+        if self.path is None:
+            return {}
+
+        try:
+            with open(self.path) as f:
+                local_sizes = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        return local_sizes if isinstance(local_sizes, dict) else {}
+
+    def _store(self):
+        if self.path is None:
+            return
+
+        # winners tuned by other processes in the meantime are kept
+        local_sizes = self._load()
+        local_sizes.update(self._local_sizes)
+
+        directory = os.path.dirname(self.path) or "."
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+
+            descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+
+            with os.fdopen(descriptor, "w") as f:
+                json.dump(local_sizes, f, indent=2, sort_keys=True)
+
+            os.replace(temporary_path, self.path)
+
+        except OSError:
+            return